@@ -0,0 +1,318 @@
+"""Asyncio runtime of the moderation bot.
+
+Runs the moderation logic of telegram_bot.py on AsyncTeleBot. Updates are
+received and dispatched on the event loop; blocking work is done on a
+dedicated thread pool so that it never blocks the loop. Settings, database
+helpers and caches are shared with telegram_bot.py; edit the settings there.
+
+Messages, joins and most admin commands are handled by the very functions
+telegram_bot.py registers for them, run on the thread pool: the message
+filter pipeline (flood control, links and domain lists, swear words, spam
+copies), raid detection and the shared commands (/ban, /cachestats,
+/setflood, /allowdomain, /blockdomain, /unlistdomain, /domains, /spam,
+/apistats, /filterstats). The admin roster they check is fetched on the
+event loop beforehand, so no thread of the pool waits on Telegram for it.
+Their requests go through telegram_bot's ApiScheduler, so they are rate
+limited, and deletions are batched, the same as in the threaded bot. Only
+the simple commands below and the captcha answers are coroutines of their
+own.
+
+Usage: python async_bot.py
+"""
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import telebot
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_helper import ApiTelegramException
+
+import telegram_bot as core
+from telegram_bot import logger
+
+# Threads running database helpers and shared handlers; each keeps its own connection.
+DB_EXECUTOR_THREADS = 4
+
+# --- INITIALIZATION ---
+# The token is checked in the __main__ block, so the module can be imported without one.
+bot = AsyncTeleBot(core.BOT_TOKEN, validate_token=False)
+db_executor = ThreadPoolExecutor(
+    max_workers=DB_EXECUTOR_THREADS, thread_name_prefix="db"
+)
+
+
+async def run_db(func, *args):
+    """Runs a blocking database helper or shared handler on the database thread pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, functools.partial(func, *args))
+
+
+async def run_shared(handler, message: telebot.types.Message):
+    """Runs a handler of telegram_bot.py on the database thread pool.
+
+    The admin roster of the chat is fetched here first, so that the handler finds
+    it cached instead of blocking a database thread on the request.
+    """
+    await get_chat_admins(message.chat.id)
+    await run_db(handler, message)
+
+
+# --- BOT LOGIC ---
+
+# {chat_id: task fetching the admin roster}, so concurrent misses share one request.
+_admin_fetches = {}
+
+
+async def _fetch_chat_admins(chat_id: int) -> frozenset:
+    """Fetches the admin roster of a chat and caches it."""
+    try:
+        admins = core.cache_admin_roster(chat_id, await bot.get_chat_administrators(chat_id))
+    except ApiTelegramException as e:
+        logger.debug(f"Error fetching administrators of {chat_id}: {e}")
+        admins = frozenset()
+        core.admin_cache.set(chat_id, admins, ttl=core.ADMIN_CACHE_NEGATIVE_TTL)
+    return admins
+
+
+async def get_chat_admins(chat_id: int) -> frozenset:
+    """Returns the ids of the chat administrators, fetching the roster when not cached."""
+    admins = core.admin_cache.get(chat_id)
+    if admins is not None:
+        return admins
+    task = _admin_fetches.get(chat_id)
+    if task is None:
+        task = asyncio.ensure_future(_fetch_chat_admins(chat_id))
+        _admin_fetches[chat_id] = task
+        task.add_done_callback(lambda _: _admin_fetches.pop(chat_id, None))
+    return await task
+
+
+async def is_admin(user_id: int, chat_id: int) -> bool:
+    """Checks if a user is an administrator of a chat."""
+    return user_id in await get_chat_admins(chat_id)
+
+
+async def require_admin(message: telebot.types.Message) -> bool:
+    """Checks that the sender is an administrator, replying to them if not."""
+    if await is_admin(message.from_user.id, message.chat.id):
+        return True
+    await bot.reply_to(message, "Only administrators can use this command.")
+    return False
+
+
+@bot.chat_member_handler()
+async def handle_chat_member_update(update: telebot.types.ChatMemberUpdated):
+    """Keeps the cached admin roster in sync with promotions and demotions."""
+    core.handle_chat_member_update(update)
+
+
+@bot.message_handler(commands=["start"])
+async def handle_start(message: telebot.types.Message):
+    """Handles the /start command in a private chat."""
+    if message.chat.type == "private":
+        await bot.reply_to(message, "This bot is intended for use in groups.")
+
+
+@bot.message_handler(commands=["setwelcome"])
+async def set_welcome_message(message: telebot.types.Message):
+    """Sets the welcome message for the chat."""
+    if not await require_admin(message):
+        return
+
+    welcome_message = (
+        message.text.split(maxsplit=1)[1] if len(message.text.split()) > 1 else ""
+    )
+    if welcome_message:
+        await run_db(core.set_welcome_message_db, message.chat.id, welcome_message)
+        await bot.reply_to(message, f'Welcome message updated to: "{welcome_message}"')
+    else:
+        await bot.reply_to(
+            message, "Please provide a welcome message. Usage: /setwelcome <message>"
+        )
+
+
+@bot.message_handler(commands=["setrules"])
+async def set_rules(message: telebot.types.Message):
+    """Sets the rules for the chat."""
+    if not await require_admin(message):
+        return
+
+    rules = message.text.split(maxsplit=1)[1] if len(message.text.split()) > 1 else ""
+    if rules:
+        await run_db(core.set_rules_db, message.chat.id, rules)
+        await bot.reply_to(message, f'Rules updated to: "{rules}"')
+    else:
+        await bot.reply_to(message, "Please provide the rules. Usage: /setrules <rules>")
+
+
+@bot.message_handler(commands=["rules"])
+async def show_rules(message: telebot.types.Message):
+    """Shows the rules of the chat."""
+    chat_settings = await run_db(core.get_chat_settings, message.chat.id)
+    rules = chat_settings.get("rules") or "No rules have been set for this chat yet."
+    await bot.reply_to(message, rules)
+
+
+@bot.message_handler(commands=["mute"])
+async def mute_user(message: telebot.types.Message):
+    """Mutes a user for a specified amount of time."""
+    if not await require_admin(message):
+        return
+
+    try:
+        user_id = message.reply_to_message.from_user.id
+        mute_time = int(message.text.split()[1])
+    except (AttributeError, IndexError, ValueError):
+        mute_time = 0
+    if mute_time < 1:
+        await bot.reply_to(message, "Usage: /mute <time_in_seconds> (reply to a message)")
+        return
+    await run_db(core.mute_scheduler.mute, message.chat.id, user_id, mute_time)
+    await bot.reply_to(message, f"User {user_id} has been muted for {mute_time} seconds.")
+
+
+@bot.message_handler(commands=["report"])
+async def report_to_admins(message: telebot.types.Message):
+    """Reports a message to the admins."""
+    if message.reply_to_message:
+        # Digests are sent by the notifier's own thread.
+        core.admin_notifier.reported(message.from_user, message.reply_to_message)
+        await bot.reply_to(message, "The message has been reported to the administrators.")
+    else:
+        await bot.reply_to(message, "Please reply to a message to report it.")
+
+
+def register_toggle_command(command: str, setter, subject: str):
+    """Registers an admin command that turns a chat setting on or off."""
+
+    @bot.message_handler(commands=[command])
+    async def set_toggle(message: telebot.types.Message):
+        if not await require_admin(message):
+            return
+
+        parts = message.text.split()
+        status = parts[1].lower() if len(parts) > 1 else ""
+        if status in ("on", "off"):
+            await run_db(setter, message.chat.id, status == "on")
+            state = "enabled" if status == "on" else "disabled"
+            await bot.reply_to(message, f"{subject} is now {state}.")
+        else:
+            await bot.reply_to(message, f"Usage: /{command} <on/off>")
+
+    return set_toggle
+
+
+register_toggle_command("deletelinks", core.set_delete_links_db, "Link deletion")
+register_toggle_command(
+    "deleteforwards", core.set_delete_forwards_db, "Forwarded message deletion"
+)
+register_toggle_command("deletefiles", core.set_delete_files_db, "File deletion")
+
+
+def register_shared_command(commands: list, handler):
+    """Registers a command handled by the function telegram_bot.py registers for it."""
+
+    @bot.message_handler(commands=commands)
+    async def handle_shared(message: telebot.types.Message):
+        await run_shared(handler, message)
+
+    return handle_shared
+
+
+register_shared_command(["ban"], core.ban_user)
+register_shared_command(["cachestats"], core.show_cache_stats)
+register_shared_command(["setflood"], core.set_flood_limit)
+register_shared_command(["allowdomain", "blockdomain", "unlistdomain"], core.set_domain_lists)
+register_shared_command(["domains"], core.show_domain_lists)
+register_shared_command(["spam"], core.mark_spam)
+register_shared_command(["apistats"], core.show_api_stats)
+register_shared_command(["filterstats"], core.show_filter_stats)
+
+
+@bot.message_handler(commands=["setlogchannel"])
+async def set_log_channel(message: telebot.types.Message):
+    """Sets the log channel for the chat."""
+    if not await require_admin(message):
+        return
+
+    try:
+        log_channel = int(message.text.split()[1])
+    except (IndexError, ValueError):
+        await bot.reply_to(
+            message,
+            "Please provide a valid channel ID. Usage: /setlogchannel <channel_id>",
+        )
+        return
+    await run_db(core.set_log_channel_db, message.chat.id, log_channel)
+    # Log handlers send from their own thread, so they use the synchronous bot.
+    core.add_log_channel(log_channel)
+    await bot.reply_to(message, f"Log channel updated to: {log_channel}")
+
+
+@bot.message_handler(content_types=["new_chat_members"])
+async def handle_new_member(message: telebot.types.Message):
+    """Sends captchas to new users, aggregated during raids."""
+    await run_shared(core.handle_new_member, message)
+
+
+@bot.callback_query_handler(func=lambda call: (call.data or "").startswith("cap:"))
+async def handle_captcha_answer(call: telebot.types.CallbackQuery):
+    """Checks the answer a user pressed on a captcha."""
+    captcha = core.parse_captcha_data(call.data)
+    if captcha is None or call.message is None or captcha[0] != call.message.chat.id:
+        text = "This captcha is not valid."
+    elif captcha[1] and captcha[1] != call.from_user.id:
+        text = "This captcha is for someone else."
+    else:
+        text = await run_db(core.solve_captcha, captcha[0], call.from_user.id, captcha[2])
+    try:
+        await bot.answer_callback_query(call.id, text)
+    except ApiTelegramException as e:
+        logger.error(f"Error answering captcha: {e}")
+
+
+@bot.message_handler(func=lambda message: True, content_types=telebot.util.content_type_media)
+async def handle_all_messages(message: telebot.types.Message):
+    """Handles all incoming messages."""
+    await run_shared(core.handle_all_messages, message)
+
+
+# --- BOT START ---
+
+
+async def main():
+    """Prepares the database and polls for updates until stopped."""
+    logger.info("Initializing database...")
+    await run_db(core.init_db)
+    logger.info("Database ready.")
+    for channel_id in await run_db(core.get_log_channels):
+        core.add_log_channel(channel_id)
+    await run_db(core.captcha_store.start)
+    await run_db(core.mute_scheduler.start)
+    core.start_metrics()
+    logger.info("Starting bot...")
+    try:
+        # chat_member updates are not sent unless requested explicitly.
+        await bot.polling(non_stop=True, allowed_updates=telebot.util.update_types)
+    finally:
+        db_executor.shutdown()
+        core.raid_captcha_batcher.flush_all()
+        core.deletion_batcher.flush()
+        core.admin_notifier.flush()
+        core.api_scheduler.stop()  # Sends the digests and mute changes still queued
+        core.write_behind.flush()
+        core.close_connections()
+
+
+if __name__ == "__main__":
+    if not core.BOT_TOKEN:
+        logger.error(
+            "Error: Bot token not specified. Please edit telegram_bot.py and specify the BOT_TOKEN."
+        )
+    elif not core.ADMIN_ID:
+        logger.error(
+            "Error: Admin ID not specified. Please edit telegram_bot.py and specify the ADMIN_ID."
+        )
+    else:
+        asyncio.run(main())
@@ -0,0 +1,607 @@
+"""Benchmark and load test for the message handlers of telegram_bot.py.
+
+Synthetic updates are fed to the bot the way Telegram delivers them while the
+Bot API is replaced by a stand-in that answers every request and counts them
+by method, so only the bot's own work and the simulated API latency are
+measured. The stand-in either answers in-process or, with --api http, runs as
+a local HTTP server, so that requests take telebot's real network path.
+
+In polling mode the updates go through the bot's threaded worker pool, like
+bot.polling; in webhook mode they are POSTed to a local WebhookServer; in
+sharded mode a ShardRouter spreads them over worker processes by chat.
+
+Traffic mixes:
+    chatter  ordinary messages, a few with swear words
+    links    chatter and messages with links, in chats that delete links
+    raid     bursts of joins into a few chats
+    captcha  joins of new users, then their presses of the captcha buttons
+    mixed    all of the above
+
+The report gives throughput, p50/p99 handler latency and Bot API calls per
+update. --json saves it; --baseline compares it with a saved report and exits
+with status 1 if throughput, latency or API calls regressed beyond --tolerance.
+
+Usage:
+    python benchmark.py [--mode polling|webhook|sharded] [--api inprocess|http]
+                        [--mix chatter|links|raid|captcha|mixed] [--messages 5000]
+                        [--users 200] [--chats 10] [--threads 4] [--shards 4]
+                        [--api-latency 0] [--json FILE] [--baseline FILE]
+                        [--tolerance 0.2]
+"""
+
+import argparse
+import functools
+import http.client
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import telebot
+
+import sharded_bot
+import telegram_bot
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Bot", "username": "bot"}
+# Users who join during a benchmark get ids from here on; seeded users come before.
+NEW_USER_ID = 100000
+
+
+class FakeTelegramApi:
+    """Answers Bot API requests in-process and counts them by method."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = {}
+        self._message_id = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, method, url, params=None, files=None, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        return telebot.util.CustomRequestResponse(json.dumps(self.handle(api_method, params or {})))
+
+    def handle(self, api_method: str, params: dict) -> dict:
+        """Records a request and returns the response Telegram would send."""
+        with self._lock:
+            self.calls[api_method] = self.calls.get(api_method, 0) + 1
+            self._message_id += 1
+            message_id = self._message_id
+        if self.latency:
+            time.sleep(self.latency)
+        return {"ok": True, "result": self.result(api_method, params, message_id)}
+
+    def result(self, api_method: str, params: dict, message_id: int):
+        """Builds the result payload of a single API method."""
+        if api_method == "getMe":
+            return BOT_USER
+        if api_method == "getChatMember":
+            user = {"id": int(params.get("user_id", 0)), "is_bot": False, "first_name": "User"}
+            return {"status": "member", "user": user}
+        if api_method == "getChatAdministrators":
+            return [{"status": "creator", "user": BOT_USER, "is_anonymous": False}]
+        if api_method in ("sendMessage", "forwardMessage"):
+            return {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id", 0)), "type": "supergroup"},
+                "text": params.get("text", ""),
+            }
+        return True
+
+
+class FakeBotApiServer:
+    """Serves a FakeTelegramApi over HTTP at a local stand-in of api.telegram.org."""
+
+    def __init__(self, api: FakeTelegramApi, host: str = "127.0.0.1", port: int = 0):
+        self.api = api
+        self.httpd = ThreadingHTTPServer((host, port), self._make_request_handler())
+        self.httpd.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        """The value for telebot.apihelper.API_URL."""
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/bot{{0}}/{{1}}"
+
+    def _make_request_handler(self):
+        api = self.api
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # telebot keeps its connections alive
+
+            def do_GET(self):
+                self._answer(b"")
+
+            def do_POST(self):
+                self._answer(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+
+            def _answer(self, body: bytes):
+                url = urllib.parse.urlsplit(self.path)
+                params = dict(urllib.parse.parse_qsl(url.query))
+                if body and "json" not in self.headers.get("Content-Type", ""):
+                    params.update(urllib.parse.parse_qsl(body.decode("utf-8")))
+                response = json.dumps(api.handle(url.path.rsplit("/", 1)[-1], params)).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            def log_message(self, format, *args):
+                pass
+
+        return RequestHandler
+
+    def start(self):
+        """Serves requests on a background thread."""
+        threading.Thread(target=self.httpd.serve_forever, name="FakeBotApi", daemon=True).start()
+
+    def stop(self):
+        """Stops serving requests."""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def use_fake_api(api: FakeTelegramApi, url: str = None):
+    """Sends the Bot API requests of this process to a fake, in-process or at url."""
+    if url:
+        telebot.apihelper.CUSTOM_REQUEST_SENDER = None
+        telebot.apihelper.API_URL = url
+    else:
+        telebot.apihelper.CUSTOM_REQUEST_SENDER = api
+    telegram_bot.bot.token = "0:benchmark"
+
+
+# --- TRAFFIC ---
+
+
+def _user(user_id: int) -> dict:
+    return {
+        "id": user_id,
+        "is_bot": False,
+        "first_name": f"User{user_id}",
+        "username": f"user{user_id}",
+    }
+
+
+def make_update(update_id: int, chat_id: int, user_id: int, text: str, entities: list = None) -> dict:
+    """Builds the JSON of a text-message update as Telegram would deliver it."""
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "supergroup", "title": f"Chat {chat_id}"},
+        "from": _user(user_id),
+        "text": text,
+    }
+    if entities:
+        message["entities"] = entities
+    return {"update_id": update_id, "message": message}
+
+
+def make_join(update_id: int, chat_id: int, user_ids: list) -> dict:
+    """Builds the JSON of an update announcing new chat members."""
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": f"Chat {chat_id}"},
+            "from": _user(user_ids[0]),
+            "new_chat_members": [_user(user_id) for user_id in user_ids],
+        },
+    }
+
+
+def make_callback(update_id: int, chat_id: int, user_id: int, message_id: int, data: str) -> dict:
+    """Builds the JSON of an update for a pressed inline button."""
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": _user(user_id),
+            "chat_instance": str(chat_id),
+            "data": data,
+            "message": {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "supergroup", "title": f"Chat {chat_id}"},
+                "text": "",
+            },
+        },
+    }
+
+
+def chat_ids(chats: int) -> list:
+    """Returns the ids of the benchmark's chats."""
+    return [-1000 - i for i in range(chats)]
+
+
+# Share of each kind of update in a mix.
+MIXES = {
+    "chatter": {"chatter": 1.0},
+    "links": {"chatter": 0.5, "link": 0.5},
+    "raid": {"raid": 1.0},
+    "captcha": {"join": 1.0},
+    "mixed": {"chatter": 0.8, "link": 0.1, "join": 0.05, "raid": 0.05},
+}
+
+
+def make_words(count: int) -> list:
+    """Returns a reproducible vocabulary of made-up words."""
+    rng = random.Random(7)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    return ["".join(rng.choices(letters, k=rng.randint(2, 9))) for _ in range(count)]
+
+
+# Large enough that unrelated messages don't look like copies of each other to the spam
+# fingerprints, as they would if made of a handful of words.
+WORDS = make_words(2000)
+
+
+def make_traffic(mix: str, messages: int, users: int, chats: int, swear_ratio: float = 0.02) -> list:
+    """Generates a reproducible traffic mix as a list of phases.
+
+    A phase is a list of updates, or a function returning one when the phase
+    starts; captcha answers can only be built once the captchas were sent.
+    """
+    rng = random.Random(42)
+    chats = chat_ids(chats)
+    kinds, weights = zip(*MIXES[mix].items())
+    updates = []
+    joined = []  # (chat_id, user_id) of users who got a captcha
+    new_user_id = NEW_USER_ID
+    update_id = 0
+    while len(updates) < messages:
+        update_id += 1
+        kind = rng.choices(kinds, weights)[0]
+        if kind in ("chatter", "link"):
+            text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 15)))
+            entities = None
+            if kind == "link":
+                text += " https://spam.example.com/offer"
+                entities = [{"type": "url", "offset": len(text) - 30, "length": 30}]
+            elif rng.random() < swear_ratio:
+                text += " " + rng.choice(telegram_bot.SWEAR_WORDS)
+            user_id = 1000 + rng.randrange(users)
+            updates.append(make_update(update_id, rng.choice(chats), user_id, text, entities))
+        elif kind == "join":
+            chat_id = rng.choice(chats)
+            updates.append(make_join(update_id, chat_id, [new_user_id]))
+            joined.append((chat_id, new_user_id))
+            new_user_id += 1
+        else:  # A raid: a burst of joins into one of the first few chats
+            chat_id = chats[rng.randrange(min(3, len(chats)))]
+            for _ in range(min(50, messages - len(updates))):
+                updates.append(make_join(update_id, chat_id, [new_user_id]))
+                new_user_id += 1
+                update_id += 1
+    phases = [updates]
+    if joined:
+        phases.append(functools.partial(make_answers, joined, update_id + 1))
+    return phases
+
+
+def make_answers(joined: list, first_update_id: int, wrong_ratio: float = 0.1) -> list:
+    """Builds the button presses of joined users on their pending captchas, some of them wrong."""
+    rng = random.Random(7)
+    updates = []
+    for update_id, (chat_id, user_id) in enumerate(joined, first_update_id):
+        answer = telegram_bot.captcha_store.get(chat_id, user_id)
+        message_id = telegram_bot.captcha_challenges.message_id(chat_id, user_id)
+        if answer is None or message_id is None:
+            continue
+        if rng.random() < wrong_ratio:
+            answer += 1
+        data = telegram_bot.sign_captcha_data(chat_id, user_id, answer)
+        updates.append(make_callback(update_id, chat_id, user_id, message_id, data))
+    return updates
+
+
+def seed(users: int, chats: int, mix: str):
+    """Stores verified users, and chats that delete links for the link mixes."""
+    with telegram_bot.get_connection() as conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO users (user_id, is_bot, first_name, is_verified) VALUES (?, 0, ?, 1)",
+            [(1000 + i, f"User{1000 + i}") for i in range(users)],
+        )
+    if MIXES[mix].get("link"):
+        for chat_id in chat_ids(chats):
+            telegram_bot.set_delete_links_db(chat_id, True)
+
+
+# --- FEEDING ---
+
+
+def unlimited_scheduler() -> telegram_bot.ApiScheduler:
+    """Returns a scheduler without rate limits: the bot is measured, not Telegram's limits."""
+    return telegram_bot.ApiScheduler(
+        global_rate=1e6, group_chat_rate=1e6, private_chat_rate=1e6, chat_burst=1e6
+    )
+
+
+def relax_limits(mix: str):
+    """Turns off the protections the synthetic traffic of a mix would trip."""
+    # The synthetic users write far faster than people, so they would all be muted.
+    telegram_bot.FLOOD_MESSAGES = 0
+    if mix == "captcha":
+        # Measures one captcha per join; joins at this rate would be taken for a raid.
+        telegram_bot.raid_detector.threshold = float("inf")
+
+
+def setup_shard(db_name: str, api_latency: float, mix: str, api_url: str = None):
+    """Points a shard process at the benchmark database and a fake API."""
+    use_fake_api(FakeTelegramApi(latency=api_latency), api_url)
+    telegram_bot.DB_NAME = db_name
+    telegram_bot.METRICS_PORT = 0
+    relax_limits(mix)
+    telegram_bot.api_scheduler = unlimited_scheduler()
+
+
+def time_handlers(bot: telebot.TeleBot, samples: list):
+    """Makes the bot's handlers append their durations to samples; returns an undo function."""
+    wrapped = []
+    for handlers in (bot.message_handlers, bot.chat_member_handlers):
+        for handler in handlers:
+            func = handler["function"]
+            wrapped.append((handler, func))
+
+            @functools.wraps(func)
+            def timed(*args, func=func, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    samples.append(time.perf_counter() - started)
+
+            handler["function"] = timed
+
+    def undo():
+        for handler, func in wrapped:
+            handler["function"] = func
+
+    return undo
+
+
+def phase_updates(phase) -> list:
+    """Returns the updates of a traffic phase."""
+    return phase() if callable(phase) else phase
+
+
+def settle():
+    """Waits until the work the handlers left behind has been sent."""
+    telegram_bot.raid_captcha_batcher.flush_all()
+    telegram_bot.deletion_batcher.flush()
+    telegram_bot.api_scheduler.join()
+    telegram_bot.write_behind.flush()
+
+
+def drain(bot: telebot.TeleBot):
+    """Blocks until every task queued before the call has been processed."""
+    pool = bot.worker_pool
+    barrier = threading.Barrier(pool.num_threads + 1)
+    for _ in range(pool.num_threads):
+        pool.put(barrier.wait)
+    barrier.wait()
+    pool.raise_exceptions()
+
+
+def feed_polling(bot: telebot.TeleBot, phases: list, threads: int) -> tuple:
+    """Processes updates on the bot's worker pool in getUpdates-sized batches.
+
+    Returns the elapsed time and the number of updates.
+    """
+    bot.worker_pool.close()
+    bot.worker_pool = telebot.util.ThreadPool(bot, num_threads=threads)
+    count = 0
+    started = time.perf_counter()
+    for phase in phases:
+        updates = [telebot.types.Update.de_json(update) for update in phase_updates(phase)]
+        count += len(updates)
+        for i in range(0, len(updates), 100):  # getUpdates returns at most 100 updates
+            bot.process_new_updates(updates[i:i + 100])
+        drain(bot)
+        settle()
+    elapsed = time.perf_counter() - started
+    bot.worker_pool.close()
+    return elapsed, count
+
+
+def feed_webhook(bot: telebot.TeleBot, phases: list, threads: int, connections: int = 4) -> tuple:
+    """POSTs updates to a local webhook server over a few keep-alive connections.
+
+    Returns the elapsed time and the number of updates.
+    """
+    server = telegram_bot.WebhookServer(bot, "127.0.0.1", 0, "/telegram", workers=threads)
+    server.start()
+    host, port = server.address
+
+    def post(batch):
+        conn = http.client.HTTPConnection(host, port)
+        for update in batch:
+            while True:
+                conn.request("POST", "/telegram", json.dumps(update),
+                             {"Content-Type": "application/json"})
+                response = conn.getresponse()
+                response.read()
+                if response.status != 503:  # Queue full: retry like Telegram would
+                    break
+                time.sleep(0.01)
+            if response.status != 200:
+                raise RuntimeError(f"Webhook answered {response.status}")
+        conn.close()
+
+    count = 0
+    started = time.perf_counter()
+    for phase in phases:
+        updates = phase_updates(phase)
+        count += len(updates)
+        senders = [
+            threading.Thread(target=post, args=(updates[i::connections],))
+            for i in range(connections)
+        ]
+        for sender in senders:
+            sender.start()
+        for sender in senders:
+            sender.join()
+        server.join()
+        settle()
+    elapsed = time.perf_counter() - started
+    server.stop()
+    bot.threaded = True
+    return elapsed, count
+
+
+def feed_sharded(phases: list, shards: int, threads: int, setup) -> tuple:
+    """Routes updates to shard processes in getUpdates-sized batches.
+
+    Returns the elapsed time and the number of updates.
+    """
+    router = sharded_bot.ShardRouter(shards, threads, setup)
+    router.start()  # Process startup is not measured
+    updates = phase_updates(phases[0])  # Captchas live in the shards, answers can't be built
+    started = time.perf_counter()
+    for i in range(0, len(updates), 100):
+        router.route(updates[i:i + 100])
+    router.stop()
+    return time.perf_counter() - started, len(updates)
+
+
+# --- REPORT ---
+
+
+def percentile(samples: list, q: float) -> float:
+    """Returns the q-quantile of sorted samples (0 if there are none)."""
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+def run(args) -> dict:
+    """Runs one benchmark and returns its measurements."""
+    api = FakeTelegramApi(latency=args.api_latency / 1000)
+    api_server = None
+    if args.api == "http":
+        api_server = FakeBotApiServer(api)
+        api_server.start()
+    api_url = api_server.url if api_server else None
+    use_fake_api(api, api_url)
+    bot = telegram_bot.bot
+    telegram_bot.api_scheduler = unlimited_scheduler()
+    relax_limits(args.mix)
+    samples = []
+    undo = time_handlers(bot, samples)
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            telegram_bot.DB_NAME = os.path.join(tmp, "bench.db")
+            telegram_bot.init_db()
+            seed(args.users, args.chats, args.mix)
+            telegram_bot.close_connections()
+            phases = make_traffic(args.mix, args.messages, args.users, args.chats)
+            if args.mode == "sharded":
+                setup = functools.partial(
+                    setup_shard, telegram_bot.DB_NAME, api.latency, args.mix, api_url
+                )
+                elapsed, updates = feed_sharded(phases, args.shards, args.threads, setup)
+            else:
+                feed = feed_webhook if args.mode == "webhook" else feed_polling
+                elapsed, updates = feed(bot, phases, args.threads)
+            telegram_bot.api_scheduler.stop()
+            telegram_bot.close_connections()
+    finally:
+        undo()
+        if api_server:
+            api_server.stop()
+
+    samples.sort()
+    # Shards handle and count their updates in their own processes, unless the API is shared.
+    calls = api.calls if args.mode != "sharded" or api_server else {}
+    return {
+        "mode": args.mode,
+        "api": args.api,
+        "mix": args.mix,
+        "updates": updates,
+        "threads": args.threads,
+        "shards": args.shards if args.mode == "sharded" else 1,
+        "seconds": elapsed,
+        "updates_per_second": updates / elapsed,
+        "p50_ms": percentile(samples, 0.5) * 1000,
+        "p99_ms": percentile(samples, 0.99) * 1000,
+        "api_calls": dict(sorted(calls.items())),
+        "api_calls_per_update": sum(calls.values()) / updates if calls else None,
+    }
+
+
+def find_regressions(result: dict, baseline: dict, tolerance: float) -> list:
+    """Returns descriptions of the measurements that got worse than baseline by more than tolerance."""
+    regressions = []
+    if result["updates_per_second"] < baseline["updates_per_second"] * (1 - tolerance):
+        regressions.append(
+            f"throughput {result['updates_per_second']:.0f}/s "
+            f"< baseline {baseline['updates_per_second']:.0f}/s"
+        )
+    for key, name in [("p50_ms", "p50 latency"), ("p99_ms", "p99 latency")]:
+        if baseline.get(key) and result[key] > baseline[key] * (1 + tolerance):
+            regressions.append(f"{name} {result[key]:.3f} ms > baseline {baseline[key]:.3f} ms")
+    if (
+        baseline.get("api_calls_per_update") is not None
+        and result["api_calls_per_update"] is not None
+        and result["api_calls_per_update"] > baseline["api_calls_per_update"] * (1 + tolerance)
+    ):
+        regressions.append(
+            f"{result['api_calls_per_update']:.3f} API calls per update "
+            f"> baseline {baseline['api_calls_per_update']:.3f}"
+        )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", choices=["polling", "webhook", "sharded"], default="polling")
+    parser.add_argument("--api", choices=["inprocess", "http"], default="inprocess",
+                        help="answer API requests in-process or from a local HTTP server")
+    parser.add_argument("--mix", choices=sorted(MIXES), default="chatter")
+    parser.add_argument("--messages", type=int, default=5000, help="updates before captcha answers")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--chats", type=int, default=10)
+    parser.add_argument("--threads", type=int, default=4, help="worker threads (per shard)")
+    parser.add_argument("--shards", type=int, default=4, help="worker processes in sharded mode")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="simulated API latency, ms")
+    parser.add_argument("--json", help="save the report to this file")
+    parser.add_argument("--baseline", help="compare with a report saved by --json")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed relative regression against the baseline")
+    args = parser.parse_args()
+
+    result = run(args)
+    print(
+        f"{result['mode']} ({result['mix']}, {result['api']} API): {result['updates']} updates "
+        f"on {result['shards']} x {result['threads']} threads in {result['seconds']:.2f}s"
+    )
+    print(f"{result['updates_per_second']:.0f} updates/second")
+    if result["mode"] != "sharded":  # Shards time their handlers in their own processes
+        print(f"handler latency: p50 {result['p50_ms']:.3f} ms, p99 {result['p99_ms']:.3f} ms")
+    if result["api_calls"]:
+        print(
+            f"API calls: {result['api_calls_per_update']:.3f} per update;",
+            ", ".join(f"{k}={v}" for k, v in result["api_calls"].items()),
+        )
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(result, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION:", regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
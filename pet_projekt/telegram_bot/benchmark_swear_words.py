@@ -0,0 +1,79 @@
+"""Microbenchmark of swear word matching in telegram_bot.py.
+
+Compares the compiled SwearWordMatcher with the naive per-word scan it replaced
+on a synthetic corpus of chat messages.
+
+Usage:
+    python benchmark_swear_words.py [--words 5000] [--messages 20000] [--hit-ratio 0.02]
+"""
+
+import argparse
+import random
+import time
+
+import telegram_bot
+
+CYRILLIC = "абвгдежзийклмнопрстуфхцчшщъыьэюя"
+
+
+def make_corpus(words: int, messages: int, hit_ratio: float):
+    """Returns a reproducible word list and messages, some of them containing a listed word."""
+    rng = random.Random(42)
+
+    def word(low, high):
+        return "".join(rng.choice(CYRILLIC) for _ in range(rng.randint(low, high)))
+
+    swear_words = list({word(5, 10) for _ in range(words)})
+    vocabulary = [word(2, 8) for _ in range(2000)]
+    corpus = []
+    for _ in range(messages):
+        tokens = [rng.choice(vocabulary) for _ in range(rng.randint(3, 40))]
+        if rng.random() < hit_ratio:
+            tokens.insert(rng.randrange(len(tokens)), rng.choice(swear_words).upper())
+        corpus.append(" ".join(tokens).capitalize())
+    return swear_words, corpus
+
+
+def naive_search(words, text: str):
+    """The per-word scan check_swear_words used before the matcher."""
+    for word in words:
+        if word in text.lower():
+            return word
+    return None
+
+
+def measure(search, corpus) -> tuple:
+    """Returns the number of matching messages and the time it took to scan them."""
+    started = time.perf_counter()
+    found = sum(1 for text in corpus if search(text) is not None)
+    return found, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--words", type=int, default=5000)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--hit-ratio", type=float, default=0.02)
+    args = parser.parse_args()
+
+    swear_words, corpus = make_corpus(args.words, args.messages, args.hit_ratio)
+
+    started = time.perf_counter()
+    matcher = telegram_bot.SwearWordMatcher(swear_words)
+    build_time = time.perf_counter() - started
+    print(f"{len(swear_words)} words, {len(corpus)} messages")
+    print(f"matcher build: {build_time * 1000:.1f} ms")
+
+    for name, search in [
+        ("compiled matcher", matcher.search),
+        ("naive scan", lambda text: naive_search(swear_words, text)),
+    ]:
+        found, elapsed = measure(search, corpus)
+        print(
+            f"{name}: {found} matches, {elapsed:.3f}s, "
+            f"{len(corpus) / elapsed:.0f} messages/second"
+        )
+
+
+if __name__ == "__main__":
+    main()
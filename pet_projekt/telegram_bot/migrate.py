@@ -0,0 +1,30 @@
+"""Brings the schema of the bot's database up to date.
+
+Migrations are defined in telegram_bot.py and also run on every start of the
+bot; this script applies them ahead of a deployment, or with --dry-run reports
+which ones are pending and how long they take without changing anything.
+
+Usage: python migrate.py [--dry-run] [--db users.db]
+"""
+
+import argparse
+
+import telegram_bot
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dry-run", action="store_true", help="roll back instead of committing")
+    parser.add_argument("--db", default=telegram_bot.DB_NAME, help="database file")
+    args = parser.parse_args()
+
+    telegram_bot.DB_NAME = args.db
+    try:
+        report = telegram_bot.Migrator(telegram_bot.get_connection(), args.dry_run).run()
+    finally:
+        telegram_bot.close_connections()
+    print(telegram_bot.format_migration_report(report, args.dry_run))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+"""Multi-process runtime of the moderation bot.
+
+A front-end process fetches updates and routes each one to one of SHARDS
+worker processes by its chat id. A chat is therefore always handled by the same
+process, which owns the caches, pending captchas, deletion batches and rate
+limits of its chats; the SQLite database (in WAL mode) is the state all
+processes share. Settings are read from telegram_bot.py.
+
+Usage: python sharded_bot.py
+"""
+
+import multiprocessing
+import os
+import threading
+import time
+
+import requests
+import telebot
+
+import telegram_bot as core
+from telegram_bot import logger
+
+# Worker processes; one per core by default.
+SHARDS = os.cpu_count() or 1
+# Handler threads per worker process, so slow API calls don't stall a shard.
+SHARD_THREADS = 4
+# Batches of updates waiting per worker; when full, the front-end stops fetching.
+SHARD_QUEUE_SIZE = 100
+
+# Update fields that carry a chat, in the order they are looked up.
+CHAT_UPDATE_FIELDS = (
+    "message",
+    "edited_message",
+    "channel_post",
+    "edited_channel_post",
+    "chat_member",
+    "my_chat_member",
+    "chat_join_request",
+    "message_reaction",
+    "message_reaction_count",
+    "chat_boost",
+    "removed_chat_boost",
+)
+
+
+def update_chat_id(update: dict):
+    """Returns the chat an update belongs to, or None for chat-less updates."""
+    for field in CHAT_UPDATE_FIELDS:
+        if field in update:
+            return update[field]["chat"]["id"]
+    message = update.get("callback_query", {}).get("message")
+    return message["chat"]["id"] if message else None
+
+
+def shard_of(chat_id, shards: int) -> int:
+    """Returns the shard that handles a chat."""
+    return 0 if chat_id is None else chat_id % shards
+
+
+# --- WORKER ---
+
+
+def _process_batches(updates):
+    while True:
+        batch = updates.get()
+        if batch is None:
+            return
+        for update in batch:
+            try:
+                core.bot.process_new_updates([telebot.types.Update.de_json(update)])
+            except Exception as e:
+                logger.error(f"Error processing update {update.get('update_id')}: {e}")
+
+
+def run_shard(shard: int, shards: int, threads: int, updates, ready, setup=None):
+    """Entry point of a worker process: handles the updates routed to it until stopped.
+
+    setup, if given, is called first to adjust the settings of telegram_bot.
+    """
+    # Each shard gets an equal part of the global limit; chat limits are per shard anyway.
+    core.api_scheduler = core.ApiScheduler(global_rate=core.API_GLOBAL_RATE / shards)
+    if setup is not None:
+        setup()
+    # The shard's own threads run the handlers.
+    core.bot.threaded = False
+    for channel_id in core.get_log_channels():
+        core.add_log_channel(channel_id)
+
+    def owns_chat(chat_id):
+        return shard_of(chat_id, shards) == shard
+
+    core.captcha_store.start(owns_chat=owns_chat)
+    core.mute_scheduler.start(owns_chat=owns_chat)
+    # Every shard serves its own metrics, on the ports following METRICS_PORT.
+    core.start_metrics(port=core.METRICS_PORT and core.METRICS_PORT + 1 + shard)
+
+    workers = [
+        threading.Thread(target=_process_batches, args=(updates,), name=f"Shard{shard}-{i + 1}")
+        for i in range(threads)
+    ]
+    for worker in workers:
+        worker.start()
+    ready.set()
+    try:
+        for worker in workers:
+            worker.join()
+    finally:
+        core.raid_captcha_batcher.flush_all()
+        core.deletion_batcher.flush()
+        core.admin_notifier.flush()
+        core.api_scheduler.stop()
+        core.write_behind.flush()
+        core.close_connections()
+
+
+# --- FRONT-END ---
+
+
+class ShardRouter:
+    """Starts the worker processes and hands each of them the updates of its chats."""
+
+    def __init__(self, shards: int = SHARDS, threads: int = SHARD_THREADS, setup=None):
+        context = multiprocessing.get_context("spawn")  # Don't fork the front-end's threads
+        self.shards = shards
+        self.threads = threads
+        self.queues = [context.Queue(SHARD_QUEUE_SIZE) for _ in range(shards)]
+        self.ready = [context.Event() for _ in range(shards)]
+        self.processes = [
+            context.Process(
+                target=run_shard,
+                args=(i, shards, threads, self.queues[i], self.ready[i], setup),
+                name=f"Shard{i}",
+                daemon=True,
+            )
+            for i in range(shards)
+        ]
+
+    def start(self):
+        """Starts the workers and waits until all of them accept updates."""
+        for process in self.processes:
+            process.start()
+        for ready in self.ready:
+            ready.wait()
+
+    def route(self, updates: list):
+        """Sends updates (as received from the Bot API) to their shards, one batch per shard."""
+        batches = [[] for _ in range(self.shards)]
+        for update in updates:
+            batches[shard_of(update_chat_id(update), self.shards)].append(update)
+        for shard, batch in enumerate(batches):
+            if batch:
+                self.queues[shard].put(batch)
+
+    def stop(self):
+        """Lets the workers finish the queued updates and waits for them to exit."""
+        for updates in self.queues:
+            for _ in range(self.threads):
+                updates.put(None)
+        for process in self.processes:
+            process.join()
+
+
+def poll(router: ShardRouter):
+    """Fetches updates with long polling and routes them until interrupted."""
+    offset = None
+    while True:
+        try:
+            updates = telebot.apihelper.get_updates(
+                core.BOT_TOKEN,
+                offset=offset,
+                timeout=25,
+                # chat_member updates are not sent unless requested explicitly.
+                allowed_updates=telebot.util.update_types,
+                long_polling_timeout=20,
+            )
+        except (telebot.apihelper.ApiException, requests.RequestException) as e:
+            logger.error(f"Error fetching updates: {e}")
+            time.sleep(3)
+            continue
+        if updates:
+            router.route(updates)
+            offset = updates[-1]["update_id"] + 1
+
+
+# --- BOT START ---
+if __name__ == "__main__":
+    if not core.BOT_TOKEN:
+        logger.error(
+            "Error: Bot token not specified. Please edit telegram_bot.py and specify the BOT_TOKEN."
+        )
+    elif not core.ADMIN_ID:
+        logger.error(
+            "Error: Admin ID not specified. Please edit telegram_bot.py and specify the ADMIN_ID."
+        )
+    else:
+        logger.info("Initializing database...")
+        core.init_db()
+        core.close_connections()  # The front-end needs no connection of its own
+        logger.info("Database ready.")
+        core.bot.remove_webhook()
+        router = ShardRouter()
+        router.start()
+        logger.info(f"Started {router.shards} shards.")
+        try:
+            poll(router)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            router.stop()
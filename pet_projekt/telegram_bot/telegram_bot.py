@@ -1,8 +1,25 @@
 import telebot
 import sqlite3
 import random
+import bisect
+import contextlib
+import functools
+import hashlib
+import heapq
+import hmac
+import itertools
 import logging
+import os
+import queue
+import re
+import threading
 import time
+import urllib.parse
+import weakref
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 # --- BOT SETTINGS ---
 # Insert your token obtained from @BotFather.
@@ -12,6 +29,14 @@ ADMIN_ID = 0  # <<< INSERT YOUR TELEGRAM ID HERE
 
 # List of swear words to filter (can be extended)
 SWEAR_WORDS = ["дурак", "идиот", "олух"]  # Example
+# Optional file with one swear word per line, used instead of SWEAR_WORDS.
+# It is reloaded automatically when it changes.
+SWEAR_WORDS_FILE = None
+SWEAR_WORDS_RELOAD_INTERVAL = 30  # in seconds
+# Match whole words only ("олух" will not match "олухи").
+SWEAR_WORDS_WHOLE_WORDS = False
+# Treat look-alike characters as the same letter ("0лух" matches "олух").
+SWEAR_WORDS_NORMALIZE_CONFUSABLES = False
 
 # Warning settings
 WARNING_LIMIT = 3
@@ -19,276 +44,3039 @@ WARNING_LIMIT = 3
 # Captcha settings
 CAPTCHA_MIN_NUMBER = 1
 CAPTCHA_MAX_NUMBER = 10
+# The captcha is answered by pressing one of CAPTCHA_CHOICES buttons; after
+# CAPTCHA_MAX_ATTEMPTS wrong presses it is failed.
+CAPTCHA_CHOICES = 4
+CAPTCHA_MAX_ATTEMPTS = 2
+# Key signing the data of the captcha buttons; the bot token if empty.
+CAPTCHA_SECRET = ""
+# Users who don't solve the captcha in time, or fail it, are removed from the chat.
+CAPTCHA_TIMEOUT = 300  # in seconds
+CAPTCHA_KICK_ON_TIMEOUT = True
+# Keep pending captchas in the database so they survive a restart.
+CAPTCHA_PERSIST = True
+
+# Flood control settings, the defaults for chats that haven't set their own with /setflood.
+# A user who sends more than FLOOD_MESSAGES messages within FLOOD_SECONDS seconds is
+# muted for FLOOD_MUTE_TIME seconds.
+FLOOD_MESSAGES = 10
+FLOOD_SECONDS = 5
+FLOOD_MUTE_TIME = 300  # in seconds
+# The largest limits /setflood accepts. A tracked pair keeps as many message times
+# as its limit allows messages.
+FLOOD_MAX_MESSAGES = 100
+FLOOD_MAX_SECONDS = 3600
+# (chat, user) pairs whose recent message times are kept in memory.
+FLOOD_TRACKER_SIZE = 100000
+
+# Spam fingerprints: texts admins mark with /spam are remembered for SPAM_FINGERPRINT_TTL
+# seconds, and their copies are deleted in every chat. So are texts deleted for swear words
+# once the same text was deleted in SPAM_SUSPECT_SOURCES chats, or from as many senders.
+SPAM_FINGERPRINT_TTL = 3600  # in seconds
+SPAM_FINGERPRINT_BUCKET = 60  # in seconds, the granularity of the expiry
+SPAM_FINGERPRINT_SIZE = 10000  # fingerprints kept at most
+# Near copies share at least SPAM_SIMILARITY of their 4-character shingles (Jaccard),
+# as estimated by MinHash signatures compared a band at a time.
+SPAM_SHINGLE_SIZE = 4
+SPAM_SIMILARITY = 0.5
+SPAM_MINHASH_SLOTS = 64
+SPAM_MINHASH_BANDS = 16
+# Shorter texts ("hi", "ok") are too common to be fingerprinted.
+SPAM_MIN_LENGTH = 20
+SPAM_SUSPECT_SOURCES = 2
+
+# Raid settings
+# A chat is under a raid when at least RAID_JOIN_THRESHOLD users join within
+# RAID_WINDOW seconds; raid mode ends RAID_COOLDOWN seconds after the last such burst.
+RAID_JOIN_THRESHOLD = 10
+RAID_WINDOW = 60  # in seconds
+RAID_COOLDOWN = 300  # in seconds
+# During a raid, joiners are greeted together with one captcha message per interval.
+RAID_CAPTCHA_INTERVAL = 5  # in seconds
+RAID_WELCOME_MESSAGE = (
+    "Welcome, {user_names}!\nTo be able to write in the chat, please solve the equation: "
+    "{num1} + {num2} = ?"
+)
+# Until they solve the captcha, raid joiners may not send anything.
+RAID_RESTRICT_ON_JOIN = True
+
+# Update delivery: "polling" or "webhook"
+RUN_MODE = "polling"
+# Public HTTPS URL Telegram posts updates to, e.g. "https://bot.example.com/telegram".
+# A reverse proxy is expected to forward it to WEBHOOK_HOST:WEBHOOK_PORT/WEBHOOK_PATH.
+WEBHOOK_URL = ""
+WEBHOOK_HOST = "127.0.0.1"
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "/telegram"
+# Random string Telegram sends back in every request, so forged updates are rejected.
+WEBHOOK_SECRET_TOKEN = ""
+# Updates waiting for a worker; when full, Telegram is asked to retry later.
+WEBHOOK_QUEUE_SIZE = 1000
+WEBHOOK_WORKERS = 8
+# Larger request bodies are rejected unread; updates are far smaller.
+WEBHOOK_MAX_BODY_SIZE = 1024 * 1024  # in bytes
+
+# Outbound request settings, matching Telegram's published limits
+API_GLOBAL_RATE = 30  # requests per second over all chats
+API_GROUP_CHAT_RATE = 20 / 60  # messages per second to one group
+API_PRIVATE_CHAT_RATE = 1  # messages per second to one user
+API_CHAT_BURST = 3  # messages a chat may receive at once before the rate applies
+API_WORKERS = 8  # requests in flight at the same time
+API_MAX_RETRIES = 3  # retries of a request that got "429 Too Many Requests"
+# Requests waiting to be sent; beyond this only moderation actions are accepted.
+API_QUEUE_LIMIT = 10000
+
+# Messages to delete in a chat are collected for up to DELETE_BATCH_WINDOW seconds
+# and deleted with one request; Telegram accepts up to 100 messages per request.
+DELETE_BATCH_WINDOW = 0.5
+DELETE_BATCH_SIZE = 100
+
+# Admin notifications (warning limits reached, reports) are merged per (chat, user) and
+# sent every NOTIFY_DIGEST_INTERVAL seconds as one digest per recipient: the chat's log
+# channel if it has one, otherwise each of its admins, and ADMIN_ID as a last resort.
+NOTIFY_DIGEST_INTERVAL = 60  # in seconds
+NOTIFY_DIGEST_MAX_USERS = 20  # users listed per chat in a digest, the rest are counted
+# Admins the bot can't write to (they never started it) are skipped for this long.
+NOTIFY_UNREACHABLE_TTL = 3600  # in seconds
+
+# Log channel settings
+# Records are sent to log channels in batches, at most once per interval.
+LOG_FLUSH_INTERVAL = 5  # in seconds
+# Records waiting to be sent per channel; further records are dropped until the next batch.
+LOG_QUEUE_SIZE = 1000
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Metrics settings
+# Metrics are served in the Prometheus text format at http://METRICS_HOST:METRICS_PORT/metrics.
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9464  # 0 disables the endpoint
+# Seconds between summaries of the metrics sent to the log channels; 0 disables them.
+METRICS_LOG_INTERVAL = 0
+
+# Database settings
+DB_NAME = "users.db"
+# The oldest SQLite the queries work with (RETURNING came with 3.35).
+MIN_SQLITE_VERSION = (3, 35)
+# Seconds a connection waits for a lock held by another thread before failing.
+DB_TIMEOUT = 5.0
+# Number of prepared statements kept per connection.
+DB_STATEMENT_CACHE_SIZE = 128
+# Applied to every connection when it is opened.
+DB_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "temp_store": "MEMORY",
+    "cache_size": -8000,  # in KiB
+    "mmap_size": 64 * 1024 * 1024,
+}
+# Schema migrations rewrite large tables in batches of this many rows, one
+# transaction each, pausing in between so that the bot's own writes get through.
+MIGRATION_BATCH_SIZE = 1000
+MIGRATION_BATCH_PAUSE = 0.05  # in seconds
+# Warnings and profile updates are written behind: collected in memory and written
+# in one transaction every WRITE_BEHIND_INTERVAL seconds, or sooner once
+# WRITE_BEHIND_MAX_OPS changes are waiting. That much is lost if the process dies.
+WRITE_BEHIND_INTERVAL = 0.2  # in seconds
+WRITE_BEHIND_MAX_OPS = 500
+
+# Cache settings
+# Chat settings change only through admin commands, so they can stay cached for long.
+CHAT_SETTINGS_CACHE_SIZE = 10000
+CHAT_SETTINGS_CACHE_TTL = 3600  # in seconds
+# Admin rosters are also refreshed from chat_member updates, the TTL is a safety net.
+ADMIN_CACHE_SIZE = 10000
+ADMIN_CACHE_TTL = 600  # in seconds
+# Domain lists are cached per chat, and the verdicts for hostnames seen recently too.
+DOMAIN_LISTS_CACHE_SIZE = 1000
+HOST_CACHE_SIZE = 100000
+# Chats whose administrators could not be fetched are retried after this delay.
+ADMIN_CACHE_NEGATIVE_TTL = 60  # in seconds
+# Chat member state is written through on every change, so the TTL only bounds staleness
+# from changes made to the database by hand.
+USER_CACHE_SIZE = 100000
+USER_CACHE_TTL = 3600  # in seconds
 
 # --- INITIALIZATION ---
-bot = telebot.TeleBot(BOT_TOKEN)
-DB_NAME = "users.db"
+# The token is checked in the __main__ block, so the module can be imported without one.
+bot = telebot.TeleBot(BOT_TOKEN, validate_token=False)
+
+
+def batch_lines(lines):
+    """Joins lines into texts no longer than a Telegram message."""
+    batch = ""
+    for line in lines:
+        line = line[:TELEGRAM_MESSAGE_LIMIT]
+        if batch and len(batch) + 1 + len(line) > TELEGRAM_MESSAGE_LIMIT:
+            yield batch
+            batch = ""
+        batch = f"{batch}\n{line}" if batch else line
+    if batch:
+        yield batch
 
 
 # Logger setup
 class TelegramLogHandler(logging.Handler):
-    def __init__(self, bot, chat_id):
+    """Sends log records to a chat in batches from a background thread.
+
+    emit() only puts the record in a bounded queue, so logging never waits for
+    Telegram. Every flush_interval seconds the queued records are joined into as
+    few messages as fit the message size limit, with repeated records collapsed
+    into one line. Records that don't fit in the queue are dropped and counted.
+    """
+
+    def __init__(self, bot, chat_id, flush_interval: float = None, queue_size: int = None):
         super().__init__()
         self.bot = bot
         self.chat_id = chat_id
+        self.flush_interval = flush_interval or LOG_FLUSH_INTERVAL
+        self.records = queue.Queue(maxsize=queue_size or LOG_QUEUE_SIZE)
+        self.dropped = 0
+        self._flush_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name=f"TelegramLog{chat_id}", daemon=True
+        )
+        self._thread.start()
 
     def emit(self, record):
-        log_entry = self.format(record)
         try:
-            self.bot.send_message(self.chat_id, log_entry)
-        except telebot.apihelper.ApiTelegramException:
-            pass
+            self.records.put_nowait(self.format(record))
+        except queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """Sends everything queued so far."""
+        with self._flush_lock:
+            counts = {}  # Keeps the order in which records first appeared
+            while True:
+                try:
+                    entry = self.records.get_nowait()
+                except queue.Empty:
+                    break
+                counts[entry] = counts.get(entry, 0) + 1
+            lines = [entry if n == 1 else f"{entry} (x{n})" for entry, n in counts.items()]
+            dropped, self.dropped = self.dropped, 0
+            if dropped:
+                lines.append(f"{dropped} log records were dropped.")
+            for text in batch_lines(lines):
+                self._send(text)
+
+    def _send(self, text: str):
+        for _ in range(2):
+            try:
+                with metrics.timer("bot_api_request_seconds", method="send_message"):
+                    self.bot.send_message(self.chat_id, text)
+                return
+            except telebot.apihelper.ApiTelegramException as e:
+                if e.error_code != 429:
+                    return
+                # Flood limit: wait as long as Telegram asks, then retry once.
+                time.sleep(e.result_json.get("parameters", {}).get("retry_after", 1))
+            except Exception:
+                return  # Network errors can't be logged to the log that failed
+
+    def close(self):
+        self._stopped.set()
+        self._thread.join()
+        self.flush()
+        super().close()
 
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-# Dictionary to store captchas for new users {user_id: correct_answer}
-pending_captchas = {}
+# {channel_id: handler}; each log channel gets one handler however many chats use it.
+log_channel_handlers = {}
+_log_channel_handlers_lock = threading.Lock()
+
+
+def add_log_channel(channel_id: int):
+    """Starts sending the log to a channel unless it is already receiving it."""
+    with _log_channel_handlers_lock:
+        if channel_id not in log_channel_handlers:
+            handler = TelegramLogHandler(bot, channel_id)
+            log_channel_handlers[channel_id] = handler
+            logger.addHandler(handler)
+
+
+# --- CACHING ---
+
+
+class LRUCache:
+    """Thread-safe mapping bounded by size and entry age, with hit/miss counters."""
+
+    def __init__(self, maxsize: int, ttl: float = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Returns a cached value, or default if it is missing or expired."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl: float = None):
+        """Stores a value, evicting the least recently used entry when full."""
+        ttl = ttl or self.ttl
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def update(self, key, **fields):
+        """Replaces a cached dict with a copy that has fields changed; no-op if not cached."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                self._data[key] = (expires_at, {**value, **fields})
+
+    def delete(self, key):
+        """Removes a value if it is cached."""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Removes all values and resets the counters."""
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        """Returns the size and hit/miss counters of the cache."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+# {chat_id: settings dict}; missing chats are cached as {} as well.
+chat_settings_cache = LRUCache(CHAT_SETTINGS_CACHE_SIZE, CHAT_SETTINGS_CACHE_TTL)
+# {chat_id: frozenset of administrator user ids}
+admin_cache = LRUCache(ADMIN_CACHE_SIZE, ADMIN_CACHE_TTL)
+# {user_id: True} for the bots seen among chat administrators; bots can't message each other.
+admin_bots = LRUCache(ADMIN_CACHE_SIZE)
+# {chat_id: DomainTrie of the chat's allowed and blocked domains}; empty for chats without lists.
+domain_lists_cache = LRUCache(DOMAIN_LISTS_CACHE_SIZE, CHAT_SETTINGS_CACHE_TTL)
+# {(chat_id, hostname): (DomainTrie, verdict)}; stale once the chat's trie is replaced.
+host_cache = LRUCache(HOST_CACHE_SIZE, CHAT_SETTINGS_CACHE_TTL)
+# {(chat_id, user_id): {"user_id", "warnings", "is_verified", "muted", "banned"}}
+user_cache = LRUCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+# --- METRICS ---
+
+# Upper bounds of the histogram buckets, in seconds.
+HISTOGRAM_BUCKETS = (
+    0.00001, 0.00002, 0.00005, 0.0001, 0.0002, 0.0005,
+    0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0,
+)
+
+
+class Histogram:
+    """Thread-safe distribution of durations over fixed buckets."""
+
+    def __init__(self, buckets: tuple = HISTOGRAM_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last one counts values above all bounds
+        self.count = 0
+        self.total = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        """Adds one measurement."""
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += value
+
+    def quantile(self, q: float) -> float:
+        """Returns the upper bound of the bucket holding the q-quantile (0 if empty)."""
+        with self._lock:
+            rank = q * self.count
+            seen = 0
+            for index, count in enumerate(self.counts):
+                seen += count
+                if count and seen >= rank:
+                    return self.buckets[index] if index < len(self.buckets) else float("inf")
+        return 0.0
+
+    def stats(self) -> dict:
+        """Returns the count, mean, median and 99th percentile of the measurements."""
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+        }
+
+    def snapshot(self) -> tuple:
+        """Returns the bucket counts, the number and the sum of the measurements."""
+        with self._lock:
+            return list(self.counts), self.count, self.total
+
+
+def _format_labels(labels, extra=()) -> str:
+    """Formats (key, value) pairs as the label set of a Prometheus sample."""
+    pairs = [*labels, *extra]
+    if not pairs:
+        return ""
+    escaped = (
+        (key, str(value).replace("\\", "\\\\").replace('"', '\\"')) for key, value in pairs
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+class MetricsRegistry:
+    """Named counters, histograms and gauges, each optionally split by labels."""
+
+    def __init__(self):
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> Histogram
+        self._gauges = {}  # (name, labels) -> function returning the current value
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, amount: int = 1, **labels):
+        """Adds to a counter."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def histogram(self, name: str, **labels) -> Histogram:
+        """Returns a histogram, creating it on first use."""
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram())
+        return histogram
+
+    def gauge(self, name: str, func, **labels):
+        """Registers a function that returns the current value of a gauge."""
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = func
+
+    def timed(self, name: str, label: str):
+        """Returns a decorator recording the duration of every call in a histogram.
+
+        The histogram is labelled with the name of the decorated function.
+        """
+
+        def decorator(func):
+            histogram = self.histogram(name, **{label: func.__name__})
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - started)
+
+            return wrapper
+
+        return decorator
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels):
+        """Records the duration of a with block in a histogram."""
+        histogram = self.histogram(name, **labels)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            histogram.observe(time.perf_counter() - started)
+
+    def render(self) -> str:
+        """Returns all metrics in the Prometheus text exposition format."""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items(), key=lambda item: item[0])
+            gauges = sorted(self._gauges.items(), key=lambda item: item[0])
+        lines = []
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in counters:
+            declare(name, "counter")
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+        for (name, labels), func in gauges:
+            try:
+                value = func()
+            except Exception as e:
+                logger.error(f"Error reading gauge {name}: {e}")
+                continue
+            declare(name, "gauge")
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+        for (name, labels), histogram in histograms:
+            declare(name, "histogram")
+            counts, count, total = histogram.snapshot()
+            cumulative = 0
+            for bound, bucket_count in zip(histogram.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self, top: int = 10) -> str:
+        """Returns the counters and the histograms that took the most time, as short text."""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = list(self._histograms.items())
+        lines = ["Metrics:"]
+        for (name, labels), value in counters:
+            lines.append(f"{name}{_format_labels(labels)}: {value}")
+        histograms.sort(key=lambda item: item[1].total, reverse=True)
+        for (name, labels), histogram in histograms[:top]:
+            stats = histogram.stats()
+            if not stats["count"]:
+                break
+            lines.append(
+                f"{name}{_format_labels(labels)}: {stats['count']} calls, "
+                f"{histogram.total:.2f}s total, p50 <= {stats['p50'] * 1000:g} ms, "
+                f"p99 <= {stats['p99'] * 1000:g} ms"
+            )
+        return "\n".join(lines)
+
+
+metrics = MetricsRegistry()
+# Decorators timing the database helpers and the update handlers.
+timed_db = metrics.timed("bot_db_seconds", "helper")
+timed_handler = metrics.timed("bot_handler_seconds", "handler")
+
+
+# --- SWEAR WORD MATCHING ---
+
+# Invisible characters used to split words apart without changing how they look.
+_INVISIBLE_CHARS = dict.fromkeys(map(ord, "\u00ad\u200b\u200c\u200d\u2060\ufeff"))
+# Digits, symbols and Latin letters that look like Cyrillic ones.
+_CONFUSABLE_CHARS = str.maketrans(
+    {
+        "0": "о", "3": "з", "4": "ч", "6": "б", "@": "а",
+        "a": "а", "b": "в", "c": "с", "e": "е", "h": "н", "k": "к",
+        "m": "м", "o": "о", "p": "р", "t": "т", "x": "х", "y": "у",
+    }
+)
+
+
+def normalize_text(text: str) -> str:
+    """Brings text to the form swear words are matched in."""
+    text = text.casefold().translate(_INVISIBLE_CHARS)
+    if SWEAR_WORDS_NORMALIZE_CONFUSABLES:
+        text = text.translate(_CONFUSABLE_CHARS)
+    return text
+
+
+class SwearWordMatcher:
+    """Finds any of a list of words in a text with a single regex pass.
+
+    The words are merged into a trie and compiled as one pattern, so the cost of
+    a search depends on the length of the text, not on the number of words.
+    """
+
+    def __init__(self, words):
+        self.words = sorted({normalize_text(w.strip()) for w in words if w.strip()})
+        pattern = self._trie_pattern(self.words)
+        if pattern and SWEAR_WORDS_WHOLE_WORDS:
+            pattern = rf"(?<!\w)(?:{pattern})(?!\w)"
+        self.regex = re.compile(pattern) if pattern else None
+
+    @staticmethod
+    def _trie_pattern(words) -> str:
+        """Builds a regex that matches the same strings as the alternation of words."""
+        trie = {}
+        for word in words:
+            node = trie
+            for char in word:
+                node = node.setdefault(char, {})
+            node[""] = {}
+
+        def build(node) -> str:
+            branches = [re.escape(char) + build(child) for char, child in node.items() if char]
+            if not branches:
+                return ""
+            pattern = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+            if "" in node:
+                pattern = "(?:" + pattern + ")?"
+            return pattern
+
+        return build(trie)
+
+    def search(self, text: str):
+        """Returns the first swear word found in the text, or None."""
+        if self.regex is None or not text:
+            return None
+        match = self.regex.search(normalize_text(text))
+        return match.group() if match else None
+
+
+_swear_word_matcher = None
+_swear_words_file_mtime = None
+_swear_words_checked_at = 0.0
+_swear_words_lock = threading.Lock()
+
+
+def load_swear_words(words=None):
+    """Rebuilds the swear word matcher from words, SWEAR_WORDS_FILE or SWEAR_WORDS."""
+    global _swear_word_matcher, _swear_words_file_mtime
+    if words is None and SWEAR_WORDS_FILE:
+        try:
+            with open(SWEAR_WORDS_FILE, encoding="utf-8") as f:
+                _swear_words_file_mtime = os.fstat(f.fileno()).st_mtime
+                words = f.read().splitlines()
+        except OSError as e:
+            logger.error(f"Error reading swear words file: {e}")
+    if words is None:
+        words = SWEAR_WORDS
+    _swear_word_matcher = SwearWordMatcher(words)
+    logger.info(f"Loaded {len(_swear_word_matcher.words)} swear words.")
+
+
+def get_swear_word_matcher() -> SwearWordMatcher:
+    """Returns the current matcher, reloading SWEAR_WORDS_FILE if it has changed."""
+    global _swear_words_checked_at
+    now = time.monotonic()
+    if _swear_word_matcher is None or (
+        SWEAR_WORDS_FILE and now - _swear_words_checked_at >= SWEAR_WORDS_RELOAD_INTERVAL
+    ):
+        with _swear_words_lock:
+            if _swear_word_matcher is None:
+                load_swear_words()
+            elif now - _swear_words_checked_at >= SWEAR_WORDS_RELOAD_INTERVAL:
+                try:
+                    changed = os.stat(SWEAR_WORDS_FILE).st_mtime != _swear_words_file_mtime
+                except OSError:
+                    changed = False
+                if changed:
+                    load_swear_words()
+            _swear_words_checked_at = now
+    return _swear_word_matcher
+
 
 # --- DATABASE HANDLING ---
 
+# Every thread (polling workers, timers) keeps one long-lived connection, closed
+# when the thread ends. close_connections() bumps the generation so that stale
+# connections get reopened.
+_db_local = threading.local()
+_db_connections = set()
+_db_connections_lock = threading.RLock()  # Finalizers may run while it is held
+_db_generation = 0
 
-def init_db():
-    """Initializes the database and creates the tables if they don't exist."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute(
+
+class _ThreadConnection:
+    """Holds a thread's connection in _db_local and closes it once the thread is gone."""
+
+    __slots__ = ("conn", "generation", "__weakref__")
+
+    def __init__(self, conn: sqlite3.Connection, generation: int):
+        self.conn = conn
+        self.generation = generation
+        # Thread-local data is dropped when its thread ends, which runs the finalizer.
+        weakref.finalize(self, _close_connection, conn)
+
+
+def _close_connection(conn: sqlite3.Connection):
+    with _db_connections_lock:
+        _db_connections.discard(conn)
+    conn.close()
+
+
+def get_connection() -> sqlite3.Connection:
+    """Returns the database connection of the calling thread, opening it if needed."""
+    holder = getattr(_db_local, "holder", None)
+    if holder is not None and holder.generation == _db_generation:
+        return holder.conn
+    conn = sqlite3.connect(
+        DB_NAME,
+        timeout=DB_TIMEOUT,
+        cached_statements=DB_STATEMENT_CACHE_SIZE,
+        check_same_thread=False,
+    )
+    conn.row_factory = sqlite3.Row
+    for pragma, value in DB_PRAGMAS.items():
+        conn.execute(f"PRAGMA {pragma} = {value}")
+    with _db_connections_lock:
+        _db_connections.add(conn)
+    _db_local.holder = _ThreadConnection(conn, _db_generation)
+    return conn
+
+
+def close_connections():
+    """Closes the connections of all threads."""
+    global _db_generation
+    with _db_connections_lock:
+        _db_generation += 1
+        for conn in _db_connections:
+            conn.close()
+        _db_connections.clear()
+
+
+# --- SCHEMA MIGRATIONS ---
+
+# (version, name, function) of every schema change, in version order.
+MIGRATIONS = []
+
+
+def migration(version: int, name: str):
+    """Registers a function as the schema migration to the given version."""
+
+    def register(func):
+        if MIGRATIONS and MIGRATIONS[-1][0] >= version:
+            raise ValueError(f"Migration {version} is out of order")
+        MIGRATIONS.append((version, name, func))
+        return func
+
+    return register
+
+
+class Migrator:
+    """Applies the pending schema migrations, each in its own transaction.
+
+    A dry run applies them all in one transaction that is rolled back at the
+    end, which reports what would be done and how long it takes.
+    """
+
+    def __init__(self, conn: sqlite3.Connection, dry_run: bool = False,
+                 batch_size: int = MIGRATION_BATCH_SIZE, batch_pause: float = MIGRATION_BATCH_PAUSE):
+        self.conn = conn
+        self.dry_run = dry_run
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.rows = 0
+
+    def execute(self, sql: str, params=()) -> sqlite3.Cursor:
+        """Runs a statement of the current migration."""
+        cursor = self.conn.execute(sql, params)
+        if cursor.rowcount > 0:
+            self.rows += cursor.rowcount
+        return cursor
+
+    def backfill(self, sql: str, params: dict = None) -> int:
+        """Runs a batched statement until it changes no more rows and returns the total.
+
+        The statement gets the batch size as :batch_size and must only touch rows it
+        has not changed yet, so that an interrupted backfill resumes where it stopped.
+        Every batch but the last is committed on its own.
+        """
+        params = dict(params or {}, batch_size=self.batch_size)
+        total = 0
+        while True:
+            changed = self.execute(sql, params).rowcount
+            total += changed
+            if changed < self.batch_size:
+                return total
+            if not self.dry_run:
+                self.conn.commit()
+                time.sleep(self.batch_pause)
+                self.conn.execute("BEGIN IMMEDIATE")
+
+    def applied_versions(self) -> set:
+        """Returns the versions recorded in schema_version."""
+        return {row[0] for row in self.conn.execute("SELECT version FROM schema_version")}
+
+    def run(self) -> list:
+        """Applies the pending migrations and returns a report of what was done.
+
+        Every entry of the report is a dict with the keys version, name, rows and seconds.
+        """
+        if self.dry_run:
+            self.conn.execute("BEGIN IMMEDIATE")
+        self.conn.execute(
             """
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                is_bot BOOLEAN,
-                first_name TEXT,
-                last_name TEXT,
-                username TEXT,
-                language_code TEXT,
-                join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                warnings INTEGER DEFAULT 0,
-                is_verified BOOLEAN DEFAULT 0,
-                muted INTEGER DEFAULT 0,
-                banned INTEGER DEFAULT 0
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                name TEXT,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                seconds REAL
             )
         """
         )
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS chat_settings (
-                chat_id INTEGER PRIMARY KEY,
-                welcome_message TEXT,
-                rules TEXT,
-                delete_links BOOLEAN DEFAULT 0,
-                delete_forwards BOOLEAN DEFAULT 0,
-                delete_files BOOLEAN DEFAULT 0,
-                log_channel INTEGER
-            )
+        report = []
+        try:
+            for version, name, func in MIGRATIONS:
+                if not self.dry_run:
+                    self.conn.execute("BEGIN IMMEDIATE")
+                # Checked within the transaction: another process may have migrated already.
+                if version in self.applied_versions():
+                    if not self.dry_run:
+                        self.conn.rollback()
+                    continue
+                started = time.perf_counter()
+                self.rows = 0
+                func(self)
+                seconds = time.perf_counter() - started
+                self.conn.execute(
+                    "INSERT INTO schema_version (version, name, seconds) VALUES (?, ?, ?)",
+                    (version, name, seconds),
+                )
+                if not self.dry_run:
+                    self.conn.commit()
+                report.append({"version": version, "name": name, "rows": self.rows, "seconds": seconds})
+        except BaseException:
+            self.conn.rollback()
+            raise
+        if self.dry_run:
+            self.conn.rollback()
+        return report
+
+
+def format_migration_report(report: list, dry_run: bool = False) -> str:
+    """Formats the report of Migrator.run as text, one line per migration."""
+    if not report:
+        return "Database schema is up to date."
+    lines = ["Migrations that would be applied:" if dry_run else "Applied migrations:"]
+    for entry in report:
+        lines.append(
+            f"  {entry['version']:>4}  {entry['name']}: "
+            f"{entry['rows']} rows, {entry['seconds'] * 1000:.1f} ms"
+        )
+    return "\n".join(lines)
+
+
+@migration(1, "create users, chat_settings and captchas")
+def _create_base_tables(migrator: Migrator):
+    migrator.execute(
         """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            is_bot BOOLEAN,
+            first_name TEXT,
+            last_name TEXT,
+            username TEXT,
+            language_code TEXT,
+            join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            warnings INTEGER DEFAULT 0,
+            is_verified BOOLEAN DEFAULT 0,
+            muted INTEGER DEFAULT 0,
+            banned INTEGER DEFAULT 0
         )
-        conn.commit()
+    """
+    )
+    migrator.execute(
+        """
+        CREATE TABLE IF NOT EXISTS chat_settings (
+            chat_id INTEGER PRIMARY KEY,
+            welcome_message TEXT,
+            rules TEXT,
+            delete_links BOOLEAN DEFAULT 0,
+            delete_forwards BOOLEAN DEFAULT 0,
+            delete_files BOOLEAN DEFAULT 0,
+            log_channel INTEGER
+        )
+    """
+    )
+    migrator.execute(
+        """
+        CREATE TABLE IF NOT EXISTS captchas (
+            chat_id INTEGER,
+            user_id INTEGER,
+            answer INTEGER,
+            expires_at INTEGER,
+            PRIMARY KEY (chat_id, user_id)
+        ) WITHOUT ROWID
+    """
+    )
 
 
-def get_chat_settings(chat_id: int) -> dict:
-    """Gets the settings for a chat."""
-    with sqlite3.connect(DB_NAME) as conn:
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM chat_settings WHERE chat_id = ?", (chat_id,))
-        result = cursor.fetchone()
-        return dict(result) if result else {}
+@migration(2, "keep moderation state per chat")
+def _create_chat_members(migrator: Migrator):
+    # The warnings, is_verified, muted and banned columns of users are what older
+    # versions kept for all chats at once: they seed a user's state in a chat the
+    # first time the bot sees them there.
+    migrator.execute(
+        """
+        CREATE TABLE IF NOT EXISTS chat_members (
+            chat_id INTEGER,
+            user_id INTEGER,
+            join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            warnings INTEGER DEFAULT 0,
+            is_verified BOOLEAN DEFAULT 0,
+            muted INTEGER DEFAULT 0,
+            banned INTEGER DEFAULT 0,
+            PRIMARY KEY (chat_id, user_id)
+        ) WITHOUT ROWID
+    """
+    )
+    # Partial indexes only hold the few rows the lookups are after.
+    migrator.execute("CREATE INDEX IF NOT EXISTS chat_members_user ON chat_members (user_id)")
+    migrator.execute(
+        "CREATE INDEX IF NOT EXISTS chat_members_muted ON chat_members (muted) WHERE muted > 0"
+    )
+    migrator.execute(
+        "CREATE INDEX IF NOT EXISTS chat_members_banned ON chat_members (chat_id) WHERE banned"
+    )
+    migrator.execute(
+        "CREATE INDEX IF NOT EXISTS chat_members_unverified "
+        "ON chat_members (chat_id) WHERE NOT is_verified"
+    )
 
 
-def set_welcome_message_db(chat_id: int, message: str):
-    """Sets the welcome message for a chat."""
-    with sqlite3.connect(DB_NAME) as conn:
+@migration(3, "index log channels")
+def _index_log_channels(migrator: Migrator):
+    migrator.execute(
+        "CREATE INDEX IF NOT EXISTS chat_settings_log_channel "
+        "ON chat_settings (log_channel) WHERE log_channel IS NOT NULL"
+    )
+
+
+@migration(4, "clear expired mutes")
+def _clear_expired_mutes(migrator: Migrator):
+    # Keeps chat_members_muted down to the mutes that are still running.
+    migrator.backfill(
+        """
+        UPDATE chat_members SET muted = 0
+        WHERE (chat_id, user_id) IN (
+            SELECT chat_id, user_id FROM chat_members
+            WHERE muted > 0 AND muted <= :now LIMIT :batch_size
+        )
+    """,
+        {"now": int(time.time())},
+    )
+
+
+@migration(5, "add flood limits to chat_settings")
+def _add_flood_limits(migrator: Migrator):
+    # NULL means the defaults of the bot settings.
+    for column in ("flood_messages", "flood_seconds", "flood_mute_time"):
+        migrator.execute(f"ALTER TABLE chat_settings ADD COLUMN {column} INTEGER")
+
+
+@migration(6, "create chat_domains")
+def _create_chat_domains(migrator: Migrator):
+    migrator.execute(
+        """
+        CREATE TABLE IF NOT EXISTS chat_domains (
+            chat_id INTEGER NOT NULL,
+            domain TEXT NOT NULL,
+            allowed INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, domain)
+        ) WITHOUT ROWID
+    """
+    )
+
+
+@migration(7, "drop unused chat_members indexes")
+def _drop_unused_member_indexes(migrator: Migrator):
+    # No query reads them, and chat_members_unverified held nearly every new row.
+    # get_mutes_db still uses chat_members_muted.
+    for index in ("chat_members_user", "chat_members_banned", "chat_members_unverified"):
+        migrator.execute(f"DROP INDEX IF EXISTS {index}")
+
+
+@timed_db
+def init_db(dry_run: bool = False) -> list:
+    """Creates the database or brings its schema up to date and returns the migration report."""
+    if sqlite3.sqlite_version_info < MIN_SQLITE_VERSION:
+        # _MEMBER_STATE_SQL reads the state it creates back with RETURNING.
+        raise RuntimeError(
+            f"SQLite {sqlite3.sqlite_version} is too old, version "
+            f"{'.'.join(map(str, MIN_SQLITE_VERSION))} or newer is needed"
+        )
+    conn = get_connection()
+    report = Migrator(conn, dry_run=dry_run).run()
+    if report:
+        logger.info(format_migration_report(report, dry_run))
+    return report
+
+
+@timed_db
+def get_chat_settings(chat_id: int) -> dict:
+    """Gets the settings for a chat. The returned dict must not be modified."""
+    settings = chat_settings_cache.get(chat_id)
+    if settings is None:
+        with get_connection() as conn:
+            settings = _load_chat_settings(conn.cursor(), chat_id)
+    return settings
+
+
+def _load_chat_settings(cursor: sqlite3.Cursor, chat_id: int) -> dict:
+    """Reads the settings of a chat from the database and caches them."""
+    cursor.execute("SELECT * FROM chat_settings WHERE chat_id = ?", (chat_id,))
+    result = cursor.fetchone()
+    settings = dict(result) if result else {}
+    chat_settings_cache.set(chat_id, settings)
+    return settings
+
+
+def _set_chat_settings(chat_id: int, **fields):
+    """Stores settings of a chat, keeping the others, and caches the result."""
+    columns = ", ".join(fields)
+    updates = ", ".join(f"{column} = excluded.{column}" for column in fields)
+    with get_connection() as conn:
         cursor = conn.cursor()
         cursor.execute(
-            "INSERT OR REPLACE INTO chat_settings (chat_id, welcome_message) VALUES (?, ?)",
-            (chat_id, message),
+            f"INSERT INTO chat_settings (chat_id, {columns}) VALUES (?{', ?' * len(fields)}) "
+            f"ON CONFLICT (chat_id) DO UPDATE SET {updates}",
+            (chat_id, *fields.values()),
         )
         conn.commit()
+        _load_chat_settings(cursor, chat_id)
 
 
+@timed_db
+def set_welcome_message_db(chat_id: int, message: str):
+    """Sets the welcome message for a chat."""
+    _set_chat_settings(chat_id, welcome_message=message)
+
+
+@timed_db
 def set_rules_db(chat_id: int, rules: str):
     """Sets the rules for a chat."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE chat_settings SET rules = ? WHERE chat_id = ?", (rules, chat_id)
-        )
-        conn.commit()
+    _set_chat_settings(chat_id, rules=rules)
 
 
+@timed_db
 def set_delete_links_db(chat_id: int, delete_links: bool):
     """Sets the delete links setting for a chat."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE chat_settings SET delete_links = ? WHERE chat_id = ?",
-            (delete_links, chat_id),
-        )
-        conn.commit()
+    _set_chat_settings(chat_id, delete_links=delete_links)
 
 
+@timed_db
 def set_delete_forwards_db(chat_id: int, delete_forwards: bool):
     """Sets the delete forwards setting for a chat."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE chat_settings SET delete_forwards = ? WHERE chat_id = ?",
-            (delete_forwards, chat_id),
-        )
-        conn.commit()
+    _set_chat_settings(chat_id, delete_forwards=delete_forwards)
 
 
+@timed_db
 def set_delete_files_db(chat_id: int, delete_files: bool):
     """Sets the delete files setting for a chat."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE chat_settings SET delete_files = ? WHERE chat_id = ?",
-            (delete_files, chat_id),
-        )
-        conn.commit()
+    _set_chat_settings(chat_id, delete_files=delete_files)
 
 
+@timed_db
 def set_log_channel_db(chat_id: int, log_channel: int):
     """Sets the log channel for a chat."""
-    with sqlite3.connect(DB_NAME) as conn:
+    _set_chat_settings(chat_id, log_channel=log_channel)
+
+
+@timed_db
+def set_flood_limit_db(chat_id: int, messages: int, seconds: int, mute_time: int):
+    """Sets the flood limit of a chat; 0 messages turns flood control off."""
+    _set_chat_settings(
+        chat_id, flood_messages=messages, flood_seconds=seconds, flood_mute_time=mute_time
+    )
+
+
+@timed_db
+def get_domain_lists(chat_id: int) -> "DomainTrie":
+    """Returns the allowed (True) and blocked (False) domains of a chat as a DomainTrie."""
+    domains = domain_lists_cache.get(chat_id)
+    if domains is None:
+        with get_connection() as conn:
+            rows = conn.execute(
+                "SELECT domain, allowed FROM chat_domains WHERE chat_id = ?", (chat_id,)
+            ).fetchall()
+        domains = DomainTrie((domain, bool(allowed)) for domain, allowed in rows)
+        domain_lists_cache.set(chat_id, domains)
+    return domains
+
+
+@timed_db
+def list_domains_db(chat_id: int, domains: list, allowed: bool):
+    """Adds domains to the allowlist or the blocklist of a chat, moving them if listed."""
+    with get_connection() as conn:
+        conn.executemany(
+            "INSERT INTO chat_domains (chat_id, domain, allowed) VALUES (?, ?, ?) "
+            "ON CONFLICT (chat_id, domain) DO UPDATE SET allowed = excluded.allowed",
+            [(chat_id, domain, int(allowed)) for domain in domains],
+        )
+    domain_lists_cache.delete(chat_id)
+
+
+@timed_db
+def unlist_domains_db(chat_id: int, domains: list) -> int:
+    """Removes domains from the lists of a chat and returns how many were listed."""
+    with get_connection() as conn:
+        removed = conn.executemany(
+            "DELETE FROM chat_domains WHERE chat_id = ? AND domain = ?",
+            [(chat_id, domain) for domain in domains],
+        ).rowcount
+    domain_lists_cache.delete(chat_id)
+    return removed
+
+
+@timed_db
+def get_log_channels() -> list:
+    """Returns the log channels configured in any chat."""
+    with get_connection() as conn:
         cursor = conn.cursor()
         cursor.execute(
-            "UPDATE chat_settings SET log_channel = ? WHERE chat_id = ?",
-            (log_channel, chat_id),
+            "SELECT DISTINCT log_channel FROM chat_settings WHERE log_channel IS NOT NULL"
         )
-        conn.commit()
+        return [row[0] for row in cursor.fetchall()]
 
 
-def add_or_update_user(user: telebot.types.User):
-    """Adds a new user or updates an existing one."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM users WHERE user_id = ?", (user.id,))
-        if cursor.fetchone() is None:
-            cursor.execute(
-                """INSERT INTO users (user_id, is_bot, first_name, last_name, username, language_code)
-                   VALUES (?, ?, ?, ?, ?, ?)""",
-                (
-                    user.id,
-                    user.is_bot,
-                    user.first_name,
-                    user.last_name,
-                    user.username,
-                    user.language_code,
-                ),
+@timed_db
+def save_captcha_db(chat_id: int, user_id: int, answer: int, expires_at: int):
+    """Stores a pending captcha."""
+    with get_connection() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO captchas (chat_id, user_id, answer, expires_at) VALUES (?, ?, ?, ?)",
+            (chat_id, user_id, answer, expires_at),
+        )
+
+
+@timed_db
+def save_captchas_db(rows: list):
+    """Stores several pending captchas given as (chat_id, user_id, answer, expires_at)."""
+    with get_connection() as conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO captchas (chat_id, user_id, answer, expires_at) VALUES (?, ?, ?, ?)",
+            rows,
+        )
+
+
+@timed_db
+def delete_captcha_db(chat_id: int, user_id: int):
+    """Removes a pending captcha."""
+    with get_connection() as conn:
+        conn.execute(
+            "DELETE FROM captchas WHERE chat_id = ? AND user_id = ?", (chat_id, user_id)
+        )
+
+
+@timed_db
+def get_captchas_db() -> list:
+    """Returns all pending captchas as (chat_id, user_id, answer, expires_at) rows."""
+    with get_connection() as conn:
+        return conn.execute(
+            "SELECT chat_id, user_id, answer, expires_at FROM captchas"
+        ).fetchall()
+
+
+_UPSERT_USER_SQL = """
+    INSERT INTO users (user_id, is_bot, first_name, last_name, username, language_code)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (user_id) DO UPDATE SET
+        first_name = excluded.first_name,
+        last_name = excluded.last_name,
+        username = excluded.username
+"""
+
+
+def _user_params(user: telebot.types.User) -> tuple:
+    """Returns the parameters of _UPSERT_USER_SQL for a user."""
+    return (
+        user.id,
+        user.is_bot,
+        user.first_name,
+        user.last_name,
+        user.username,
+        user.language_code,
+    )
+
+
+_ADD_WARNINGS_SQL = """
+    INSERT INTO chat_members (chat_id, user_id, warnings) VALUES (?, ?, ?)
+    ON CONFLICT (chat_id, user_id) DO UPDATE SET warnings = warnings + excluded.warnings
+"""
+
+
+class WriteBehindBuffer:
+    """Collects user upserts and warning increments and writes them in batches.
+
+    Every batch is one transaction, written by a background thread at most
+    interval seconds after its first change, or as soon as max_ops changes are
+    waiting. The user cache stays authoritative for warning counts meanwhile:
+    increments are applied to it right away, and states read from the database
+    are corrected by the increments not written yet. flush() writes everything
+    at once and must be called on shutdown.
+    """
+
+    def __init__(self, interval: float = WRITE_BEHIND_INTERVAL, max_ops: int = WRITE_BEHIND_MAX_OPS):
+        self.interval = interval
+        self.max_ops = max_ops
+        self._users = {}  # user_id -> parameters of _UPSERT_USER_SQL
+        self._warnings = {}  # (chat_id, user_id) -> warnings not written yet
+        self._ops = 0
+        self._lock = threading.Lock()
+        # Held while a batch is written, so that readers see it either before or after.
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return self._ops
+
+    def add_users(self, users: list):
+        """Queues profile updates; the latest profile of a user wins."""
+        with self._lock:
+            for user in users:
+                self._users[user.id] = _user_params(user)
+            self._ops += len(users)
+        self._queued()
+
+    def add_warning(self, chat_id: int, user_id: int) -> int:
+        """Queues a warning and returns the user's new warning count in the chat."""
+        key = (chat_id, user_id)
+        with self._lock:
+            self._warnings[key] = self._warnings.get(key, 0) + 1
+            self._ops += 1
+            state = user_cache.get(key)
+            if state is not None:
+                warnings = state["warnings"] + 1
+                user_cache.update(key, warnings=warnings)
+        if state is None:
+            with self.consistent_read(), get_connection() as conn:
+                row = conn.execute(
+                    "SELECT warnings FROM chat_members WHERE chat_id = ? AND user_id = ?", key
+                ).fetchone()
+                warnings = (row[0] if row else 0) + self.pending_warnings(chat_id, user_id)
+        self._queued()
+        return warnings
+
+    def pending_warnings(self, chat_id: int, user_id: int) -> int:
+        """Returns the warnings of a user in a chat that are not written yet."""
+        with self._lock:
+            return self._warnings.get((chat_id, user_id), 0)
+
+    def cache_state(self, chat_id: int, user_id: int, state: dict):
+        """Corrects a state read from the database by the pending warnings and caches it.
+
+        Done under the lock add_warning takes, so that a warning queued meanwhile is
+        either counted here or applied to the cached state, never lost.
+        """
+        with self._lock:
+            state["warnings"] += self._warnings.get((chat_id, user_id), 0)
+            user_cache.set((chat_id, user_id), state)
+
+    def consistent_read(self):
+        """Returns a lock to hold while reading state that pending_warnings corrects."""
+        return self._flush_lock
+
+    def _queued(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._run, name="WriteBehind", daemon=True
+                    )
+                    self._thread.start()
+        if self._ops >= self.max_ops:
+            self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        """Writes every queued change in one transaction."""
+        with self._flush_lock:
+            with self._lock:
+                users, warnings = self._users, self._warnings
+                self._users, self._warnings, self._ops = {}, {}, 0
+            if not users and not warnings:
+                return
+            try:
+                with metrics.timer("bot_db_seconds", helper="write_behind_flush"):
+                    with get_connection() as conn:
+                        conn.executemany(_UPSERT_USER_SQL, users.values())
+                        conn.executemany(
+                            _ADD_WARNINGS_SQL,
+                            [(chat_id, user_id, n) for (chat_id, user_id), n in warnings.items()],
+                        )
+            except sqlite3.Error as e:
+                logger.error(f"Error writing {len(users) + len(warnings)} buffered changes: {e}")
+                with self._lock:  # Try again with the next batch
+                    for user_id, params in users.items():
+                        self._users.setdefault(user_id, params)
+                    for key, n in warnings.items():
+                        self._warnings[key] = self._warnings.get(key, 0) + n
+                    self._ops += len(users) + len(warnings)
+
+
+write_behind = WriteBehindBuffer()
+
+
+def add_or_update_users(users: list):
+    """Adds or updates several users, written behind in one transaction."""
+    write_behind.add_users(users)
+
+
+# Creates the state of a user in a chat from the user's legacy state, or returns it.
+# Legacy mutes are only carried over while they last.
+_MEMBER_STATE_SQL = """
+    INSERT INTO chat_members (chat_id, user_id, warnings, is_verified, muted, banned)
+    SELECT ?, user_id, warnings, is_verified,
+           CASE WHEN muted > CAST(strftime('%s', 'now') AS INTEGER) THEN muted ELSE 0 END,
+           banned
+    FROM users WHERE user_id = ?
+    ON CONFLICT (chat_id, user_id) DO UPDATE SET warnings = warnings
+    RETURNING user_id, warnings, is_verified, muted, banned
+"""
+
+
+@timed_db
+def get_user_state(chat_id: int, user: telebot.types.User) -> dict:
+    """Returns the moderation state of a user in a chat, adding the user if unknown.
+
+    The result has the keys user_id, warnings, is_verified, muted and banned and
+    must not be modified.
+    """
+    state = user_cache.get((chat_id, user.id))
+    if state is None:
+        with write_behind.consistent_read():
+            with get_connection() as conn:
+                conn.execute(_UPSERT_USER_SQL, _user_params(user))
+                row = conn.execute(_MEMBER_STATE_SQL, (chat_id, user.id)).fetchone()
+            state = dict(row)
+            write_behind.cache_state(chat_id, user.id, state)
+            if state["muted"] > time.time() and (chat_id, user.id) not in mute_scheduler:
+                # A legacy mute copied into the chat, which nothing has restricted the user for yet.
+                mute_scheduler.enforce(chat_id, user.id, state["muted"])
+    return state
+
+
+def _set_member_field(chat_id: int, user_id: int, field: str, value: int):
+    """Stores one moderation field of a user in a chat."""
+    with get_connection() as conn:
+        conn.execute(
+            f"INSERT INTO chat_members (chat_id, user_id, {field}) VALUES (?, ?, ?) "
+            f"ON CONFLICT (chat_id, user_id) DO UPDATE SET {field} = excluded.{field}",
+            (chat_id, user_id, value),
+        )
+    user_cache.update((chat_id, user_id), **{field: value})
+
+
+@timed_db
+def set_user_verified(chat_id: int, user_id: int):
+    """Marks a user as verified in a chat."""
+    _set_member_field(chat_id, user_id, "is_verified", 1)
+
+
+# Like _MEMBER_STATE_SQL, but the user is not verified whatever the legacy state says.
+_UNVERIFY_SQL = """
+    INSERT INTO chat_members (chat_id, user_id, warnings, is_verified, muted, banned)
+    SELECT ?, user_id, warnings, 0,
+           CASE WHEN muted > CAST(strftime('%s', 'now') AS INTEGER) THEN muted ELSE 0 END,
+           banned
+    FROM users WHERE user_id = ?
+    ON CONFLICT (chat_id, user_id) DO UPDATE SET is_verified = 0
+"""
+
+
+@timed_db
+def set_users_unverified(chat_id: int, user_ids: list):
+    """Marks users as not verified in a chat, e.g. when they are given a new captcha."""
+    with get_connection() as conn:
+        conn.executemany(_UNVERIFY_SQL, [(chat_id, user_id) for user_id in user_ids])
+    for user_id in user_ids:
+        user_cache.update((chat_id, user_id), is_verified=0)
+
+
+@timed_db
+def add_warning(chat_id: int, user_id: int) -> int:
+    """Adds a warning to a user in a chat and returns the new count, written behind."""
+    return write_behind.add_warning(chat_id, user_id)
+
+
+@timed_db
+def mute_user_db(chat_id: int, user_id: int, mute_time: int) -> int:
+    """Mutes a user in a chat for a specified amount of time and returns when it ends."""
+    muted = int(time.time()) + mute_time
+    _set_member_field(chat_id, user_id, "muted", muted)
+    return muted
+
+
+@timed_db
+def unmute_user_db(chat_id: int, user_id: int):
+    """Unmutes a user in a chat."""
+    _set_member_field(chat_id, user_id, "muted", 0)
+
+
+@timed_db
+def ban_user_db(chat_id: int, user_id: int):
+    """Bans a user from a chat."""
+    _set_member_field(chat_id, user_id, "banned", 1)
+
+
+@timed_db
+def unban_user_db(chat_id: int, user_id: int):
+    """Unbans a user from a chat."""
+    _set_member_field(chat_id, user_id, "banned", 0)
+
+
+@timed_db
+def get_mutes_db() -> list:
+    """Returns all mutes as (chat_id, user_id, muted) rows, muted being when they end."""
+    with get_connection() as conn:
+        return conn.execute(
+            "SELECT chat_id, user_id, muted FROM chat_members WHERE muted > 0"
+        ).fetchall()
+
+
+# --- OUTBOUND REQUESTS ---
+
+# Priorities of outbound requests, the lowest value is sent first.
+PRIORITY_MODERATION = 0  # Deletions, bans
+PRIORITY_WARNING = 1  # Warnings and admin notifications
+PRIORITY_REPLY = 2  # Command replies and captcha answers
+PRIORITY_WELCOME = 3  # Welcome messages and captchas
+
+
+class TokenBucket:
+    """Allows rate events per second on average, with bursts of up to capacity."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def delay(self, now: float) -> float:
+        """Returns how many seconds to wait before a token is available."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = max(self.blocked_until - now, 0.0)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def take(self):
+        """Uses up one token."""
+        self.tokens -= 1
+
+    def block(self, now: float, seconds: float):
+        """Stops handing out tokens for a while, e.g. after a flood-limit error."""
+        self.blocked_until = max(self.blocked_until, now + seconds)
+
+
+class ApiJob:
+    """An outbound request waiting in the ApiScheduler."""
+
+    __slots__ = ("priority", "func", "args", "kwargs", "limit_chat", "action",
+                 "future", "queued_at", "attempts")
+
+    def __init__(self, priority, func, args, kwargs, limit_chat, action):
+        self.priority = priority
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.limit_chat = limit_chat
+        self.action = action
+        self.future = Future()
+        self.queued_at = time.monotonic()
+        self.attempts = 0
+
+
+class ApiScheduler:
+    """Sends Telegram requests in priority order within the global and per-chat limits.
+
+    A dispatcher thread picks the most important request whose rate limits allow
+    it and hands it to a pool of workers. Requests that fail with 429 are put
+    back and retried after the retry_after Telegram asks for.
+    """
+
+    def __init__(self, global_rate: float = API_GLOBAL_RATE,
+                 group_chat_rate: float = API_GROUP_CHAT_RATE,
+                 private_chat_rate: float = API_PRIVATE_CHAT_RATE,
+                 chat_burst: float = API_CHAT_BURST, workers: int = API_WORKERS,
+                 queue_limit: int = API_QUEUE_LIMIT):
+        self.group_chat_rate = group_chat_rate
+        self.private_chat_rate = private_chat_rate
+        self.chat_burst = chat_burst
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets = {}
+        self._ready = []  # heap of (priority, seq, job)
+        self._delayed = []  # heap of (not_before, seq, job), waiting for a chat bucket or a retry
+        self._seq = itertools.count()
+        self._in_flight = 0
+        self._cond = threading.Condition()
+        self._running = False
+        self._dispatcher = None
+        self._executor = None
+        # Metrics
+        self.max_queued = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.dropped = 0
+        self.wait_total = {}  # priority -> seconds spent queued by sent requests
+        self.wait_count = {}
+        self.wait_max = 0.0
+
+    def submit(self, priority: int, func, *args, limit_chat: int = None, action: str = "",
+               **kwargs) -> Future:
+        """Queues func(*args, **kwargs) and returns a Future of its result.
+
+        limit_chat is the chat whose message rate the request counts against;
+        action describes the request in error messages ("sending warning").
+        """
+        job = ApiJob(priority, func, args, kwargs, limit_chat, action)
+        with self._cond:
+            queued = len(self._ready) + len(self._delayed)
+            if queued >= self.queue_limit and priority > PRIORITY_MODERATION:
+                self.dropped += 1
+                job.future.set_exception(RuntimeError("Outbound queue is full"))
+                return job.future
+            if not self._running:
+                self._start()
+            heapq.heappush(self._ready, (priority, next(self._seq), job))
+            self.max_queued = max(self.max_queued, queued + 1)
+            self._cond.notify_all()
+        return job.future
+
+    def _start(self):
+        self._running = True
+        self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="ApiWorker")
+        self._dispatcher = threading.Thread(
+            target=self._dispatch, name="ApiScheduler", daemon=True
+        )
+        self._dispatcher.start()
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= 10000:
+                # Full buckets hold no state worth keeping.
+                now = time.monotonic()
+                for key in [k for k, b in self._chat_buckets.items() if b.delay(now) == 0
+                            and b.tokens >= b.capacity]:
+                    del self._chat_buckets[key]
+            rate = self.private_chat_rate if chat_id > 0 else self.group_chat_rate
+            bucket = self._chat_buckets[chat_id] = TokenBucket(rate, self.chat_burst)
+        return bucket
+
+    def _dispatch(self):
+        with self._cond:
+            while self._running or self._ready or self._delayed or self._in_flight:
+                now = time.monotonic()
+                while self._delayed and self._delayed[0][0] <= now:
+                    _, seq, job = heapq.heappop(self._delayed)
+                    heapq.heappush(self._ready, (job.priority, seq, job))
+                if not self._ready:
+                    self._cond.wait(self._delayed[0][0] - now if self._delayed else None)
+                    continue
+                # A more important request may arrive while waiting for the global limit.
+                wait = self._global_bucket.delay(now)
+                if wait:
+                    self._cond.wait(wait)
+                    continue
+                _, seq, job = heapq.heappop(self._ready)
+                if job.limit_chat is not None:
+                    bucket = self._chat_bucket(job.limit_chat)
+                    wait = bucket.delay(now)
+                    if wait:
+                        heapq.heappush(self._delayed, (now + wait, seq, job))
+                        continue
+                    bucket.take()
+                self._global_bucket.take()
+                self._in_flight += 1
+                if job.attempts == 0:
+                    waited = now - job.queued_at
+                    self.wait_total[job.priority] = self.wait_total.get(job.priority, 0.0) + waited
+                    self.wait_count[job.priority] = self.wait_count.get(job.priority, 0) + 1
+                    self.wait_max = max(self.wait_max, waited)
+                self._executor.submit(self._run, job)
+
+    def _run(self, job: ApiJob):
+        method = getattr(job.func, "__name__", "call").lstrip("_")
+        started = time.perf_counter()
+        try:
+            try:
+                result = job.func(*job.args, **job.kwargs)
+            finally:
+                metrics.histogram("bot_api_request_seconds", method=method).observe(
+                    time.perf_counter() - started
+                )
+        except telebot.apihelper.ApiTelegramException as e:
+            metrics.inc("bot_api_errors_total", method=method, code=e.error_code)
+            if e.error_code == 429 and job.attempts < API_MAX_RETRIES:
+                self._retry(job, e.result_json.get("parameters", {}).get("retry_after", 1))
+                return
+            self._fail(job, e)
+        except Exception as e:
+            self._fail(job, e)
+        else:
+            with self._cond:
+                self.sent += 1
+                self._in_flight -= 1
+                self._cond.notify_all()
+            job.future.set_result(result)
+
+    def _retry(self, job: ApiJob, retry_after: float):
+        with self._cond:
+            now = time.monotonic()
+            if job.limit_chat is not None:
+                self._chat_bucket(job.limit_chat).block(now, retry_after)
+            else:
+                self._global_bucket.block(now, retry_after)
+            job.attempts += 1
+            self.retried += 1
+            self._in_flight -= 1
+            heapq.heappush(self._delayed, (now + retry_after, next(self._seq), job))
+            self._cond.notify_all()
+
+    def _fail(self, job: ApiJob, error: Exception):
+        if job.action:
+            logger.error(f"Error {job.action}: {error}")
+        with self._cond:
+            self.failed += 1
+            self._in_flight -= 1
+            self._cond.notify_all()
+        job.future.set_exception(error)
+
+    def join(self):
+        """Blocks until every queued request has been sent or has failed."""
+        with self._cond:
+            while self._ready or self._delayed or self._in_flight:
+                self._cond.wait()
+
+    def stop(self):
+        """Sends what is queued, then stops the dispatcher and the workers."""
+        with self._cond:
+            if not self._running:
+                return
+            self._running = False
+            self._cond.notify_all()
+        self._dispatcher.join()
+        self._executor.shutdown()
+
+    def stats(self) -> dict:
+        """Returns the queue depth, outcome counters and queueing delays."""
+        with self._cond:
+            waits = sum(self.wait_count.values())
+            return {
+                "queued": len(self._ready) + len(self._delayed),
+                "max_queued": self.max_queued,
+                "in_flight": self._in_flight,
+                "sent": self.sent,
+                "failed": self.failed,
+                "retried": self.retried,
+                "dropped": self.dropped,
+                "avg_wait": sum(self.wait_total.values()) / waits if waits else 0.0,
+                "max_wait": self.wait_max,
+                "avg_wait_by_priority": {
+                    p: self.wait_total[p] / n for p, n in sorted(self.wait_count.items())
+                },
+            }
+
+
+api_scheduler = ApiScheduler()
+
+
+# Parts of the errors deleteMessages gives about the messages rather than the chat or the bot.
+_MESSAGE_ERRORS = ("message to delete not found", "message can't be deleted", "message_id_invalid")
+
+
+def _is_message_error(error: telebot.apihelper.ApiTelegramException) -> bool:
+    """Checks if a failed deletion may have failed because of particular messages."""
+    description = error.description.lower()
+    return (
+        error.error_code == 400
+        and "rights" not in description
+        and any(part in description for part in _MESSAGE_ERRORS)
+    )
+
+
+class DeletionBatcher:
+    """Collects messages to delete per chat and deletes each batch with one request.
+
+    A batch is sent when it is full or when its oldest message has waited for
+    the batch window, whichever comes first, so no deletion waits longer than
+    the window plus the time spent in the ApiScheduler queue.
+    """
+
+    def __init__(self, window: float = DELETE_BATCH_WINDOW, max_size: int = DELETE_BATCH_SIZE):
+        self.window = window
+        self.max_size = max_size
+        self._pending = {}  # chat_id -> (deadline, [message_id, ...])
+        self._deadlines = []  # heap of (deadline, chat_id), may hold entries of sent batches
+        self._cond = threading.Condition()
+        self._thread = None
+        # Metrics
+        self.messages = 0
+        self.batches = 0
+        self.fallbacks = 0
+
+    def add(self, chat_id: int, message_id: int):
+        """Queues a message for deletion."""
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="DeletionBatcher", daemon=True
+                )
+                self._thread.start()
+            entry = self._pending.get(chat_id)
+            if entry is None:
+                entry = self._pending[chat_id] = (time.monotonic() + self.window, [])
+                heapq.heappush(self._deadlines, (entry[0], chat_id))
+                self._cond.notify()
+            entry[1].append(message_id)
+            self.messages += 1
+            metrics.inc("bot_deletions_total")
+            if len(entry[1]) >= self.max_size:
+                self._send(chat_id)
+
+    def _run(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                while self._deadlines and self._deadlines[0][0] <= now:
+                    deadline, chat_id = heapq.heappop(self._deadlines)
+                    entry = self._pending.get(chat_id)
+                    if entry is not None and entry[0] == deadline:
+                        self._send(chat_id)
+                self._cond.wait(self._deadlines[0][0] - now if self._deadlines else None)
+
+    def _send(self, chat_id: int):
+        _, message_ids = self._pending.pop(chat_id)
+        self.batches += 1
+        if len(message_ids) == 1:
+            api_scheduler.submit(
+                PRIORITY_MODERATION,
+                bot.delete_message,
+                chat_id,
+                message_ids[0],
+                action="deleting message",
             )
         else:
-            cursor.execute(
-                """UPDATE users SET first_name = ?, last_name = ?, username = ?
-                   WHERE user_id = ?""",
-                (user.first_name, user.last_name, user.username, user.id),
+            api_scheduler.submit(PRIORITY_MODERATION, self._delete_batch, chat_id, message_ids)
+
+    def _delete_batch(self, chat_id: int, message_ids: list):
+        try:
+            bot.delete_messages(chat_id, message_ids)
+        except telebot.apihelper.ApiTelegramException as e:
+            if e.error_code == 429:
+                raise  # The scheduler retries the whole batch
+            if not _is_message_error(e):
+                # Missing rights or a chat the bot has left; single deletes would fail the same way.
+                logger.error(f"Error deleting {len(message_ids)} messages: {e}")
+                return
+            # Fails only if none of the messages could be deleted; find out which ones.
+            logger.warning(f"Error deleting {len(message_ids)} messages at once: {e}")
+            with self._cond:
+                self.fallbacks += 1
+            for message_id in message_ids:
+                api_scheduler.submit(
+                    PRIORITY_MODERATION,
+                    bot.delete_message,
+                    chat_id,
+                    message_id,
+                    action="deleting message",
+                )
+
+    def flush(self):
+        """Sends every collected batch right away."""
+        with self._cond:
+            for chat_id in list(self._pending):
+                self._send(chat_id)
+
+    def stats(self) -> dict:
+        """Returns how many messages were deleted in how many batches."""
+        with self._cond:
+            return {
+                "messages": self.messages,
+                "batches": self.batches,
+                "fallbacks": self.fallbacks,
+                "pending": sum(len(ids) for _, ids in self._pending.values()),
+            }
+
+
+deletion_batcher = DeletionBatcher()
+
+
+def delete_message(message: telebot.types.Message):
+    """Queues the deletion of a message."""
+    deletion_batcher.add(message.chat.id, message.message_id)
+
+
+def send_message(chat_id: int, text: str, priority: int, action: str = "sending message",
+                 **kwargs) -> Future:
+    """Queues a message to a chat."""
+    return api_scheduler.submit(
+        priority, bot.send_message, chat_id, text, limit_chat=chat_id, action=action, **kwargs
+    )
+
+
+def reply_to(message: telebot.types.Message, text: str, priority: int = PRIORITY_REPLY,
+             action: str = "sending reply") -> Future:
+    """Queues a reply to a message."""
+    return api_scheduler.submit(
+        priority, bot.reply_to, message, text, limit_chat=message.chat.id, action=action
+    )
+
+
+def display_name(user: telebot.types.User) -> str:
+    """Returns how messages refer to a user: @username, else the first name, else the id."""
+    if user.username:
+        return f"@{user.username}"
+    return user.first_name or str(user.id)
+
+
+# --- ADMIN NOTIFICATIONS ---
+
+
+def message_link(chat_id: int, message_id: int):
+    """Returns a link to a message in a supergroup, or None for other chats."""
+    if str(chat_id).startswith("-100"):
+        return f"https://t.me/c/{str(chat_id)[4:]}/{message_id}"
+    return None
+
+
+class AdminNotifier:
+    """Collects notifications for chat admins and sends them as periodic digests.
+
+    Notifications about the same user in the same chat are merged into one
+    entry however often they come, so an incident costs each recipient one
+    message per interval rather than one per event. A chat's entries go to its
+    log channel if it has one, otherwise to each of its admins in private, and
+    an admin of several chats gets one digest covering all of them. Bots and
+    admins who never started the bot can't be written to; a chat none of
+    whose recipients could be reached goes to ADMIN_ID instead.
+    """
+
+    def __init__(
+        self, interval: float = NOTIFY_DIGEST_INTERVAL, max_users: int = NOTIFY_DIGEST_MAX_USERS
+    ):
+        self.interval = interval
+        self.max_users = max_users
+        self._pending = {}  # chat_id -> {"title": str, "users": {user_id: entry dict}}
+        self._lock = threading.Lock()
+        self._thread = None
+        # {user_id: True} for admins whose digests were refused
+        self.unreachable = LRUCache(10000, NOTIFY_UNREACHABLE_TTL)
+        # Metrics
+        self.notifications = 0
+        self.digests = 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return sum(len(chat["users"]) for chat in self._pending.values())
+
+    def _entry(self, chat: telebot.types.Chat, user: telebot.types.User) -> dict:
+        # Called with the lock held.
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="AdminNotifier", daemon=True)
+            self._thread.start()
+        self.notifications += 1
+        pending = self._pending.setdefault(chat.id, {"title": chat.title, "users": {}})
+        return pending["users"].setdefault(
+            user.id,
+            {
+                "name": display_name(user),
+                "warnings": 0,
+                "reports": 0,
+                "reporters": set(),
+                "last_report": None,  # (text, link)
+            },
+        )
+
+    def warned(self, chat: telebot.types.Chat, user: telebot.types.User, warnings: int):
+        """Notes that a user is at or over the warning limit in a chat."""
+        with self._lock:
+            entry = self._entry(chat, user)
+            entry["warnings"] = max(entry["warnings"], warnings)
+
+    def reported(self, reporter: telebot.types.User, reported: telebot.types.Message):
+        """Notes a report about a message."""
+        text = reported.text or reported.caption or "(no text)"
+        if len(text) > 200:
+            text = text[:200] + "..."
+        with self._lock:
+            entry = self._entry(reported.chat, reported.from_user)
+            entry["reports"] += 1
+            entry["reporters"].add(reporter.id)
+            entry["last_report"] = (text, message_link(reported.chat.id, reported.message_id))
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error sending admin digests: {e}")
+
+    def flush(self):
+        """Sends the digests of everything collected so far."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        sections = {}  # chat_id -> lines
+        chats_of = {}  # recipient -> chat ids
+        for chat_id, chat in pending.items():
+            sections[chat_id] = self._format_chat(chat_id, chat)
+            for recipient in self._recipients(chat_id) or ([ADMIN_ID] if ADMIN_ID else []):
+                chats_of.setdefault(recipient, []).append(chat_id)
+        # chat_id -> [recipients still being sent to, whether any of them was reached]
+        outcomes = {chat_id: [0, False] for chat_id in sections}
+        for chat_ids in chats_of.values():
+            for chat_id in chat_ids:
+                outcomes[chat_id][0] += 1
+        for recipient, chat_ids in chats_of.items():
+            lines = ["Moderation digest"]
+            for chat_id in chat_ids:
+                lines.extend(sections[chat_id])
+            sent = [
+                send_message(recipient, text, PRIORITY_WARNING, action="sending admin digest")
+                for text in batch_lines(lines)
+            ]
+            self._track(recipient, sent, chat_ids, outcomes, sections)
+            self.digests += 1
+            metrics.inc("bot_admin_digests_total")
+
+    def _track(self, recipient: int, sent: list, chat_ids: list, outcomes: dict, sections: dict):
+        """Once a digest is sent, falls back to ADMIN_ID for its chats that reached no one."""
+        remaining = [len(sent)]
+        errors = []
+
+        def on_sent(future: Future):
+            with self._lock:
+                if future.exception() is not None:
+                    errors.append(future.exception())
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+                unreached = []
+                for chat_id in chat_ids:
+                    outcome = outcomes[chat_id]
+                    outcome[0] -= 1
+                    outcome[1] = outcome[1] or not errors
+                    if not outcome[0] and not outcome[1]:
+                        unreached.append(chat_id)
+            if any(
+                isinstance(e, telebot.apihelper.ApiTelegramException) and e.error_code in (400, 403)
+                for e in errors
+            ):
+                self.unreachable.set(recipient, True)
+            if unreached and ADMIN_ID and recipient != ADMIN_ID:
+                lines = ["Moderation digest (no administrator of these chats could be reached)"]
+                for chat_id in unreached:
+                    lines.extend(sections[chat_id])
+                for text in batch_lines(lines):
+                    send_message(ADMIN_ID, text, PRIORITY_WARNING, action="sending admin digest")
+
+        for future in sent:
+            future.add_done_callback(on_sent)
+
+    def _format_chat(self, chat_id: int, chat: dict) -> list:
+        users = list(chat["users"].items())
+        lines = ["", f"{chat['title'] or 'Chat'} (ID: {chat_id}):"]
+        for user_id, entry in users[: self.max_users]:
+            events = []
+            if entry["warnings"]:
+                events.append(f"{entry['warnings']} warnings (limit {WARNING_LIMIT})")
+            if entry["reports"]:
+                events.append(
+                    f"reported {entry['reports']} time(s) by {len(entry['reporters'])} user(s)"
+                )
+            lines.append(f"- {entry['name']} (ID: {user_id}): {', '.join(events)}")
+            if entry["last_report"]:
+                text, link = entry["last_report"]
+                lines.append(f'  last reported: "{text}"' + (f" {link}" if link else ""))
+        if len(users) > self.max_users:
+            lines.append(f"... and {len(users) - self.max_users} more users")
+        return lines
+
+    def _recipients(self, chat_id: int) -> list:
+        log_channel = get_chat_settings(chat_id).get("log_channel")
+        if log_channel:
+            return [log_channel]
+        return sorted(
+            admin
+            for admin in get_chat_admins(chat_id)
+            if admin_bots.get(admin) is None and self.unreachable.get(admin) is None
+        )
+
+
+admin_notifier = AdminNotifier()
+
+
+# --- CAPTCHAS ---
+
+
+class CaptchaStore:
+    """Pending captchas per (chat, user), forgotten when they expire.
+
+    Each entry is a small (answer, expires_at) tuple. A heap ordered by expiry
+    lets a sweeper thread wake up exactly when the next captcha times out and
+    hand it to on_expire; entries of captchas that were solved in the meantime
+    are skipped. With persist set, entries are mirrored in the captchas table
+    and reloaded by start().
+    """
+
+    def __init__(self, timeout: float = CAPTCHA_TIMEOUT, persist: bool = CAPTCHA_PERSIST,
+                 on_expire=None):
+        self.timeout = timeout
+        self.persist = persist
+        self.on_expire = on_expire
+        self._entries = {}  # (chat_id, user_id) -> (answer, expires_at)
+        self._expiries = []  # heap of (expires_at, chat_id, user_id)
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def add(self, chat_id: int, user_id: int, answer: int):
+        """Stores the answer a user has to give, replacing an earlier captcha.
+
+        The user is no longer verified in the chat until they solve it.
+        """
+        set_users_unverified(chat_id, [user_id])
+        expires_at = int(time.time() + self.timeout)
+        # Stored first, so that the sweeper can't delete the row before it is written.
+        if self.persist:
+            save_captcha_db(chat_id, user_id, answer, expires_at)
+        with self._cond:
+            self._entries[(chat_id, user_id)] = (answer, expires_at)
+            heapq.heappush(self._expiries, (expires_at, chat_id, user_id))
+            self._cond.notify()
+
+    def add_many(self, chat_id: int, user_ids: list, answer: int):
+        """Gives several users of a chat the same captcha, with one write per table."""
+        set_users_unverified(chat_id, user_ids)
+        expires_at = int(time.time() + self.timeout)
+        if self.persist:
+            save_captchas_db([(chat_id, user_id, answer, expires_at) for user_id in user_ids])
+        with self._cond:
+            for user_id in user_ids:
+                self._entries[(chat_id, user_id)] = (answer, expires_at)
+                heapq.heappush(self._expiries, (expires_at, chat_id, user_id))
+            self._cond.notify()
+
+    def get(self, chat_id: int, user_id: int):
+        """Returns the expected answer, or None if the user has no pending captcha."""
+        entry = self._entries.get((chat_id, user_id))
+        if entry is None or entry[1] <= time.time():
+            return None
+        return entry[0]
+
+    def remove(self, chat_id: int, user_id: int):
+        """Forgets a captcha, e.g. once it is solved."""
+        with self._cond:
+            entry = self._entries.pop((chat_id, user_id), None)
+        if entry is not None and self.persist:
+            delete_captcha_db(chat_id, user_id)
+
+    def start(self, owns_chat=None):
+        """Loads persisted captchas and starts expiring them in the background.
+
+        owns_chat, if given, selects the chats whose captchas this process handles.
+        """
+        if self.persist:
+            with self._cond:
+                for chat_id, user_id, answer, expires_at in get_captchas_db():
+                    if owns_chat is not None and not owns_chat(chat_id):
+                        continue
+                    self._entries[(chat_id, user_id)] = (answer, expires_at)
+                    heapq.heappush(self._expiries, (expires_at, chat_id, user_id))
+            logger.info(f"Loaded {len(self._entries)} pending captchas.")
+        self._thread = threading.Thread(target=self._sweep, name="CaptchaSweeper", daemon=True)
+        self._thread.start()
+
+    def _sweep(self):
+        while True:
+            with self._cond:
+                now = time.time()
+                while not self._expiries or self._expiries[0][0] > now:
+                    self._cond.wait(self._expiries[0][0] - now if self._expiries else None)
+                    now = time.time()
+                expires_at, chat_id, user_id = heapq.heappop(self._expiries)
+                entry = self._entries.get((chat_id, user_id))
+                if entry is None or entry[1] != expires_at:
+                    continue  # Solved or replaced by a newer captcha
+                del self._entries[(chat_id, user_id)]
+            if self.persist:
+                delete_captcha_db(chat_id, user_id)
+            if self.on_expire:
+                try:
+                    self.on_expire(chat_id, user_id)
+                except Exception as e:
+                    logger.error(f"Error handling expired captcha: {e}")
+
+
+def kick_user(chat_id: int, user_id: int):
+    """Removes a user from a chat without banning them."""
+    bot.ban_chat_member(chat_id, user_id)
+    bot.unban_chat_member(chat_id, user_id, only_if_banned=True)
+
+
+def handle_captcha_timeout(chat_id: int, user_id: int):
+    """Kicks a user who did not solve the captcha in time."""
+    logger.info(f"User {user_id} did not solve the captcha in chat {chat_id}.")
+    metrics.inc("bot_captchas_total", result="expired")
+    captcha_challenges.done(chat_id, user_id)
+    if CAPTCHA_KICK_ON_TIMEOUT:
+        api_scheduler.submit(
+            PRIORITY_MODERATION, kick_user, chat_id, user_id, action="kicking user"
+        )
+
+
+def _captcha_signature(payload: str) -> str:
+    key = (CAPTCHA_SECRET or BOT_TOKEN).encode()
+    return hmac.new(key, payload.encode(), hashlib.sha256).hexdigest()[:16]
+
+
+def sign_captcha_data(chat_id: int, user_id: int, answer: int) -> str:
+    """Returns the callback data of a captcha button; user_id 0 lets any pending user press it."""
+    payload = f"{chat_id}:{user_id}:{answer}"
+    return f"cap:{payload}:{_captcha_signature(payload)}"  # At most 64 bytes
+
+
+def parse_captcha_data(data: str):
+    """Returns the (chat_id, user_id, answer) of captcha button data, or None if it is forged."""
+    try:
+        prefix, chat_id, user_id, answer, signature = data.split(":")
+        if prefix == "cap" and hmac.compare_digest(
+            signature, _captcha_signature(f"{chat_id}:{user_id}:{answer}")
+        ):
+            return int(chat_id), int(user_id), int(answer)
+    except (AttributeError, ValueError):
+        pass
+    return None
+
+
+def captcha_keyboard(chat_id: int, user_id: int, answer: int):
+    """Returns the buttons of a captcha: the answer among wrong ones, in ascending order."""
+    sums = range(2 * CAPTCHA_MIN_NUMBER, 2 * CAPTCHA_MAX_NUMBER + 1)
+    wrong = random.sample([s for s in sums if s != answer], min(CAPTCHA_CHOICES, len(sums)) - 1)
+    keyboard = telebot.types.InlineKeyboardMarkup()
+    keyboard.row(
+        *(
+            telebot.types.InlineKeyboardButton(
+                str(choice), callback_data=sign_captcha_data(chat_id, user_id, choice)
             )
-        conn.commit()
+            for choice in sorted([answer, *wrong])
+        )
+    )
+    return keyboard
 
 
-def get_user(user_id: int) -> dict:
-    """Gets a user from the database."""
-    with sqlite3.connect(DB_NAME) as conn:
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-        result = cursor.fetchone()
-        return dict(result) if result else {}
+class CaptchaChallenges:
+    """The messages challenging users with a captcha, deleted once nobody needs them.
 
+    A message may challenge several users (during raids). It goes to the
+    DeletionBatcher, to be deleted along with other messages of the chat, when
+    the last of its users has solved, failed or let the captcha expire. Not
+    persisted: challenges pending across a restart are left in the chat.
+    """
 
-def get_user_status(user_id: int) -> bool:
-    """Checks if a user is verified."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT is_verified FROM users WHERE user_id = ?", (user_id,))
-        result = cursor.fetchone()
-        return bool(result[0]) if result else False
+    def __init__(self):
+        self._messages = {}  # (chat_id, user_id) -> message_id
+        self._users = {}  # (chat_id, message_id) -> set of user ids still challenged
+        self._lock = threading.Lock()
 
+    def track(self, chat_id: int, user_ids: list, sent: Future):
+        """Remembers the challenge message of users once it has been sent."""
 
-def set_user_verified(user_id: int):
-    """Marks a user as verified."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("UPDATE users SET is_verified = 1 WHERE user_id = ?", (user_id,))
-        conn.commit()
+        def on_sent(future: Future):
+            if not future.cancelled() and future.exception() is None and future.result():
+                self.add(chat_id, user_ids, future.result().message_id)
 
+        sent.add_done_callback(on_sent)
 
-def add_warning(user_id: int) -> int:
-    """Adds a warning to a user and returns the new count."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE users SET warnings = warnings + 1 WHERE user_id = ?", (user_id,)
+    def add(self, chat_id: int, user_ids: list, message_id: int):
+        """Remembers the challenge message of users who still have a pending captcha."""
+        unneeded = []
+        with self._lock:
+            users = {user_id for user_id in user_ids if (chat_id, user_id) in captcha_store}
+            if users:
+                self._users[(chat_id, message_id)] = users
+            else:
+                unneeded.append(message_id)  # Solved or expired while it was being sent
+            for user_id in users:
+                previous = self._messages.get((chat_id, user_id))
+                self._messages[(chat_id, user_id)] = message_id
+                if previous is not None and self._leave(chat_id, user_id, previous):
+                    unneeded.append(previous)
+        for unneeded_id in unneeded:
+            deletion_batcher.add(chat_id, unneeded_id)
+
+    def message_id(self, chat_id: int, user_id: int):
+        """Returns the challenge message of a user, or None."""
+        return self._messages.get((chat_id, user_id))
+
+    def done(self, chat_id: int, user_id: int):
+        """Forgets a user's challenge and deletes its message if no one else needs it."""
+        with self._lock:
+            message_id = self._messages.pop((chat_id, user_id), None)
+            unneeded = message_id is not None and self._leave(chat_id, user_id, message_id)
+        if unneeded:
+            deletion_batcher.add(chat_id, message_id)
+
+    def _leave(self, chat_id: int, user_id: int, message_id: int) -> bool:
+        # Called with the lock held; returns whether the message is no longer needed.
+        users = self._users.get((chat_id, message_id))
+        if users is None:
+            return False
+        users.discard(user_id)
+        if users:
+            return False
+        del self._users[(chat_id, message_id)]
+        return True
+
+
+captcha_store = CaptchaStore(on_expire=handle_captcha_timeout)
+captcha_challenges = CaptchaChallenges()
+# {(chat_id, user_id): wrong presses so far}
+captcha_attempts = LRUCache(100000, CAPTCHA_TIMEOUT)
+
+
+# --- RAIDS ---
+
+# Permissions of raid joiners until they pass the captcha: none.
+RAID_PERMISSIONS = telebot.types.ChatPermissions(
+    can_send_messages=False,
+    can_send_audios=False,
+    can_send_documents=False,
+    can_send_photos=False,
+    can_send_videos=False,
+    can_send_video_notes=False,
+    can_send_voice_notes=False,
+    can_send_polls=False,
+    can_send_other_messages=False,
+    can_add_web_page_previews=False,
+    can_invite_users=False,
+)
+# Passing True for every permission lifts a user's restrictions.
+UNRESTRICTED_PERMISSIONS = telebot.types.ChatPermissions(
+    can_send_messages=True,
+    can_send_audios=True,
+    can_send_documents=True,
+    can_send_photos=True,
+    can_send_videos=True,
+    can_send_video_notes=True,
+    can_send_voice_notes=True,
+    can_send_polls=True,
+    can_send_other_messages=True,
+    can_add_web_page_previews=True,
+    can_change_info=True,
+    can_invite_users=True,
+    can_pin_messages=True,
+    can_manage_topics=True,
+)
+
+
+class RaidDetector:
+    """Counts joins per chat over a sliding window to tell raids from ordinary joins."""
+
+    def __init__(self, threshold: int = RAID_JOIN_THRESHOLD, window: float = RAID_WINDOW,
+                 cooldown: float = RAID_COOLDOWN):
+        self.threshold = threshold
+        self.window = window
+        self.cooldown = cooldown
+        self._joins = {}  # chat_id -> [deque of (time, count), total count in the deque]
+        self._raid_until = {}  # chat_id -> time the raid mode ends
+        self._lock = threading.Lock()
+
+    def record(self, chat_id: int, count: int) -> bool:
+        """Records that count users joined a chat and returns whether it is under a raid."""
+        now = time.monotonic()
+        with self._lock:
+            joins = self._joins.get(chat_id)
+            if joins is None:
+                joins = self._joins[chat_id] = [deque(), 0]
+            events = joins[0]
+            events.append((now, count))
+            joins[1] += count
+            while events[0][0] <= now - self.window:
+                joins[1] -= events.popleft()[1]
+            if joins[1] >= self.threshold:
+                if self._raid_until.get(chat_id, 0) <= now:
+                    logger.warning(f"Join raid detected in chat {chat_id}.")
+                    metrics.inc("bot_raids_total")
+                self._raid_until[chat_id] = now + self.cooldown
+            if len(self._joins) > 10000:
+                self._prune(now)
+            return self._raid_until.get(chat_id, 0) > now
+
+    def _prune(self, now: float):
+        for chat_id in [c for c, (events, _) in self._joins.items()
+                        if events[-1][0] <= now - self.window]:
+            del self._joins[chat_id]
+        for chat_id in [c for c, until in self._raid_until.items() if until <= now]:
+            del self._raid_until[chat_id]
+
+
+class RaidCaptchaBatcher:
+    """Greets the users who join a chat during a raid with one captcha message per interval.
+
+    The batches of all chats are sent by one thread, which sleeps until the
+    oldest batch is due.
+    """
+
+    def __init__(self, interval: float = RAID_CAPTCHA_INTERVAL):
+        self.interval = interval
+        self._pending = {}  # chat_id -> (deadline, [user, ...])
+        self._deadlines = []  # heap of (deadline, chat_id), may hold entries of sent batches
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def add(self, chat_id: int, users: list):
+        """Queues users for the next aggregated captcha of the chat."""
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="RaidCaptchaBatcher", daemon=True
+                )
+                self._thread.start()
+            entry = self._pending.get(chat_id)
+            if entry is None:
+                entry = self._pending[chat_id] = (time.monotonic() + self.interval, [])
+                heapq.heappush(self._deadlines, (entry[0], chat_id))
+                self._cond.notify()
+            entry[1].extend(users)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                while not self._deadlines or self._deadlines[0][0] > now:
+                    self._cond.wait(self._deadlines[0][0] - now if self._deadlines else None)
+                    now = time.monotonic()
+                deadline, chat_id = heapq.heappop(self._deadlines)
+                entry = self._pending.get(chat_id)
+                if entry is None or entry[0] != deadline:
+                    continue  # Sent by flush_all already
+            try:
+                self.flush(chat_id)
+            except Exception as e:
+                logger.error(f"Error sending raid captcha: {e}")
+
+    def flush(self, chat_id: int):
+        """Registers the queued users and sends them one shared captcha."""
+        with self._cond:
+            _, users = self._pending.pop(chat_id, (None, None))
+        if not users:
+            return
+        add_or_update_users(users)
+        num1 = random.randint(CAPTCHA_MIN_NUMBER, CAPTCHA_MAX_NUMBER)
+        num2 = random.randint(CAPTCHA_MIN_NUMBER, CAPTCHA_MAX_NUMBER)
+        captcha_store.add_many(chat_id, [user.id for user in users], num1 + num2)
+        metrics.inc("bot_captchas_total", len(users), result="issued")
+
+        names = [user.first_name for user in users[:50]]
+        if len(users) > len(names):
+            names.append(f"and {len(users) - len(names)} more")
+        sent = send_message(
+            chat_id,
+            RAID_WELCOME_MESSAGE.format(user_names=", ".join(names), num1=num1, num2=num2),
+            PRIORITY_WELCOME,
+            action="sending captcha",
+            reply_markup=captcha_keyboard(chat_id, 0, num1 + num2),  # Any of them may answer
         )
-        conn.commit()
-        cursor.execute("SELECT warnings FROM users WHERE user_id = ?", (user_id,))
-        result = cursor.fetchone()
-        return result[0] if result else 0
+        captcha_challenges.track(chat_id, [user.id for user in users], sent)
+
+    def flush_all(self):
+        """Sends the captchas of every chat right away, e.g. on shutdown."""
+        with self._cond:
+            chat_ids = list(self._pending)
+        for chat_id in chat_ids:
+            self.flush(chat_id)
+
+
+raid_detector = RaidDetector()
+raid_captcha_batcher = RaidCaptchaBatcher()
+# {(chat_id, user_id): True} for raid joiners whose restriction is lifted once they
+# pass the captcha; restrictions expire on their own with the captcha.
+raid_restricted = LRUCache(100000, CAPTCHA_TIMEOUT)
+
+
+def restrict_raid_joiner(chat_id: int, user_id: int):
+    """Keeps a raid joiner from sending anything until the captcha times out."""
+    raid_restricted.set((chat_id, user_id), True)
+    api_scheduler.submit(
+        PRIORITY_MODERATION,
+        bot.restrict_chat_member,
+        chat_id,
+        user_id,
+        until_date=int(time.time() + CAPTCHA_TIMEOUT),
+        permissions=RAID_PERMISSIONS,
+        use_independent_chat_permissions=True,
+        action="restricting user",
+    )
 
 
-def mute_user_db(user_id: int, mute_time: int):
-    """Mutes a user for a specified amount of time."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE users SET muted = ? WHERE user_id = ?",
-            (int(time.time()) + mute_time, user_id),
+def lift_raid_restriction(chat_id: int, user_id: int):
+    """Lifts the restriction of a raid joiner who passed the captcha."""
+    if raid_restricted.get((chat_id, user_id)) is None:
+        return
+    raid_restricted.delete((chat_id, user_id))
+    api_scheduler.submit(
+        PRIORITY_REPLY,
+        bot.restrict_chat_member,
+        chat_id,
+        user_id,
+        permissions=UNRESTRICTED_PERMISSIONS,
+        use_independent_chat_permissions=True,
+        action="lifting restriction",
+    )
+
+
+# --- MUTES ---
+
+# Permissions of muted users: none.
+MUTED_PERMISSIONS = telebot.types.ChatPermissions(
+    can_send_messages=False,
+    can_send_audios=False,
+    can_send_documents=False,
+    can_send_photos=False,
+    can_send_videos=False,
+    can_send_video_notes=False,
+    can_send_voice_notes=False,
+    can_send_polls=False,
+    can_send_other_messages=False,
+    can_add_web_page_previews=False,
+    can_change_info=False,
+    can_invite_users=False,
+    can_pin_messages=False,
+    can_manage_topics=False,
+)
+
+
+class MuteScheduler:
+    """Restricts muted users in Telegram and lifts the restriction when the mute ends.
+
+    Mutes are stored in chat_members.muted, from which start() recovers them. A
+    heap ordered by end time lets a thread wake up exactly when the next mute
+    ends; mutes that were replaced in the meantime are skipped. Muted users
+    cannot send anything; what arrives from them anyway, e.g. because the
+    restriction failed, is deleted by the "muted" filter stage.
+    """
+
+    def __init__(self):
+        self._mutes = {}  # (chat_id, user_id) -> time the mute ends
+        self._expiries = []  # heap of (muted_until, chat_id, user_id)
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._mutes)
+
+    def __contains__(self, key):
+        return key in self._mutes
+
+    def mute(self, chat_id: int, user_id: int, mute_time: int):
+        """Mutes a user in a chat for mute_time seconds, replacing an earlier mute."""
+        muted_until = mute_user_db(chat_id, user_id, mute_time)
+        metrics.inc("bot_mutes_total")
+        self.enforce(chat_id, user_id, muted_until)
+
+    def enforce(self, chat_id: int, user_id: int, muted_until: int):
+        """Restricts a user whose mute is already stored and lifts it when the mute ends."""
+        # Telegram lifts the restriction itself at until_date as well, except for
+        # mutes shorter than 30 seconds, which it would keep forever. Queued before
+        # the mute is scheduled, so that the lift can never be sent ahead of it.
+        api_scheduler.submit(
+            PRIORITY_MODERATION,
+            bot.restrict_chat_member,
+            chat_id,
+            user_id,
+            until_date=muted_until,
+            permissions=MUTED_PERMISSIONS,
+            use_independent_chat_permissions=True,
+            action="muting user",
         )
-        conn.commit()
+        self._schedule(chat_id, user_id, muted_until)
 
+    def start(self, owns_chat=None):
+        """Loads the stored mutes and starts lifting them in the background.
 
-def unmute_user_db(user_id: int):
-    """Unmutes a user."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("UPDATE users SET muted = 0 WHERE user_id = ?", (user_id,))
-        conn.commit()
+        owns_chat, if given, selects the chats whose mutes this process handles.
+        Mutes that ended while the bot was down are lifted right away.
+        """
+        for chat_id, user_id, muted_until in get_mutes_db():
+            if owns_chat is None or owns_chat(chat_id):
+                self._schedule(chat_id, user_id, muted_until)
+        logger.info(f"Loaded {len(self._mutes)} mutes.")
+        self._thread = threading.Thread(target=self._sweep, name="MuteScheduler", daemon=True)
+        self._thread.start()
+
+    def _schedule(self, chat_id: int, user_id: int, muted_until: int):
+        with self._cond:
+            self._mutes[(chat_id, user_id)] = muted_until
+            heapq.heappush(self._expiries, (muted_until, chat_id, user_id))
+            self._cond.notify()
+
+    def _lift(self, chat_id: int, user_id: int):
+        unmute_user_db(chat_id, user_id)
+        api_scheduler.submit(
+            PRIORITY_MODERATION,
+            bot.restrict_chat_member,
+            chat_id,
+            user_id,
+            permissions=UNRESTRICTED_PERMISSIONS,
+            use_independent_chat_permissions=True,
+            action="unmuting user",
+        )
 
+    def _sweep(self):
+        while True:
+            with self._cond:
+                now = time.time()
+                while not self._expiries or self._expiries[0][0] > now:
+                    self._cond.wait(self._expiries[0][0] - now if self._expiries else None)
+                    now = time.time()
+                muted_until, chat_id, user_id = heapq.heappop(self._expiries)
+                if self._mutes.get((chat_id, user_id)) != muted_until:
+                    continue  # Replaced by a newer mute
+                del self._mutes[(chat_id, user_id)]
+            try:
+                self._lift(chat_id, user_id)
+            except Exception as e:
+                logger.error(f"Error lifting mute: {e}")
 
-def ban_user_db(user_id: int):
-    """Bans a user."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("UPDATE users SET banned = 1 WHERE user_id = ?", (user_id,))
-        conn.commit()
 
+mute_scheduler = MuteScheduler()
 
-def unban_user_db(user_id: int):
-    """Unbans a user."""
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("UPDATE users SET banned = 0 WHERE user_id = ?", (user_id,))
-        conn.commit()
+
+# --- FLOOD CONTROL ---
+
+
+class FloodTracker:
+    """Remembers when each (chat, user) pair sent its last messages, to detect floods.
+
+    Every pair gets a ring buffer of message times as long as the chat's message
+    limit. The slot about to be overwritten holds the time of the message that
+    many messages ago, so a check costs the same whatever the limit. Pairs that
+    flooded stay throttled until their mute ends. Beyond maxsize, the pairs that
+    were quiet the longest are forgotten.
+    """
+
+    def __init__(self, maxsize: int = FLOOD_TRACKER_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()  # (chat_id, user_id) -> [times, next slot, throttled until]
+        self._lock = threading.Lock()
+
+    def throttled(self, chat_id: int, user_id: int) -> bool:
+        """Checks if a pair is throttled after a flood."""
+        with self._lock:
+            entry = self._entries.get((chat_id, user_id))
+            return entry is not None and entry[2] > time.monotonic()
+
+    def record(self, chat_id: int, user_id: int, messages: int, seconds: float) -> bool:
+        """Records a message and returns whether it makes more than messages within seconds."""
+        key = (chat_id, user_id)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or len(entry[0]) != messages:
+                entry = self._entries[key] = [array("d", [float("-inf")]) * messages, 0, 0.0]
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+            else:
+                self._entries.move_to_end(key)
+            times, slot = entry[0], entry[1]
+            flooding = now - times[slot] < seconds
+            times[slot] = now
+            entry[1] = (slot + 1) % messages
+            return flooding
+
+    def throttle(self, chat_id: int, user_id: int, seconds: float):
+        """Makes a pair throttled for a while."""
+        with self._lock:
+            entry = self._entries.get((chat_id, user_id))
+            if entry is not None:
+                entry[2] = time.monotonic() + seconds
+
+
+flood_tracker = FloodTracker()
+
+
+# --- SPAM FINGERPRINTS ---
+
+_WORDS = re.compile(r"\w+")
+
+
+def normalize_spam_text(text: str) -> str:
+    """Brings text to the form copies are compared in: words only, single spaces."""
+    return " ".join(_WORDS.findall(normalize_text(text or "")))
+
+
+class SpamFingerprints:
+    """Remembers the texts deleted as spam, so that their copies are recognized on sight.
+
+    An exact copy is found by the hash of its normalized text. A near copy is
+    found by a one-permutation MinHash: the hashes of the character shingles of
+    a text are dealt into slots by their remainder, and its signature keeps the
+    smallest hash of each slot. Two texts agree on a slot about as often as they
+    share shingles (Jaccard similarity). The signature is cut into bands
+    (locality-sensitive hashing), and only the fingerprints sharing a whole band
+    with a text are compared with it.
+
+    Fingerprints are kept in time buckets of bucket seconds, and whole buckets
+    expire after ttl. Beyond maxsize, the oldest fingerprints are dropped first.
+    Suspect texts only become fingerprints once they were seen in several chats
+    or from several senders: one user insulting another is no spam campaign.
+    String hashes differ between processes, so every shard has its own fingerprints.
+    """
+
+    def __init__(
+        self,
+        ttl: float = SPAM_FINGERPRINT_TTL,
+        bucket: float = SPAM_FINGERPRINT_BUCKET,
+        maxsize: int = SPAM_FINGERPRINT_SIZE,
+        slots: int = SPAM_MINHASH_SLOTS,
+        bands: int = SPAM_MINHASH_BANDS,
+        similarity: float = SPAM_SIMILARITY,
+    ):
+        self.ttl = ttl
+        self.bucket = bucket
+        self.maxsize = maxsize
+        self.similarity = similarity
+        self._slots = slots
+        self._rows = slots // bands
+        self._bands = bands
+        self._buckets = deque()  # [bucket number, deque of fingerprints], oldest first
+        self._exact = {}  # hash of the text -> fingerprint
+        self._near = {}  # (band, values) -> set of fingerprints
+        self._size = 0
+        # hash of the text -> (chat ids, user ids) of the suspect texts seen so far
+        self._suspects = LRUCache(maxsize, ttl)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self._size
+
+    def fingerprint(self, text: str):
+        """Returns (hash of the text, MinHash signature), or None for texts too short to tell apart."""
+        normalized = normalize_spam_text(text)
+        if len(normalized) < SPAM_MIN_LENGTH:
+            return None
+        slots = self._slots
+        shingles = {
+            hash(normalized[i : i + SPAM_SHINGLE_SIZE])
+            for i in range(len(normalized) - SPAM_SHINGLE_SIZE + 1)
+        }
+        # Largest first, so that the smallest hash of each slot is written last.
+        smallest = {shingle % slots: shingle for shingle in sorted(shingles, reverse=True)}
+        # None: no shingle fell into the slot.
+        return hash(normalized), tuple(map(smallest.get, range(slots)))
+
+    def _band_keys(self, signature: tuple) -> list:
+        rows = self._rows
+        bands = [(i, signature[i * rows : (i + 1) * rows]) for i in range(self._bands)]
+        # Empty bands say nothing about the text.
+        return [band for band in bands if band[1].count(None) < rows]
+
+    @staticmethod
+    def _similarity(signature: tuple, other: tuple) -> float:
+        """Estimates the Jaccard similarity of the texts from the slots either of them filled."""
+        filled = shared = 0
+        for value, other_value in zip(signature, other):
+            if value is not None or other_value is not None:
+                filled += 1
+                shared += value == other_value
+        return shared / filled
+
+    def _forget_oldest(self):
+        fingerprints = self._buckets[0][1]
+        fingerprint = fingerprints.popleft()
+        if not fingerprints:
+            self._buckets.popleft()
+        self._size -= 1
+        if self._exact.get(fingerprint[0]) is fingerprint:
+            del self._exact[fingerprint[0]]
+        for key in self._band_keys(fingerprint[1]):
+            near = self._near[key]
+            near.discard(fingerprint)
+            if not near:
+                del self._near[key]
+
+    def _expire(self, now: float):
+        oldest = (now - self.ttl) // self.bucket
+        while self._buckets and self._buckets[0][0] < oldest:
+            for _ in range(len(self._buckets[0][1])):
+                self._forget_oldest()
+
+    def add(self, text: str):
+        """Remembers a text as spam."""
+        fingerprint = self.fingerprint(text)
+        if fingerprint is None:
+            return
+        now = time.monotonic()
+        number = now // self.bucket
+        with self._lock:
+            self._expire(now)
+            if fingerprint[0] in self._exact:
+                return
+            if not self._buckets or self._buckets[-1][0] != number:
+                self._buckets.append([number, deque()])
+            self._buckets[-1][1].append(fingerprint)
+            self._exact[fingerprint[0]] = fingerprint
+            for key in self._band_keys(fingerprint[1]):
+                self._near.setdefault(key, set()).add(fingerprint)
+            self._size += 1
+            while self._size > self.maxsize:
+                self._forget_oldest()
+
+    def suspect(self, text: str, chat_id: int, user_id: int):
+        """Notes a possible spam text, remembered as spam once it comes from enough sources."""
+        fingerprint = self.fingerprint(text)
+        if fingerprint is None:
+            return
+        with self._lock:
+            chats, users = self._suspects.get(fingerprint[0], (frozenset(), frozenset()))
+            chats, users = chats | {chat_id}, users | {user_id}
+            if max(len(chats), len(users)) < SPAM_SUSPECT_SOURCES:
+                self._suspects.set(fingerprint[0], (chats, users))
+                return
+            self._suspects.delete(fingerprint[0])
+        self.add(text)
+
+    def match(self, text: str) -> bool:
+        """Checks if a text is a copy, exact or near, of a text remembered as spam."""
+        if not self._size:
+            return False  # Nothing to compare with, don't even hash
+        fingerprint = self.fingerprint(text)
+        if fingerprint is None:
+            return False
+        text_hash, signature = fingerprint
+        with self._lock:
+            self._expire(time.monotonic())
+            if text_hash in self._exact:
+                return True
+            for key in self._band_keys(signature):
+                for candidate in self._near.get(key, ()):
+                    if self._similarity(candidate[1], signature) >= self.similarity:
+                        return True
+        return False
+
+
+spam_fingerprints = SpamFingerprints()
+
+
+# --- LINKS ---
+
+# Hostnames in text, with or without a scheme: letter/digit labels ending in a top-level
+# domain of letters. Not preceded by "@" or a dot, so that e-mail addresses don't count.
+_HOSTNAMES = re.compile(
+    r"(?<![\w@.-])(?:https?://)?((?:[^\W_](?:[\w-]{0,61}[^\W_])?\.)+[^\W\d_]{2,63})(?![\w-])"
+)
+
+
+def normalize_domain(domain: str) -> str:
+    """Brings a domain or hostname to the form lists are matched in: lowercase ASCII (IDNA)."""
+    domain = domain.strip().lower().removeprefix("*.").strip(".")
+    try:
+        return domain.encode("idna").decode("ascii")
+    except UnicodeError:
+        return domain
+
+
+class DomainTrie:
+    """Domains with a value each, looked up by the longest listed suffix of a hostname.
+
+    The labels are stored reversed ("com" -> "example" -> "ads"), so a lookup
+    walks a hostname from its top-level domain down and costs one step per
+    label, however many domains are listed. Not modified once built.
+    """
+
+    __slots__ = ("_root", "_size")
+
+    def __init__(self, items=()):
+        self._root = {}  # label -> node; a node's value is stored under None
+        self._size = 0
+        for domain, value in items:
+            node = self._root
+            for label in reversed(domain.split(".")):
+                node = node.setdefault(label, {})
+            if None not in node:
+                self._size += 1
+            node[None] = value
+
+    def __len__(self) -> int:
+        return self._size
+
+    def lookup(self, hostname: str):
+        """Returns the value of the longest listed domain hostname belongs to, or None."""
+        node = self._root
+        value = None
+        for label in reversed(hostname.split(".")):
+            node = node.get(label)
+            if node is None:
+                break
+            value = node.get(None, value)
+        return value
+
+    def items(self):
+        """Yields the listed domains and their values."""
+        stack = [((), self._root)]
+        while stack:
+            labels, node = stack.pop()
+            if None in node:
+                yield ".".join(reversed(labels)), node[None]
+            stack.extend((labels + (label,), child) for label, child in node.items() if label)
+
+
+def extract_hostnames(message: telebot.types.Message) -> tuple:
+    """Returns the hostnames in the text and caption of a message, and if Telegram marked links."""
+    hostnames = set()
+    linked = False
+    for text, entities in (
+        (message.text, message.entities),
+        (message.caption, message.caption_entities),
+    ):
+        if text:
+            hostnames.update(hostname.lower() for hostname in _HOSTNAMES.findall(text))
+        for entity in entities or ():
+            if entity.type == "url":
+                linked = True
+            elif entity.type == "text_link":
+                linked = True
+                hostname = urllib.parse.urlsplit(entity.url).hostname
+                if hostname:
+                    hostnames.add(hostname)
+    return hostnames, linked
+
+
+def host_verdict(chat_id: int, hostname: str, domains: DomainTrie):
+    """Returns True if the chat allows hostname, False if it blocks it, None if it isn't listed."""
+    cached = host_cache.get((chat_id, hostname))
+    if cached is not None and cached[0] is domains:
+        return cached[1]
+    verdict = domains.lookup(normalize_domain(hostname))
+    host_cache.set((chat_id, hostname), (domains, verdict))
+    return verdict
+
+
+def has_forbidden_links(message: telebot.types.Message, chat_settings: dict) -> bool:
+    """Checks a message for links to blocked domains, or to unlisted ones if links are off."""
+    delete_links = chat_settings.get("delete_links")
+    domains = get_domain_lists(message.chat.id)
+    if not delete_links and not domains:
+        return False
+    hostnames, linked = extract_hostnames(message)
+    verdicts = [host_verdict(message.chat.id, hostname, domains) for hostname in hostnames]
+    if delete_links and linked:
+        return not verdicts or not all(verdicts)
+    # Without links marked by Telegram, only blocked hostnames count in plain text.
+    return False in verdicts
+
+
+# --- MESSAGE FILTERS ---
+
+
+class MessageContext:
+    """A message and the data about it that filter stages need, each fetched at most once."""
+
+    __slots__ = ("message", "_user", "_chat_settings", "_is_admin")
+
+    def __init__(self, message: telebot.types.Message):
+        self.message = message
+        self._user = None
+        self._chat_settings = None
+        self._is_admin = None
+
+    @property
+    def user(self) -> dict:
+        """The moderation state of the sender in the chat, see get_user_state."""
+        if self._user is None:
+            self._user = get_user_state(self.message.chat.id, self.message.from_user)
+        return self._user
+
+    @property
+    def chat_settings(self) -> dict:
+        """The settings of the chat, see get_chat_settings."""
+        if self._chat_settings is None:
+            self._chat_settings = get_chat_settings(self.message.chat.id)
+        return self._chat_settings
+
+    @property
+    def is_admin(self) -> bool:
+        """Whether the sender administers the chat."""
+        if self._is_admin is None:
+            self._is_admin = is_admin(self.message.from_user.id, self.message.chat.id)
+        return self._is_admin
+
+
+class FilterStage:
+    """One check of the message filter pipeline, with its timing histogram."""
+
+    __slots__ = ("name", "check", "cost", "needs", "hits", "histogram")
+
+    def __init__(self, name: str, check, cost: int, needs: tuple):
+        self.name = name
+        self.check = check
+        self.cost = cost
+        self.needs = needs
+        self.hits = 0
+        self.histogram = metrics.histogram("bot_filter_stage_seconds", stage=name)
+
+
+class FilterPipeline:
+    """Runs messages through ordered filter stages until one of them handles the message.
+
+    A stage is a function taking a MessageContext that returns True when it has
+    dealt with the message, which ends the pipeline. Stages run cheapest first;
+    stages of equal cost run in the order they were added. The data a stage
+    declares in needs (attributes of MessageContext) is fetched before the stage
+    runs, once per message and timed separately, so that a stage's histogram
+    only holds its own work.
+    """
+
+    def __init__(self):
+        self.stages = []
+        self.fetch_histograms = {}  # need -> Histogram
+
+    def stage(self, name: str, cost: int, needs: tuple = ()):
+        """Registers the decorated function as a stage."""
+
+        def register(check):
+            self.add(name, check, cost, needs)
+            return check
+
+        return register
+
+    def add(self, name: str, check, cost: int, needs: tuple = ()):
+        """Adds a stage; a stage of the same name is replaced."""
+        stages = [stage for stage in self.stages if stage.name != name]
+        stages.append(FilterStage(name, check, cost, tuple(needs)))
+        stages.sort(key=lambda stage: stage.cost)  # Stable: equal costs keep their order
+        for need in needs:
+            self.fetch_histograms.setdefault(
+                need, metrics.histogram("bot_filter_fetch_seconds", data=need)
+            )
+        self.stages = stages
+
+    def run(self, message: telebot.types.Message):
+        """Filters a message and returns the name of the stage that handled it, if any."""
+        context = MessageContext(message)
+        clock = time.perf_counter
+        for stage in self.stages:
+            for need in stage.needs:
+                if getattr(context, "_" + need) is None:
+                    started = clock()
+                    getattr(context, need)
+                    self.fetch_histograms[need].observe(clock() - started)
+            started = clock()
+            handled = stage.check(context)
+            stage.histogram.observe(clock() - started)
+            if handled:
+                stage.hits += 1
+                return stage.name
+        return None
+
+    def stats(self) -> list:
+        """Returns the timings of the data fetches and stages, in the order they run."""
+        rows = [
+            {"name": f"fetch {need}", "hits": None, **histogram.stats()}
+            for need, histogram in self.fetch_histograms.items()
+        ]
+        rows += [
+            {"name": stage.name, "hits": stage.hits, **stage.histogram.stats()}
+            for stage in self.stages
+        ]
+        return rows
+
+
+message_filters = FilterPipeline()
 
 
 # --- BOT LOGIC ---
 
 
+ADMIN_STATUSES = ("administrator", "creator")
+_admin_fetch_locks = [threading.Lock() for _ in range(64)]
+
+
+def cache_admin_roster(chat_id: int, roster: list) -> frozenset:
+    """Caches the administrators of a chat, given as ChatMember objects, and returns their ids."""
+    for member in roster:
+        if member.user.is_bot:
+            admin_bots.set(member.user.id, True)
+    admins = frozenset(member.user.id for member in roster)
+    admin_cache.set(chat_id, admins)
+    return admins
+
+
+def get_chat_admins(chat_id: int) -> frozenset:
+    """Returns the ids of the chat administrators, fetching the roster when not cached."""
+    admins = admin_cache.get(chat_id)
+    if admins is not None:
+        return admins
+    # Workers that miss on the same chat at once wait for a single fetch.
+    with _admin_fetch_locks[chat_id % len(_admin_fetch_locks)]:
+        admins = admin_cache.get(chat_id)
+        if admins is not None:
+            return admins
+        try:
+            with metrics.timer("bot_api_request_seconds", method="get_chat_administrators"):
+                roster = bot.get_chat_administrators(chat_id)
+            admins = cache_admin_roster(chat_id, roster)
+        except telebot.apihelper.ApiTelegramException as e:
+            # Private chats and chats the bot has left have no roster; don't ask again right away.
+            logger.debug(f"Error fetching administrators of {chat_id}: {e}")
+            admins = frozenset()
+            admin_cache.set(chat_id, admins, ttl=ADMIN_CACHE_NEGATIVE_TTL)
+    return admins
+
+
 def is_admin(user_id: int, chat_id: int) -> bool:
     """Checks if a user is an administrator of a chat."""
-    try:
-        return bot.get_chat_member(chat_id, user_id).status in [
-            "administrator",
-            "creator",
-        ]
-    except telebot.apihelper.ApiTelegramException:
-        return False
+    return user_id in get_chat_admins(chat_id)
+
+
+@bot.chat_member_handler()
+@timed_handler
+def handle_chat_member_update(update: telebot.types.ChatMemberUpdated):
+    """Keeps the cached admin roster in sync with promotions and demotions."""
+    admins = admin_cache.get(update.chat.id)
+    if admins is None:
+        return  # Will be loaded in full on the next check
+    user_id = update.new_chat_member.user.id
+    if update.new_chat_member.status in ADMIN_STATUSES:
+        if update.new_chat_member.user.is_bot:
+            admin_bots.set(user_id, True)
+        admin_cache.set(update.chat.id, admins | {user_id})
+    elif user_id in admins:
+        admin_cache.set(update.chat.id, admins - {user_id})
 
 
 @bot.message_handler(commands=["start"])
+@timed_handler
 def handle_start(message: telebot.types.Message):
     """Handles the /start command in a private chat."""
     if message.chat.type == "private":
-        bot.reply_to(message, "This bot is intended for use in groups.")
+        reply_to(message, "This bot is intended for use in groups.")
 
 
 @bot.message_handler(commands=["setwelcome"])
+@timed_handler
 def set_welcome_message(message: telebot.types.Message):
     """Sets the welcome message for the chat."""
     if not is_admin(message.from_user.id, message.chat.id):
-        bot.reply_to(message, "Only administrators can use this command.")
+        reply_to(message, "Only administrators can use this command.")
         return
 
     welcome_message = (
@@ -296,314 +3084,789 @@ def set_welcome_message(message: telebot.types.Message):
     )
     if welcome_message:
         set_welcome_message_db(message.chat.id, welcome_message)
-        bot.reply_to(message, f'Welcome message updated to: "{welcome_message}"')
+        reply_to(message, f'Welcome message updated to: "{welcome_message}"')
     else:
-        bot.reply_to(
+        reply_to(
             message, "Please provide a welcome message. Usage: /setwelcome <message>"
         )
 
 
 @bot.message_handler(commands=["setrules"])
+@timed_handler
 def set_rules(message: telebot.types.Message):
     """Sets the rules for the chat."""
     if not is_admin(message.from_user.id, message.chat.id):
-        bot.reply_to(message, "Only administrators can use this command.")
+        reply_to(message, "Only administrators can use this command.")
         return
 
     rules = message.text.split(maxsplit=1)[1] if len(message.text.split()) > 1 else ""
     if rules:
         set_rules_db(message.chat.id, rules)
-        bot.reply_to(message, f'Rules updated to: "{rules}"')
+        reply_to(message, f'Rules updated to: "{rules}"')
     else:
-        bot.reply_to(message, "Please provide the rules. Usage: /setrules <rules>")
+        reply_to(message, "Please provide the rules. Usage: /setrules <rules>")
 
 
 @bot.message_handler(commands=["rules"])
+@timed_handler
 def show_rules(message: telebot.types.Message):
     """Shows the rules of the chat."""
     chat_settings = get_chat_settings(message.chat.id)
-    rules = chat_settings.get("rules", "No rules have been set for this chat yet.")
-    bot.reply_to(message, rules)
+    rules = chat_settings.get("rules") or "No rules have been set for this chat yet."
+    reply_to(message, rules)
 
 
 @bot.message_handler(commands=["mute"])
+@timed_handler
 def mute_user(message: telebot.types.Message):
     """Mutes a user for a specified amount of time."""
     if not is_admin(message.from_user.id, message.chat.id):
-        bot.reply_to(message, "Only administrators can use this command.")
+        reply_to(message, "Only administrators can use this command.")
         return
 
     try:
         user_id = message.reply_to_message.from_user.id
         mute_time = int(message.text.split()[1])
-        mute_user_db(user_id, mute_time)
-        bot.reply_to(message, f"User {user_id} has been muted for {mute_time} seconds.")
+        if mute_time < 1:
+            raise ValueError(mute_time)
+        mute_scheduler.mute(message.chat.id, user_id, mute_time)
+        reply_to(message, f"User {user_id} has been muted for {mute_time} seconds.")
     except (AttributeError, IndexError, ValueError):
-        bot.reply_to(message, "Usage: /mute <time_in_seconds> (reply to a message)")
+        reply_to(message, "Usage: /mute <time_in_seconds> (reply to a message)")
 
 
 @bot.message_handler(commands=["ban"])
+@timed_handler
 def ban_user(message: telebot.types.Message):
     """Bans a user from the chat."""
     if not is_admin(message.from_user.id, message.chat.id):
-        bot.reply_to(message, "Only administrators can use this command.")
+        reply_to(message, "Only administrators can use this command.")
         return
 
     try:
         user_id = message.reply_to_message.from_user.id
-        ban_user_db(user_id)
-        bot.kick_chat_member(message.chat.id, user_id)
-        bot.reply_to(message, f"User {user_id} has been banned.")
+        ban_user_db(message.chat.id, user_id)
+        metrics.inc("bot_bans_total")
+        api_scheduler.submit(
+            PRIORITY_MODERATION,
+            bot.kick_chat_member,
+            message.chat.id,
+            user_id,
+            action="banning user",
+        )
+        reply_to(message, f"User {user_id} has been banned.")
     except AttributeError:
-        bot.reply_to(message, "Usage: /ban (reply to a message)")
+        reply_to(message, "Usage: /ban (reply to a message)")
 
 
 @bot.message_handler(commands=["report"])
+@timed_handler
 def report_to_admins(message: telebot.types.Message):
     """Reports a message to the admins."""
     if message.reply_to_message:
-        reported_message = message.reply_to_message
-        reporter = message.from_user
+        admin_notifier.reported(message.from_user, message.reply_to_message)
+        reply_to(message, "The message has been reported to the administrators.")
+    else:
+        reply_to(message, "Please reply to a message to report it.")
 
-        report_text = f"Report from @{reporter.username} (ID: {reporter.id})\n"
-        report_text += f"Reported message from @{reported_message.from_user.username} (ID: {reported_message.from_user.id}):\n"
-        report_text += reported_message.text
 
-        bot.forward_message(ADMIN_ID, message.chat.id, reported_message.message_id)
-        bot.reply_to(message, "The message has been reported to the administrators.")
-    else:
-        bot.reply_to(message, "Please reply to a message to report it.")
+@bot.message_handler(commands=["spam"])
+@timed_handler
+def mark_spam(message: telebot.types.Message):
+    """Deletes the replied message as spam, along with its copies in all chats."""
+    if not is_admin(message.from_user.id, message.chat.id):
+        reply_to(message, "Only administrators can use this command.")
+        return
+    spam = message.reply_to_message
+    if not spam or not (spam.text or spam.caption):
+        reply_to(message, "Please reply to a text message to mark it as spam.")
+        return
+    spam_fingerprints.add(spam.text or spam.caption)
+    delete_message(spam)
+    reply_to(message, "The message has been deleted; its copies will be deleted too.")
 
 
 @bot.message_handler(commands=["deletelinks"])
+@timed_handler
 def set_delete_links(message: telebot.types.Message):
     """Enables or disables the deletion of links in the chat."""
     if not is_admin(message.from_user.id, message.chat.id):
-        bot.reply_to(message, "Only administrators can use this command.")
+        reply_to(message, "Only administrators can use this command.")
         return
 
     try:
         status = message.text.split()[1].lower()
         if status == "on":
             set_delete_links_db(message.chat.id, True)
-            bot.reply_to(message, "Link deletion is now enabled.")
+            reply_to(message, "Link deletion is now enabled.")
         elif status == "off":
             set_delete_links_db(message.chat.id, False)
-            bot.reply_to(message, "Link deletion is now disabled.")
+            reply_to(message, "Link deletion is now disabled.")
         else:
-            bot.reply_to(message, "Usage: /deletelinks <on/off>")
+            reply_to(message, "Usage: /deletelinks <on/off>")
     except IndexError:
-        bot.reply_to(message, "Usage: /deletelinks <on/off>")
+        reply_to(message, "Usage: /deletelinks <on/off>")
+
+
+@bot.message_handler(commands=["allowdomain", "blockdomain", "unlistdomain"])
+@timed_handler
+def set_domain_lists(message: telebot.types.Message):
+    """Allows or blocks links to domains and their subdomains, or removes them from the lists."""
+    if not is_admin(message.from_user.id, message.chat.id):
+        reply_to(message, "Only administrators can use this command.")
+        return
+
+    command, *args = message.text.split()
+    command = command[1:].split("@")[0].lower()
+    domains = [domain for domain in map(normalize_domain, args) if domain]
+    if not domains:
+        reply_to(message, f"Usage: /{command} <domain> [domain ...]")
+        return
+    if command == "unlistdomain":
+        removed = unlist_domains_db(message.chat.id, domains)
+        reply_to(message, f"Removed {removed} domain(s) from the lists.")
+    else:
+        allowed = command == "allowdomain"
+        list_domains_db(message.chat.id, domains, allowed)
+        reply_to(
+            message,
+            f"Links to {', '.join(domains)} are now {'allowed' if allowed else 'blocked'}.",
+        )
+
+
+@bot.message_handler(commands=["domains"])
+@timed_handler
+def show_domain_lists(message: telebot.types.Message):
+    """Shows the allowed and blocked domains of the chat."""
+    if not is_admin(message.from_user.id, message.chat.id):
+        reply_to(message, "Only administrators can use this command.")
+        return
+
+    listed = sorted(get_domain_lists(message.chat.id).items())
+    if not listed:
+        reply_to(message, "No domains are allowed or blocked in this chat.")
+        return
+    lines = [f"{'allowed' if allowed else 'blocked'}: {domain}" for domain, allowed in listed[:50]]
+    if len(listed) > 50:
+        lines.append(f"... and {len(listed) - 50} more")
+    reply_to(message, "\n".join(lines))
 
 
 @bot.message_handler(commands=["deleteforwards"])
+@timed_handler
 def set_delete_forwards(message: telebot.types.Message):
     """Enables or disables the deletion of forwarded messages in the chat."""
     if not is_admin(message.from_user.id, message.chat.id):
-        bot.reply_to(message, "Only administrators can use this command.")
+        reply_to(message, "Only administrators can use this command.")
         return
 
     try:
         status = message.text.split()[1].lower()
         if status == "on":
             set_delete_forwards_db(message.chat.id, True)
-            bot.reply_to(message, "Forwarded message deletion is now enabled.")
+            reply_to(message, "Forwarded message deletion is now enabled.")
         elif status == "off":
             set_delete_forwards_db(message.chat.id, False)
-            bot.reply_to(message, "Forwarded message deletion is now disabled.")
+            reply_to(message, "Forwarded message deletion is now disabled.")
         else:
-            bot.reply_to(message, "Usage: /deleteforwards <on/off>")
+            reply_to(message, "Usage: /deleteforwards <on/off>")
     except IndexError:
-        bot.reply_to(message, "Usage: /deleteforwards <on/off>")
+        reply_to(message, "Usage: /deleteforwards <on/off>")
 
 
 @bot.message_handler(commands=["deletefiles"])
+@timed_handler
 def set_delete_files(message: telebot.types.Message):
     """Enables or disables the deletion of files in the chat."""
     if not is_admin(message.from_user.id, message.chat.id):
-        bot.reply_to(message, "Only administrators can use this command.")
+        reply_to(message, "Only administrators can use this command.")
         return
 
     try:
         status = message.text.split()[1].lower()
         if status == "on":
             set_delete_files_db(message.chat.id, True)
-            bot.reply_to(message, "File deletion is now enabled.")
+            reply_to(message, "File deletion is now enabled.")
         elif status == "off":
             set_delete_files_db(message.chat.id, False)
-            bot.reply_to(message, "File deletion is now disabled.")
+            reply_to(message, "File deletion is now disabled.")
         else:
-            bot.reply_to(message, "Usage: /deletefiles <on/off>")
+            reply_to(message, "Usage: /deletefiles <on/off>")
     except IndexError:
-        bot.reply_to(message, "Usage: /deletefiles <on/off>")
+        reply_to(message, "Usage: /deletefiles <on/off>")
+
+
+@bot.message_handler(commands=["setflood"])
+@timed_handler
+def set_flood_limit(message: telebot.types.Message):
+    """Sets how many messages a user may send in a time before being muted."""
+    if not is_admin(message.from_user.id, message.chat.id):
+        reply_to(message, "Only administrators can use this command.")
+        return
+
+    usage = "Usage: /setflood <messages> <seconds> [mute_seconds] or /setflood off"
+    args = message.text.split()[1:]
+    if args == ["off"]:
+        set_flood_limit_db(message.chat.id, 0, 0, 0)
+        reply_to(message, "Flood control is now disabled.")
+        return
+    try:
+        messages, seconds = int(args[0]), int(args[1])
+        mute_time = int(args[2]) if len(args) > 2 else FLOOD_MUTE_TIME
+    except (IndexError, ValueError):
+        reply_to(message, usage)
+        return
+    if not (
+        1 <= messages <= FLOOD_MAX_MESSAGES and 1 <= seconds <= FLOOD_MAX_SECONDS and mute_time >= 1
+    ):
+        reply_to(
+            message,
+            f"Messages must be between 1 and {FLOOD_MAX_MESSAGES}, seconds between 1 and "
+            f"{FLOOD_MAX_SECONDS}, and the mute at least 1 second.\n{usage}",
+        )
+        return
+    set_flood_limit_db(message.chat.id, messages, seconds, mute_time)
+    reply_to(
+        message,
+        f"Users who send more than {messages} messages within {seconds} seconds "
+        f"will be muted for {mute_time} seconds.",
+    )
 
 
 @bot.message_handler(commands=["setlogchannel"])
+@timed_handler
 def set_log_channel(message: telebot.types.Message):
     """Sets the log channel for the chat."""
     if not is_admin(message.from_user.id, message.chat.id):
-        bot.reply_to(message, "Only administrators can use this command.")
+        reply_to(message, "Only administrators can use this command.")
         return
 
     try:
         log_channel = int(message.text.split()[1])
         set_log_channel_db(message.chat.id, log_channel)
-        logger.addHandler(TelegramLogHandler(bot, log_channel))
-        bot.reply_to(message, f"Log channel updated to: {log_channel}")
+        add_log_channel(log_channel)
+        reply_to(message, f"Log channel updated to: {log_channel}")
     except (IndexError, ValueError):
-        bot.reply_to(
+        reply_to(
             message,
             "Please provide a valid channel ID. Usage: /setlogchannel <channel_id>",
         )
 
 
+@bot.message_handler(commands=["cachestats"])
+@timed_handler
+def show_cache_stats(message: telebot.types.Message):
+    """Shows the hit/miss counters of the in-process caches."""
+    if not is_admin(message.from_user.id, message.chat.id):
+        reply_to(message, "Only administrators can use this command.")
+        return
+
+    lines = []
+    for name, cache in [
+        ("Chat settings", chat_settings_cache),
+        ("Admins", admin_cache),
+        ("Domain lists", domain_lists_cache),
+        ("Hostnames", host_cache),
+        ("Users", user_cache),
+    ]:
+        stats = cache.stats()
+        lines.append(
+            f"{name}: {stats['size']} entries, {stats['hits']} hits, "
+            f"{stats['misses']} misses ({stats['hit_rate']:.0%} hit rate)"
+        )
+    reply_to(message, "\n".join(lines))
+
+
+@bot.message_handler(commands=["apistats"])
+@timed_handler
+def show_api_stats(message: telebot.types.Message):
+    """Shows the state of the outbound request queue."""
+    if not is_admin(message.from_user.id, message.chat.id):
+        reply_to(message, "Only administrators can use this command.")
+        return
+
+    stats = api_scheduler.stats()
+    deletions = deletion_batcher.stats()
+    reply_to(
+        message,
+        f"Queued: {stats['queued']} (max {stats['max_queued']}), in flight: {stats['in_flight']}\n"
+        f"Sent: {stats['sent']}, failed: {stats['failed']}, retried: {stats['retried']}, "
+        f"dropped: {stats['dropped']}\n"
+        f"Queue wait: {stats['avg_wait']:.2f}s average, {stats['max_wait']:.2f}s max\n"
+        f"Deleted {deletions['messages']} messages in {deletions['batches']} batches "
+        f"({deletions['fallbacks']} batches retried one by one)",
+    )
+
+
+@bot.message_handler(commands=["filterstats"])
+@timed_handler
+def show_filter_stats(message: telebot.types.Message):
+    """Shows how often each message filter stage fired and how long it took."""
+    if not is_admin(message.from_user.id, message.chat.id):
+        reply_to(message, "Only administrators can use this command.")
+        return
+
+    lines = []
+    for stats in message_filters.stats():
+        hits = "" if stats["hits"] is None else f", {stats['hits']} hits"
+        lines.append(
+            f"{stats['name']}: {stats['count']} runs{hits}, {stats['mean'] * 1e6:.0f} µs average, "
+            f"p50 <= {stats['p50'] * 1e6:.0f} µs, p99 <= {stats['p99'] * 1e6:.0f} µs"
+        )
+    reply_to(message, "\n".join(lines))
+
+
 @bot.message_handler(content_types=["new_chat_members"])
+@timed_handler
 def handle_new_member(message: telebot.types.Message):
     """Sends a captcha to a new user."""
-    chat_settings = get_chat_settings(message.chat.id)
-    welcome_message_template = chat_settings.get(
-        "welcome_message",
-        "Welcome, {user_name}!\nTo be able to write in the chat, please solve the equation: {num1} + {num2} = ?",
-    )
+    chat_id = message.chat.id
+    users = message.new_chat_members
+    if raid_detector.record(chat_id, len(users)):
+        # Raid mode: constant work per joiner, one captcha message per interval.
+        if RAID_RESTRICT_ON_JOIN:
+            for user in users:
+                restrict_raid_joiner(chat_id, user.id)
+        raid_captcha_batcher.add(chat_id, users)
+        return
 
-    for user in message.new_chat_members:
-        add_or_update_user(user)
+    chat_settings = get_chat_settings(chat_id)
+    welcome_message_template = (
+        chat_settings.get("welcome_message")
+        or "Welcome, {user_name}!\nTo be able to write in the chat, please solve the equation: {num1} + {num2} = ?"
+    )
 
+    add_or_update_users(users)
+    for user in users:
         # Create captcha
         num1 = random.randint(CAPTCHA_MIN_NUMBER, CAPTCHA_MAX_NUMBER)
         num2 = random.randint(CAPTCHA_MIN_NUMBER, CAPTCHA_MAX_NUMBER)
         correct_answer = num1 + num2
-        pending_captchas[user.id] = correct_answer
+        captcha_store.add(chat_id, user.id, correct_answer)
+        metrics.inc("bot_captchas_total", result="issued")
 
         welcome_message = welcome_message_template.format(
             user_name=user.first_name, num1=num1, num2=num2
         )
 
-        try:
-            bot.send_message(message.chat.id, welcome_message)
-        except telebot.apihelper.ApiTelegramException as e:
-            logger.error(f"Error sending captcha: {e}")
-
-
-def check_captcha(message: telebot.types.Message) -> bool:
-    """Checks the captcha for a user."""
-    user = message.from_user
-    if user.id in pending_captchas:
-        try:
-            if int(message.text) == pending_captchas[user.id]:
-                set_user_verified(user.id)
-                del pending_captchas[user.id]
-                try:
-                    bot.reply_to(message, "Correct! You can now send messages.")
-                except telebot.apihelper.ApiTelegramException as e:
-                    logger.error(f"Error sending reply: {e}")
-            else:
-                try:
-                    bot.reply_to(message, "Incorrect answer. Please try again.")
-                except telebot.apihelper.ApiTelegramException as e:
-                    logger.error(f"Error sending reply: {e}")
-        except (ValueError, TypeError):
-            try:
-                bot.reply_to(
-                    message, "Please enter a number in response to the captcha."
-                )
-            except telebot.apihelper.ApiTelegramException as e:
-                logger.error(f"Error sending reply: {e}")
-        return True  # User is in the process of solving the captcha
-    return False  # Captcha not for this user
+        sent = send_message(
+            chat_id,
+            welcome_message,
+            PRIORITY_WELCOME,
+            action="sending captcha",
+            reply_markup=captcha_keyboard(chat_id, user.id, correct_answer),
+        )
+        captcha_challenges.track(chat_id, [user.id], sent)
+
+
+def solve_captcha(chat_id: int, user_id: int, answer: int) -> str:
+    """Checks the answer a user pressed and returns what to tell them."""
+    correct_answer = captcha_store.get(chat_id, user_id)
+    if correct_answer is None:
+        return "You have no captcha to solve."
+    if answer == correct_answer:
+        set_user_verified(chat_id, user_id)
+        captcha_store.remove(chat_id, user_id)
+        captcha_challenges.done(chat_id, user_id)
+        captcha_attempts.delete((chat_id, user_id))
+        lift_raid_restriction(chat_id, user_id)
+        metrics.inc("bot_captchas_total", result="solved")
+        return "Correct! You can now send messages."
+    attempts = captcha_attempts.get((chat_id, user_id), 0) + 1
+    captcha_attempts.set((chat_id, user_id), attempts)
+    if attempts < CAPTCHA_MAX_ATTEMPTS:
+        return "Incorrect answer. Please try again."
+    logger.info(f"User {user_id} failed the captcha in chat {chat_id}.")
+    captcha_store.remove(chat_id, user_id)
+    captcha_challenges.done(chat_id, user_id)
+    captcha_attempts.delete((chat_id, user_id))
+    metrics.inc("bot_captchas_total", result="failed")
+    if CAPTCHA_KICK_ON_TIMEOUT:
+        api_scheduler.submit(
+            PRIORITY_MODERATION, kick_user, chat_id, user_id, action="kicking user"
+        )
+    return "Incorrect answer."
+
+
+@bot.callback_query_handler(func=lambda call: (call.data or "").startswith("cap:"))
+@timed_handler
+def handle_captcha_answer(call: telebot.types.CallbackQuery):
+    """Checks the answer a user pressed on a captcha."""
+    captcha = parse_captcha_data(call.data)
+    if captcha is None or call.message is None or captcha[0] != call.message.chat.id:
+        text = "This captcha is not valid."
+    elif captcha[1] and captcha[1] != call.from_user.id:
+        text = "This captcha is for someone else."
+    else:
+        text = solve_captcha(captcha[0], call.from_user.id, captcha[2])
+    api_scheduler.submit(
+        PRIORITY_REPLY, bot.answer_callback_query, call.id, text, action="answering captcha"
+    )
 
 
 def check_swear_words(message: telebot.types.Message) -> bool:
     """Checks a message for swear words."""
     user = message.from_user
-    for word in SWEAR_WORDS:
-        if word in message.text.lower():
-            try:
-                bot.delete_message(message.chat.id, message.message_id)
-            except telebot.apihelper.ApiTelegramException as e:
-                logger.error(f"Error deleting message: {e}")
-            warnings = add_warning(user.id)
+    if get_swear_word_matcher().search(message.text or message.caption) is None:
+        return False  # No swear words found
+    delete_message(message)
+    spam_fingerprints.suspect(message.text or message.caption, message.chat.id, user.id)
+    warnings = add_warning(message.chat.id, user.id)
+    metrics.inc("bot_warnings_total")
+
+    send_message(
+        message.chat.id,
+        f"@ {user.username}, please follow the chat rules. "
+        f"You have been issued a warning ({warnings}/{WARNING_LIMIT}).",
+        PRIORITY_WARNING,
+        action="sending warning",
+    )
 
-            try:
-                bot.send_message(
-                    message.chat.id,
-                    f"@ {user.username}, please follow the chat rules. "
-                    f"You have been issued a warning ({warnings}/{WARNING_LIMIT}).",
-                )
-            except telebot.apihelper.ApiTelegramException as e:
-                logger.error(f"Error sending warning: {e}")
+    if warnings >= WARNING_LIMIT:
+        admin_notifier.warned(message.chat, user, warnings)
+    return True  # Swear word found
+
+
+# Stages of the message filters. The costs reflect where the data comes from:
+# 0 = flood counters and mutes, 1 = in-process caches, 2 = the message itself,
+# 5 = fingerprinting the text, 6 = scanning the text. Copies of spam are deleted
+# before the swear word scan, so that they don't earn their senders warnings too.
+
+
+@message_filters.stage("muted", cost=0)
+def filter_muted(context: MessageContext) -> bool:
+    """Deletes messages of muted users that Telegram let through."""
+    message = context.message
+    if (message.chat.id, message.from_user.id) in mute_scheduler:
+        delete_message(message)
+        return True
+    return False
+
+
+@message_filters.stage("flood", cost=0, needs=("chat_settings",))
+def filter_flood(context: MessageContext) -> bool:
+    """Mutes users who send too many messages and drops what they send until then."""
+    message = context.message
+    chat_id, user_id = message.chat.id, message.from_user.id
+    if flood_tracker.throttled(chat_id, user_id):
+        # Sent before the mute took effect in Telegram.
+        delete_message(message)
+        return True
+    settings = context.chat_settings
+    messages = settings.get("flood_messages")
+    messages = FLOOD_MESSAGES if messages is None else messages
+    if not messages:
+        return False  # Flood control is off in this chat
+    seconds = settings.get("flood_seconds") or FLOOD_SECONDS
+    if not flood_tracker.record(chat_id, user_id, messages, seconds) or context.is_admin:
+        return False
+    mute_time = settings.get("flood_mute_time") or FLOOD_MUTE_TIME
+    flood_tracker.throttle(chat_id, user_id, mute_time)
+    delete_message(message)
+    mute_scheduler.mute(chat_id, user_id, mute_time)
+    metrics.inc("bot_floods_total")
+    logger.info(f"User {user_id} flooded chat {chat_id} and was muted for {mute_time} seconds.")
+    send_message(
+        chat_id,
+        f"{display_name(message.from_user)} has been muted for {mute_time} seconds for flooding.",
+        PRIORITY_WARNING,
+        action="sending flood notice",
+    )
+    return True
+
+
+@message_filters.stage("banned", cost=1, needs=("user",))
+def filter_banned(context: MessageContext) -> bool:
+    """Ignores messages of banned users."""
+    return bool(context.user.get("banned"))
+
+
+@message_filters.stage("links", cost=2, needs=("chat_settings",))
+def filter_links(context: MessageContext) -> bool:
+    """Deletes links to blocked domains, and if the chat forbids links, to any but allowed ones."""
+    message = context.message
+    if has_forbidden_links(message, context.chat_settings) and not context.is_admin:
+        delete_message(message)
+        return True
+    return False
+
+
+@message_filters.stage("forwards", cost=2, needs=("chat_settings",))
+def filter_forwards(context: MessageContext) -> bool:
+    """Deletes forwarded messages if the chat forbids them."""
+    if (
+        context.chat_settings.get("delete_forwards")
+        and context.message.forward_from
+        and not context.is_admin
+    ):
+        delete_message(context.message)
+        return True
+    return False
+
+
+@message_filters.stage("files", cost=2, needs=("chat_settings",))
+def filter_files(context: MessageContext) -> bool:
+    """Deletes files if the chat forbids them."""
+    if (
+        context.chat_settings.get("delete_files")
+        and context.message.document
+        and not context.is_admin
+    ):
+        delete_message(context.message)
+        return True
+    return False
+
+
+@message_filters.stage("unverified", cost=2, needs=("user",))
+def filter_unverified(context: MessageContext) -> bool:
+    """Deletes messages of users who have not passed the captcha."""
+    message = context.message
+    pending = (message.chat.id, message.from_user.id) in captcha_store
+    if pending or not context.user.get("is_verified"):
+        delete_message(message)
+        return True
+    return False
+
+
+@message_filters.stage("duplicates", cost=5)
+def filter_duplicates(context: MessageContext) -> bool:
+    """Deletes copies of texts that were deleted as spam in any chat."""
+    message = context.message
+    if not spam_fingerprints.match(message.text or message.caption) or context.is_admin:
+        return False
+    delete_message(message)
+    metrics.inc("bot_spam_copies_total")
+    logger.info(f"Deleted a copy of spam from user {message.from_user.id} in chat {message.chat.id}.")
+    return True
 
-            if warnings >= WARNING_LIMIT:
-                try:
-                    bot.send_message(
-                        ADMIN_ID,
-                        f"User @{user.username} (ID: {user.id}) "
-                        f"has reached the warning limit ({warnings}).",
-                    )
-                except telebot.apihelper.ApiTelegramException as e:
-                    logger.error(f"Error sending admin notification: {e}")
-            return True  # Swear word found
-    return False  # No swear words found
 
+@message_filters.stage("swear words", cost=6)
+def filter_swear_words(context: MessageContext) -> bool:
+    """Deletes messages with swear words and warns their senders."""
+    return check_swear_words(context.message)
 
-@bot.message_handler(func=lambda message: True)
+
+# Media messages too: links, swear words and spam come in captions as well.
+@bot.message_handler(func=lambda message: True, content_types=telebot.util.content_type_media)
+@timed_handler
 def handle_all_messages(message: telebot.types.Message):
     """Handles all incoming messages."""
-    user = get_user(message.from_user.id)
-    if not user:
-        add_or_update_user(message.from_user)
-        user = get_user(message.from_user.id)
+    message_filters.run(message)
 
-    if user.get("banned"):
-        return
 
-    if user.get("muted") and user.get("muted") > int(time.time()):
-        try:
-            bot.delete_message(message.chat.id, message.message_id)
-        except telebot.apihelper.ApiTelegramException as e:
-            logger.error(f"Error deleting message: {e}")
-        return
+# --- WEBHOOK ---
 
-    chat_settings = get_chat_settings(message.chat.id)
-    if not is_admin(message.from_user.id, message.chat.id):
-        if (
-            chat_settings.get("delete_links")
-            and message.entities
-            and any(e.type in ["url", "text_link"] for e in message.entities)
-        ):
-            try:
-                bot.delete_message(message.chat.id, message.message_id)
-            except telebot.apihelper.ApiTelegramException as e:
-                logger.error(f"Error deleting message: {e}")
-            return
 
-        if chat_settings.get("delete_forwards") and message.forward_from:
-            try:
-                bot.delete_message(message.chat.id, message.message_id)
-            except telebot.apihelper.ApiTelegramException as e:
-                logger.error(f"Error deleting message: {e}")
-            return
+class WebhookServer:
+    """Receives updates over HTTP and runs the handlers on a pool of worker threads.
 
-        if chat_settings.get("delete_files") and message.document:
-            try:
-                bot.delete_message(message.chat.id, message.message_id)
-            except telebot.apihelper.ApiTelegramException as e:
-                logger.error(f"Error deleting message: {e}")
-            return
+    Requests only parse the update and put it in a bounded queue; when the queue
+    is full the server answers 503 and Telegram delivers the update again later.
+    """
 
-    if check_captcha(message):
-        return
-
-    # If the user is not verified (old member who has not passed the captcha)
-    if not get_user_status(user.get("user_id")):
-        try:
-            bot.delete_message(message.chat.id, message.message_id)
-        except telebot.apihelper.ApiTelegramException as e:
-            logger.error(f"Error deleting message: {e}")
-        return
-
-    if check_swear_words(message):
-        return
+    def __init__(self, bot, host: str, port: int, path: str, secret_token: str = "",
+                 queue_size: int = WEBHOOK_QUEUE_SIZE, workers: int = WEBHOOK_WORKERS):
+        self.bot = bot
+        self.path = path
+        self.secret_token = secret_token
+        self.updates = queue.Queue(maxsize=queue_size)
+        self.workers = [
+            threading.Thread(target=self._work, name=f"WebhookWorker{i + 1}", daemon=True)
+            for i in range(workers)
+        ]
+        self.httpd = ThreadingHTTPServer((host, port), self._make_request_handler())
+        self.httpd.daemon_threads = True
+
+    @property
+    def address(self) -> tuple:
+        """The (host, port) the server listens on."""
+        return self.httpd.server_address[:2]
+
+    def _make_request_handler(self):
+        server = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # Keep-alive, Telegram reuses connections
+
+            def do_POST(self):
+                # Checked before the body is read, so that a rejected client can't make
+                # the server read an arbitrary amount of data.
+                if self.path != server.path:
+                    self._reject(404)
+                    return
+                if server.secret_token and not hmac.compare_digest(
+                    self.headers.get("X-Telegram-Bot-Api-Secret-Token", "").encode(),
+                    server.secret_token.encode(),
+                ):
+                    self._reject(403)
+                    return
+                try:
+                    length = int(self.headers.get("Content-Length", 0))
+                except ValueError:
+                    length = -1
+                if not 0 <= length <= WEBHOOK_MAX_BODY_SIZE:
+                    self._reject(413 if length > 0 else 400)
+                    return
+                body = self.rfile.read(length)
+                try:
+                    update = telebot.types.Update.de_json(body.decode("utf-8"))
+                except (ValueError, KeyError, TypeError):  # Not JSON, or not an update
+                    self._respond(400)
+                    return
+                try:
+                    server.updates.put_nowait(update)
+                except queue.Full:
+                    logger.warning("Webhook queue is full, asking Telegram to retry.")
+                    self._respond(503)
+                    return
+                self._respond(200)
+
+            def _respond(self, status: int):
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def _reject(self, status: int):
+                # The body is left unread, so the connection can't be reused.
+                self.close_connection = True
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.send_header("Connection", "close")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass  # One line per update would flood the log
+
+        return RequestHandler
+
+    def _work(self):
+        while True:
+            update = self.updates.get()
+            try:
+                if update is None:
+                    return
+                self.bot.process_new_updates([update])
+            except Exception as e:
+                logger.error(f"Error processing update {update.update_id}: {e}")
+            finally:
+                self.updates.task_done()
+
+    def start(self):
+        """Starts the workers and serves requests on a background thread."""
+        # The workers run the handlers themselves instead of the bot's own thread pool.
+        self.bot.threaded = False
+        for worker in self.workers:
+            worker.start()
+        threading.Thread(target=self.httpd.serve_forever, name="WebhookServer", daemon=True).start()
+
+    def join(self):
+        """Blocks until every queued update has been processed."""
+        self.updates.join()
+
+    def stop(self):
+        """Stops accepting requests and lets the workers finish the queued updates."""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        for _ in self.workers:
+            self.updates.put(None)
+        for worker in self.workers:
+            worker.join()
+
+
+# --- METRICS ENDPOINT ---
+
+
+class MetricsServer:
+    """Serves the metrics registry as text for a Prometheus scraper or curl."""
+
+    def __init__(self, registry: MetricsRegistry, host: str, port: int):
+        self.registry = registry
+        self.httpd = ThreadingHTTPServer((host, port), self._make_request_handler())
+        self.httpd.daemon_threads = True
+
+    @property
+    def address(self) -> tuple:
+        """The (host, port) the server listens on."""
+        return self.httpd.server_address[:2]
+
+    def _make_request_handler(self):
+        registry = self.registry
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # Scrapes would flood the log
+
+        return RequestHandler
+
+    def start(self):
+        """Serves requests on a background thread."""
+        threading.Thread(target=self.httpd.serve_forever, name="MetricsServer", daemon=True).start()
+
+    def stop(self):
+        """Stops serving requests."""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def start_metrics(port: int = None, log_interval: float = None):
+    """Starts the metrics endpoint and the periodic summaries, as far as they are enabled.
+
+    Returns the MetricsServer, or None if the endpoint is disabled or its port
+    can't be used; the bot runs on without it then.
+    """
+    port = METRICS_PORT if port is None else port
+    log_interval = METRICS_LOG_INTERVAL if log_interval is None else log_interval
+    if log_interval:
+
+        def report():
+            while True:
+                time.sleep(log_interval)
+                logger.info(metrics.summary())
+
+        threading.Thread(target=report, name="MetricsReporter", daemon=True).start()
+    if not port:
+        return None
+    try:
+        server = MetricsServer(metrics, METRICS_HOST, port)
+    except OSError as e:
+        logger.error(f"Error serving metrics on {METRICS_HOST}:{port}: {e}")
+        return None
+    server.start()
+    logger.info(f"Serving metrics on http://{METRICS_HOST}:{server.address[1]}/metrics")
+    return server
+
+
+# Components that count for themselves are read when the metrics are rendered.
+for _name, _cache in [
+    ("chat_settings", chat_settings_cache),
+    ("admins", admin_cache),
+    ("domain_lists", domain_lists_cache),
+    ("hosts", host_cache),
+    ("users", user_cache),
+]:
+    metrics.gauge("bot_cache_entries", lambda cache=_cache: cache.stats()["size"], cache=_name)
+    metrics.gauge("bot_cache_hits", lambda cache=_cache: cache.hits, cache=_name)
+    metrics.gauge("bot_cache_misses", lambda cache=_cache: cache.misses, cache=_name)
+metrics.gauge("bot_api_queued", lambda: api_scheduler.stats()["queued"])
+metrics.gauge("bot_api_in_flight", lambda: api_scheduler.stats()["in_flight"])
+metrics.gauge("bot_pending_captchas", lambda: len(captcha_store))
+metrics.gauge("bot_active_mutes", lambda: len(mute_scheduler))
+metrics.gauge("bot_write_behind_pending", lambda: len(write_behind))
+metrics.gauge("bot_spam_fingerprints", lambda: len(spam_fingerprints))
+metrics.gauge("bot_admin_notifications_pending", lambda: len(admin_notifier))
 
 
 # --- BOT START ---
@@ -616,9 +3879,47 @@ if __name__ == "__main__":
         logger.error(
             "Error: Admin ID not specified. Please edit the file and specify the ADMIN_ID."
         )
+    elif RUN_MODE == "webhook" and not WEBHOOK_URL:
+        logger.error(
+            "Error: Webhook URL not specified. Please edit the file and specify the WEBHOOK_URL."
+        )
     else:
         logger.info("Initializing database...")
         init_db()
         logger.info("Database ready.")
+        for channel_id in get_log_channels():
+            add_log_channel(channel_id)
+        captcha_store.start()
+        mute_scheduler.start()
+        start_metrics()
         logger.info("Starting bot...")
-        bot.polling(none_stop=True)
+        try:
+            if RUN_MODE == "webhook":
+                server = WebhookServer(
+                    bot, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET_TOKEN
+                )
+                server.start()
+                # chat_member updates are not sent unless requested explicitly.
+                bot.set_webhook(
+                    url=WEBHOOK_URL,
+                    secret_token=WEBHOOK_SECRET_TOKEN or None,
+                    allowed_updates=telebot.util.update_types,
+                )
+                logger.info(f"Listening for updates on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+                try:
+                    threading.Event().wait()
+                except KeyboardInterrupt:
+                    pass
+                finally:
+                    server.stop()
+            else:
+                bot.remove_webhook()
+                # chat_member updates are not sent unless requested explicitly.
+                bot.polling(none_stop=True, allowed_updates=telebot.util.update_types)
+        finally:
+            raid_captcha_batcher.flush_all()
+            deletion_batcher.flush()
+            admin_notifier.flush()
+            api_scheduler.stop()
+            write_behind.flush()
+            close_connections()
@@ -0,0 +1,902 @@
+"""Tests of telegram_bot.py that need no connection to Telegram.
+
+Usage: python -m unittest test_telegram_bot (or pytest)
+"""
+
+import http.client
+import json
+import os
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import Future
+from unittest import mock
+
+import telebot
+
+import telegram_bot
+
+
+def api_error(code: int, description: str, **parameters) -> telebot.apihelper.ApiTelegramException:
+    """Builds the exception telebot raises when Telegram answers with an error."""
+    result_json = {"ok": False, "error_code": code, "description": description}
+    if parameters:
+        result_json["parameters"] = parameters
+    return telebot.apihelper.ApiTelegramException("test", None, result_json)
+
+
+def make_message(chat_id: int, user_id: int, text: str = "hello", message_id: int = 1,
+                 **fields) -> telebot.types.Message:
+    """Builds a group message the way telebot parses it from an update."""
+    return telebot.types.Message.de_json({
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "supergroup", "title": "Test"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"},
+        "text": text,
+        **fields,
+    })
+
+
+def wait_for(predicate, timeout: float = 5.0) -> bool:
+    """Waits until predicate() is true, for work done by a background thread."""
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+# The schema init_db created before migrations were introduced.
+BASELINE_SCHEMA = """
+    CREATE TABLE users (
+        user_id INTEGER PRIMARY KEY,
+        is_bot BOOLEAN,
+        first_name TEXT,
+        last_name TEXT,
+        username TEXT,
+        language_code TEXT,
+        join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        warnings INTEGER DEFAULT 0,
+        is_verified BOOLEAN DEFAULT 0,
+        muted INTEGER DEFAULT 0,
+        banned INTEGER DEFAULT 0
+    );
+    CREATE TABLE chat_settings (
+        chat_id INTEGER PRIMARY KEY,
+        welcome_message TEXT,
+        rules TEXT,
+        delete_links BOOLEAN DEFAULT 0,
+        delete_forwards BOOLEAN DEFAULT 0,
+        delete_files BOOLEAN DEFAULT 0,
+        log_channel INTEGER
+    );
+    INSERT INTO users (user_id, first_name, warnings, is_verified) VALUES (1, 'Ann', 2, 1);
+    INSERT INTO chat_settings (chat_id, rules) VALUES (-100, 'Be nice');
+"""
+
+
+class MigratorTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db_name = os.path.join(self.tmp.name, "users.db")
+        with sqlite3.connect(self.db_name) as conn:
+            conn.executescript(BASELINE_SCHEMA)
+        patcher = mock.patch.object(telegram_bot, "DB_NAME", self.db_name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        telegram_bot.close_connections()
+        self.tmp.cleanup()
+
+    def migrator(self, **kwargs) -> telegram_bot.Migrator:
+        return telegram_bot.Migrator(telegram_bot.get_connection(), batch_pause=0, **kwargs)
+
+    def schema(self) -> list:
+        return telegram_bot.get_connection().execute(
+            "SELECT type, name, sql FROM sqlite_master ORDER BY name"
+        ).fetchall()
+
+    def test_migrates_baseline_schema(self):
+        report = self.migrator().run()
+        self.assertEqual(
+            [entry["version"] for entry in report],
+            [version for version, _, _ in telegram_bot.MIGRATIONS],
+        )
+        conn = telegram_bot.get_connection()
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(chat_settings)")}
+        self.assertIn("flood_messages", columns)
+        self.assertEqual(
+            conn.execute("SELECT rules FROM chat_settings WHERE chat_id = -100").fetchone()[0],
+            "Be nice",
+        )
+
+    def test_dry_run_changes_nothing(self):
+        before = self.schema()
+        report = self.migrator(dry_run=True).run()
+        self.assertEqual(len(report), len(telegram_bot.MIGRATIONS))
+        self.assertEqual(self.schema(), before)
+        self.assertFalse(telegram_bot.get_connection().in_transaction)
+
+    def test_second_run_is_a_no_op(self):
+        self.migrator().run()
+        schema = self.schema()
+        self.assertEqual(self.migrator().run(), [])
+        self.assertEqual(self.migrator(dry_run=True).run(), [])
+        self.assertEqual(self.schema(), schema)
+
+    def test_interrupted_backfill_resumes(self):
+        # Migrate up to the backfill of migration 4, then give it expired mutes to clear.
+        with mock.patch.object(telegram_bot, "MIGRATIONS", telegram_bot.MIGRATIONS[:3]):
+            self.migrator().run()
+        conn = telegram_bot.get_connection()
+        with conn:
+            conn.executemany(
+                "INSERT INTO chat_members (chat_id, user_id, muted) VALUES (-100, ?, 1)",
+                [(user_id,) for user_id in range(5)],
+            )
+
+        # The pause after the first committed batch is where the process dies.
+        with mock.patch.object(telegram_bot.time, "sleep", side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                self.migrator(batch_size=2).run()
+        muted = "SELECT count(*) FROM chat_members WHERE muted > 0"
+        self.assertEqual(conn.execute(muted).fetchone()[0], 3)
+        self.assertNotIn(4, self.migrator().applied_versions())
+
+        report = self.migrator(batch_size=2).run()
+        self.assertEqual(report[0]["version"], 4)
+        self.assertEqual(report[0]["rows"], 3)
+        self.assertEqual(conn.execute(muted).fetchone()[0], 0)
+
+    def test_drops_unused_indexes(self):
+        self.migrator().run()
+        indexes = {
+            row[0]
+            for row in telegram_bot.get_connection().execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'chat_members'"
+            )
+        }
+        self.assertIn("chat_members_muted", indexes)
+        for index in ("chat_members_user", "chat_members_banned", "chat_members_unverified"):
+            self.assertNotIn(index, indexes)
+
+    def test_running_legacy_mutes_are_enforced(self):
+        muted_until = int(time.time()) + 600
+        conn = telegram_bot.get_connection()
+        with conn:
+            conn.execute("UPDATE users SET muted = ? WHERE user_id = 1", (muted_until,))
+            conn.execute("INSERT INTO users (user_id, muted) VALUES (2, ?)", (muted_until - 1200,))
+        self.migrator().run()
+        bot = mock.patch.object(telegram_bot, "bot").start()
+        mock.patch.object(telegram_bot, "api_scheduler", ImmediateScheduler()).start()
+        scheduler = telegram_bot.MuteScheduler()
+        mock.patch.object(telegram_bot, "mute_scheduler", scheduler).start()
+        self.addCleanup(mock.patch.stopall)
+        self.addCleanup(telegram_bot.user_cache.clear)
+
+        state = telegram_bot.get_user_state(-100, telebot.types.User(1, False, "Ann"))
+        self.assertEqual(state["muted"], muted_until)
+        self.assertIn((-100, 1), scheduler)
+        bot.restrict_chat_member.assert_called_once()
+        self.assertEqual(bot.restrict_chat_member.call_args.kwargs["until_date"], muted_until)
+
+        # Mutes that ended while the bot was down are not carried over.
+        state = telegram_bot.get_user_state(-100, telebot.types.User(2, False, "Bob"))
+        self.assertEqual(state["muted"], 0)
+        self.assertNotIn((-100, 2), scheduler)
+        bot.restrict_chat_member.assert_called_once()
+
+    def test_init_db_refuses_old_sqlite(self):
+        before = self.schema()
+        with mock.patch.object(telegram_bot.sqlite3, "sqlite_version_info", (3, 34, 1)):
+            with self.assertRaisesRegex(RuntimeError, "3.35"):
+                telegram_bot.init_db()
+        self.assertEqual(self.schema(), before)
+
+
+class DatabaseTest(unittest.TestCase):
+    """Runs each test against a freshly migrated database and empty caches."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        db_name = os.path.join(self.tmp.name, "users.db")
+        patcher = mock.patch.object(telegram_bot, "DB_NAME", db_name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        telegram_bot.init_db()
+        for cache in [
+            telegram_bot.chat_settings_cache,
+            telegram_bot.user_cache,
+            telegram_bot.domain_lists_cache,
+            telegram_bot.host_cache,
+        ]:
+            cache.clear()
+            self.addCleanup(cache.clear)
+
+    def tearDown(self):
+        telegram_bot.write_behind.flush()  # Before another database takes this one's place
+        telegram_bot.close_connections()
+        self.tmp.cleanup()
+
+
+class CaptchaStoreTest(DatabaseTest):
+    def test_add_get_remove(self):
+        store = telegram_bot.CaptchaStore(timeout=60)
+        store.add(-100, 1, 7)
+        self.assertIn((-100, 1), store)
+        self.assertEqual(store.get(-100, 1), 7)
+        self.assertIsNone(store.get(-100, 2))
+        store.remove(-100, 1)
+        self.assertIsNone(store.get(-100, 1))
+        self.assertEqual(telegram_bot.get_captchas_db(), [])
+
+    def test_expired_captchas_are_handed_over(self):
+        expired = []
+        store = telegram_bot.CaptchaStore(
+            timeout=60, on_expire=lambda chat_id, user_id: expired.append((chat_id, user_id))
+        )
+        store.start()
+        store.add(-100, 1, 7)
+        store.timeout = 0
+        store.add_many(-100, [2, 3], 5)
+        self.assertTrue(wait_for(lambda: len(expired) == 2))
+        self.assertEqual(sorted(expired), [(-100, 2), (-100, 3)])
+        self.assertEqual(len(store), 1)
+        rows = telegram_bot.get_captchas_db()
+        self.assertEqual([tuple(row)[:3] for row in rows], [(-100, 1, 7)])
+
+    def test_restart_reloads_persisted_captchas(self):
+        store = telegram_bot.CaptchaStore(timeout=60)
+        store.add(-100, 1, 7)
+        store.add_many(-200, [2, 3], 5)
+
+        restarted = telegram_bot.CaptchaStore(timeout=60)
+        restarted.start(owns_chat=lambda chat_id: chat_id == -200)
+        self.assertEqual(len(restarted), 2)
+        self.assertIsNone(restarted.get(-100, 1))
+        self.assertEqual(restarted.get(-200, 3), 5)
+
+    def test_nothing_is_stored_without_persist(self):
+        store = telegram_bot.CaptchaStore(timeout=60, persist=False)
+        store.add(-100, 1, 7)
+        self.assertEqual(telegram_bot.get_captchas_db(), [])
+
+
+class WriteBehindBufferTest(DatabaseTest):
+    def setUp(self):
+        super().setUp()
+        self.buffer = telegram_bot.WriteBehindBuffer(interval=60)
+        mock.patch.object(telegram_bot, "write_behind", self.buffer).start()
+        self.addCleanup(mock.patch.stopall)
+        self.user = telebot.types.User(1, False, "Ann")
+
+    def test_warnings_are_counted_before_they_are_written(self):
+        telegram_bot.get_user_state(-100, self.user)
+        self.assertEqual(telegram_bot.add_warning(-100, 1), 1)
+        self.assertEqual(telegram_bot.add_warning(-100, 1), 2)
+        telegram_bot.user_cache.clear()
+        self.assertEqual(telegram_bot.get_user_state(-100, self.user)["warnings"], 2)
+        self.buffer.flush()
+        telegram_bot.user_cache.clear()
+        self.assertEqual(telegram_bot.get_user_state(-100, self.user)["warnings"], 2)
+
+    def test_warning_queued_while_state_is_loaded(self):
+        # The warning is queued between the database read and the caching of the state.
+        results = []
+        worker = threading.Thread(target=lambda: results.append(telegram_bot.add_warning(-100, 1)))
+        cache_state = self.buffer.cache_state
+
+        def cache_state_after_warning(chat_id, user_id, state):
+            worker.start()
+            self.assertTrue(wait_for(lambda: self.buffer.pending_warnings(-100, 1) == 1))
+            cache_state(chat_id, user_id, state)
+
+        with mock.patch.object(self.buffer, "cache_state", cache_state_after_warning):
+            state = telegram_bot.get_user_state(-100, self.user)
+        worker.join(5)
+        self.assertEqual(results, [1])
+        self.assertEqual(state["warnings"], 1)
+        self.assertEqual(telegram_bot.add_warning(-100, 1), 2)
+
+
+class MuteSchedulerTest(DatabaseTest):
+    def setUp(self):
+        super().setUp()
+        self.bot = mock.patch.object(telegram_bot, "bot").start()
+        mock.patch.object(telegram_bot, "api_scheduler", ImmediateScheduler()).start()
+        self.addCleanup(mock.patch.stopall)
+        self.scheduler = telegram_bot.MuteScheduler()
+
+    def permissions(self) -> list:
+        return [call.kwargs["permissions"] for call in self.bot.restrict_chat_member.call_args_list]
+
+    def test_restricts_then_lifts(self):
+        self.scheduler.start()
+        self.scheduler.mute(-100, 1, 0)  # Ends right away
+        self.assertTrue(wait_for(lambda: len(self.permissions()) == 2))
+        self.assertEqual(
+            self.permissions(),
+            [telegram_bot.MUTED_PERMISSIONS, telegram_bot.UNRESTRICTED_PERMISSIONS],
+        )
+        self.assertNotIn((-100, 1), self.scheduler)
+        self.assertEqual(telegram_bot.get_mutes_db(), [])
+
+    def test_replaced_mute_is_not_lifted_early(self):
+        self.scheduler.mute(-100, 1, 0)
+        self.scheduler.mute(-100, 1, 600)
+        # The end of the first mute is due as soon as the sweeper runs.
+        self.scheduler.start()
+        time.sleep(0.1)
+        self.assertEqual(self.permissions(), [telegram_bot.MUTED_PERMISSIONS] * 2)
+        self.assertIn((-100, 1), self.scheduler)
+
+    def test_start_recovers_stored_mutes(self):
+        telegram_bot.mute_user_db(-100, 1, 600)
+        telegram_bot.mute_user_db(-200, 2, 600)
+        self.scheduler.start(owns_chat=lambda chat_id: chat_id == -100)
+        self.assertIn((-100, 1), self.scheduler)
+        self.assertNotIn((-200, 2), self.scheduler)
+
+    def test_pipeline_deletes_what_muted_users_send(self):
+        delete = mock.patch.object(telegram_bot, "delete_message").start()
+        mock.patch.object(telegram_bot, "mute_scheduler", self.scheduler).start()
+        self.scheduler.mute(-100, 1, 600)
+        message = make_message(-100, 1)
+        self.assertEqual(telegram_bot.message_filters.run(message), "muted")
+        delete.assert_called_once_with(message)
+
+
+class FloodTrackerTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch.object(telegram_bot.time, "monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_flags_more_than_the_limit_within_the_window(self):
+        tracker = telegram_bot.FloodTracker()
+        self.assertEqual(
+            [tracker.record(-100, 1, 3, 5) for _ in range(4)], [False, False, False, True]
+        )
+
+    def test_window_slides(self):
+        tracker = telegram_bot.FloodTracker()
+        for _ in range(3):
+            tracker.record(-100, 1, 3, 5)
+            self.now += 2
+        # The first message is now 6 seconds old.
+        self.assertFalse(tracker.record(-100, 1, 3, 5))
+        self.assertTrue(tracker.record(-100, 1, 3, 5))
+
+    def test_pairs_are_counted_apart(self):
+        tracker = telegram_bot.FloodTracker()
+        for _ in range(3):
+            tracker.record(-100, 1, 3, 5)
+        self.assertFalse(tracker.record(-100, 2, 3, 5))
+        self.assertFalse(tracker.record(-200, 1, 3, 5))
+
+    def test_changed_limit_starts_over(self):
+        tracker = telegram_bot.FloodTracker()
+        for _ in range(3):
+            tracker.record(-100, 1, 3, 5)
+        self.assertFalse(tracker.record(-100, 1, 5, 5))
+
+    def test_throttle(self):
+        tracker = telegram_bot.FloodTracker()
+        tracker.record(-100, 1, 3, 5)
+        tracker.throttle(-100, 1, 60)
+        self.assertTrue(tracker.throttled(-100, 1))
+        self.now += 61
+        self.assertFalse(tracker.throttled(-100, 1))
+
+    def test_forgets_the_quietest_pairs(self):
+        tracker = telegram_bot.FloodTracker(maxsize=2)
+        tracker.record(-100, 1, 3, 5)
+        tracker.throttle(-100, 1, 60)
+        tracker.record(-100, 2, 3, 5)
+        tracker.record(-100, 3, 3, 5)
+        self.assertFalse(tracker.throttled(-100, 1))
+
+
+class SetFloodTest(DatabaseTest):
+    def setUp(self):
+        super().setUp()
+        mock.patch.object(telegram_bot, "is_admin", return_value=True).start()
+        self.reply_to = mock.patch.object(telegram_bot, "reply_to").start()
+        self.addCleanup(mock.patch.stopall)
+
+    def set_flood(self, text: str) -> dict:
+        telegram_bot.set_flood_limit(make_message(-100, 1, text))
+        return telegram_bot.get_chat_settings(-100)
+
+    def test_stores_limits(self):
+        settings = self.set_flood("/setflood 5 10 60")
+        self.assertEqual(
+            (settings["flood_messages"], settings["flood_seconds"], settings["flood_mute_time"]),
+            (5, 10, 60),
+        )
+
+    def test_rejects_limits_out_of_range(self):
+        for text in ["/setflood 0 10", "/setflood 101 10", "/setflood 5 3601", "/setflood 5 10 0"]:
+            with self.subTest(text=text):
+                self.assertIsNone(self.set_flood(text).get("flood_messages"))
+                self.assertIn("between 1 and 100", self.reply_to.call_args.args[1])
+                telegram_bot.chat_settings_cache.clear()
+
+
+class DisplayNameTest(unittest.TestCase):
+    def test_falls_back_to_first_name_and_id(self):
+        for user, name in [
+            (telebot.types.User(1, False, "Ann", username="ann"), "@ann"),
+            (telebot.types.User(1, False, "Ann"), "Ann"),
+            (telebot.types.User(1, False, ""), "1"),
+        ]:
+            self.assertEqual(telegram_bot.display_name(user), name)
+
+
+SPAM = "Earn 500 dollars a day from home, write to our manager now"
+
+
+class SpamFingerprintsTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch.object(telegram_bot.time, "monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.spam = telegram_bot.SpamFingerprints(ttl=600, bucket=60)
+
+    def test_matches_exact_and_near_copies(self):
+        self.assertFalse(self.spam.match(SPAM))
+        self.spam.add(SPAM)
+        self.assertTrue(self.spam.match(SPAM))
+        self.assertTrue(self.spam.match(SPAM.upper() + "!!"))
+        self.assertTrue(self.spam.match(SPAM.replace("500", "700")))
+        self.assertFalse(self.spam.match("Does anyone know when the next meetup starts?"))
+
+    def test_ignores_short_texts(self):
+        self.spam.add("buy now")
+        self.assertEqual(len(self.spam), 0)
+
+    def test_suspects_need_several_sources(self):
+        self.spam.suspect(SPAM, -100, 1)
+        self.spam.suspect(SPAM, -100, 1)
+        self.assertFalse(self.spam.match(SPAM))
+        self.spam.suspect(SPAM, -200, 1)
+        self.assertTrue(self.spam.match(SPAM))
+
+    def test_fingerprints_expire(self):
+        self.spam.add(SPAM)
+        self.now += 700
+        self.assertFalse(self.spam.match(SPAM))
+        self.assertEqual(len(self.spam), 0)
+
+    def test_forgets_the_oldest_beyond_maxsize(self):
+        spam = telegram_bot.SpamFingerprints(maxsize=1)
+        spam.add(SPAM)
+        spam.add("Free crypto giveaway, send 1 coin and get 2 coins back today")
+        self.assertFalse(spam.match(SPAM))
+        self.assertEqual(len(spam), 1)
+
+
+class FilterOrderTest(DatabaseTest):
+    def setUp(self):
+        super().setUp()
+        self.spam = telegram_bot.SpamFingerprints()
+        mock.patch.object(telegram_bot, "spam_fingerprints", self.spam).start()
+        mock.patch.object(telegram_bot, "is_admin", return_value=False).start()
+        self.delete = mock.patch.object(telegram_bot, "delete_message").start()
+        self.send = mock.patch.object(telegram_bot, "send_message").start()
+        self.addCleanup(mock.patch.stopall)
+        telegram_bot.set_user_verified(-100, 1)
+
+    def test_spam_copies_are_not_warned_for(self):
+        text = SPAM + " дурак"
+        self.spam.add(text)
+        message = make_message(-100, 1, text)
+        self.assertEqual(telegram_bot.message_filters.run(message), "duplicates")
+        self.delete.assert_called_once_with(message)
+        self.send.assert_not_called()
+        self.assertEqual(telegram_bot.write_behind.pending_warnings(-100, 1), 0)
+
+
+class DomainTrieTest(unittest.TestCase):
+    def setUp(self):
+        self.trie = telegram_bot.DomainTrie(
+            [("example.com", True), ("ads.example.com", False), ("spam.net", False)]
+        )
+
+    def test_longest_listed_suffix_wins(self):
+        self.assertIs(self.trie.lookup("example.com"), True)
+        self.assertIs(self.trie.lookup("www.example.com"), True)
+        self.assertIs(self.trie.lookup("ads.example.com"), False)
+        self.assertIs(self.trie.lookup("cdn.ads.example.com"), False)
+        self.assertIs(self.trie.lookup("spam.net"), False)
+
+    def test_unlisted_hostnames(self):
+        self.assertIsNone(self.trie.lookup("notexample.com"))
+        self.assertIsNone(self.trie.lookup("com"))
+        self.assertIsNone(self.trie.lookup("example.org"))
+
+    def test_items(self):
+        self.assertEqual(len(self.trie), 3)
+        self.assertEqual(
+            sorted(self.trie.items()),
+            [("ads.example.com", False), ("example.com", True), ("spam.net", False)],
+        )
+
+
+class LinksTest(DatabaseTest):
+    def test_extract_hostnames(self):
+        message = make_message(
+            -100, 1, "see Example.com or mail me@mail.org, docs here",
+            entities=[{"type": "text_link", "offset": 39, "length": 4, "url": "https://docs.io/x"}],
+        )
+        hostnames, linked = telegram_bot.extract_hostnames(message)
+        self.assertEqual(hostnames, {"example.com", "docs.io"})
+        self.assertTrue(linked)
+        caption = make_message(-100, 1, None, caption="visit spam.com")
+        self.assertEqual(telegram_bot.extract_hostnames(caption), ({"spam.com"}, False))
+
+    def test_has_forbidden_links(self):
+        telegram_bot.list_domains_db(-100, ["spam.com"], False)
+        telegram_bot.list_domains_db(-100, ["example.com"], True)
+        blocked = make_message(-100, 1, "buy at www.spam.com")
+        unlisted = make_message(-100, 1, "see news.org")
+        self.assertTrue(telegram_bot.has_forbidden_links(blocked, {}))
+        self.assertFalse(telegram_bot.has_forbidden_links(unlisted, {}))
+        # With links off, only allowed domains may be linked.
+        linked = make_message(
+            -100, 1, "see news.org", entities=[{"type": "url", "offset": 4, "length": 8}]
+        )
+        allowed = make_message(
+            -100, 1, "see example.com", entities=[{"type": "url", "offset": 4, "length": 11}]
+        )
+        self.assertTrue(telegram_bot.has_forbidden_links(linked, {"delete_links": 1}))
+        self.assertFalse(telegram_bot.has_forbidden_links(allowed, {"delete_links": 1}))
+
+
+class MediaMessagesTest(DatabaseTest):
+    def setUp(self):
+        super().setUp()
+        mock.patch.object(telegram_bot.bot, "threaded", False).start()
+        mock.patch.object(telegram_bot, "is_admin", return_value=False).start()
+        self.delete = mock.patch.object(telegram_bot, "delete_message").start()
+        self.send = mock.patch.object(telegram_bot, "send_message").start()
+        self.addCleanup(mock.patch.stopall)
+        telegram_bot.set_user_verified(-100, 1)
+        self.update_id = 0
+
+    def send_update(self, **fields) -> telebot.types.Message:
+        self.update_id += 1
+        message = make_message(-100, 1, None, message_id=self.update_id, **fields)
+        update = telebot.types.Update.de_json({
+            "update_id": self.update_id, "message": message.json,
+        })
+        telegram_bot.bot.process_new_updates([update])
+        return update.message
+
+    def test_captioned_photo_with_blocked_link_is_deleted(self):
+        telegram_bot.list_domains_db(-100, ["spam.com"], False)
+        photo = [{"file_id": "p", "file_unique_id": "p", "width": 90, "height": 90}]
+        message = self.send_update(photo=photo, caption="buy at spam.com дурак")
+        self.delete.assert_called_once()
+        self.assertEqual(self.delete.call_args.args[0].message_id, message.message_id)
+        self.assertEqual(self.delete.call_args.args[0].content_type, "photo")
+
+    def test_document_caption_with_swear_word_is_warned_for(self):
+        document = {"file_id": "d", "file_unique_id": "d"}
+        self.send_update(document=document, caption="ты дурак")
+        self.delete.assert_called_once()
+        self.send.assert_called_once()
+
+    def test_sticker_passes(self):
+        sticker = {"file_id": "s", "file_unique_id": "s", "type": "regular", "width": 1,
+                   "height": 1, "is_animated": False, "is_video": False}
+        self.send_update(sticker=sticker)
+        self.delete.assert_not_called()
+
+
+class AdminNotifierTest(DatabaseTest):
+    def setUp(self):
+        super().setUp()
+        self.sent = []  # (chat_id, text)
+        self.refusing = {7}
+        mock.patch.object(telegram_bot, "send_message", self.send_message).start()
+        mock.patch.object(telegram_bot, "get_chat_admins", return_value=frozenset({7})).start()
+        mock.patch.object(telegram_bot, "ADMIN_ID", 42).start()
+        self.addCleanup(mock.patch.stopall)
+        self.notifier = telegram_bot.AdminNotifier()
+        self.chat = telebot.types.Chat(-100, "supergroup", title="Test")
+
+    def send_message(self, chat_id: int, text: str, priority: int, **kwargs) -> Future:
+        self.sent.append((chat_id, text))
+        future = Future()
+        if chat_id in self.refusing:
+            future.set_exception(api_error(403, "Forbidden: bot can't initiate conversation"))
+        else:
+            future.set_result(None)
+        return future
+
+    def test_names_users_without_username(self):
+        self.refusing = set()
+        self.notifier.warned(self.chat, telebot.types.User(1, False, "Ann"), 3)
+        self.notifier.warned(self.chat, telebot.types.User(2, False, "Bob", username="bob"), 3)
+        self.notifier.flush()
+        [(chat_id, text)] = self.sent
+        self.assertEqual(chat_id, 7)
+        self.assertIn("- Ann (ID: 1)", text)
+        self.assertIn("- @bob (ID: 2)", text)
+        self.assertNotIn("@None", text)
+
+    def test_falls_back_to_admin_id(self):
+        self.notifier.warned(self.chat, telebot.types.User(1, False, "Ann"), 3)
+        self.notifier.flush()
+        self.assertEqual([chat_id for chat_id, _ in self.sent], [7, 42])
+        self.assertIn("could be reached", self.sent[1][1])
+        self.assertIn("- Ann (ID: 1)", self.sent[1][1])
+
+        # The unreachable admin is skipped from then on.
+        self.sent.clear()
+        self.notifier.warned(self.chat, telebot.types.User(1, False, "Ann"), 4)
+        self.notifier.flush()
+        self.assertEqual([chat_id for chat_id, _ in self.sent], [42])
+
+    def test_log_channel_gets_the_digest(self):
+        telegram_bot.set_log_channel_db(-100, -555)
+        self.notifier.warned(self.chat, telebot.types.User(1, False, "Ann"), 3)
+        self.notifier.flush()
+        self.assertEqual([chat_id for chat_id, _ in self.sent], [-555])
+
+
+class CaptchaDataTest(unittest.TestCase):
+    def test_round_trip(self):
+        data = telegram_bot.sign_captcha_data(-1001234567890, 42, 17)
+        self.assertLessEqual(len(data.encode()), 64)
+        self.assertEqual(telegram_bot.parse_captcha_data(data), (-1001234567890, 42, 17))
+
+    def test_rejects_forged_data(self):
+        data = telegram_bot.sign_captcha_data(-100, 42, 17)
+        prefix, chat_id, user_id, _, signature = data.split(":")
+        forged = ":".join([prefix, chat_id, user_id, "18", signature])
+        self.assertIsNone(telegram_bot.parse_captcha_data(forged))
+        self.assertIsNone(telegram_bot.parse_captcha_data(data.replace("cap:", "xyz:")))
+
+    def test_rejects_malformed_data(self):
+        for data in (None, "", "cap:", "cap:1:2:3", "cap:a:b:c:d"):
+            self.assertIsNone(telegram_bot.parse_captcha_data(data))
+
+
+class PendingCaptchaTest(DatabaseTest):
+    def setUp(self):
+        super().setUp()
+        self.store = telegram_bot.CaptchaStore(timeout=60)
+        mock.patch.object(telegram_bot, "captcha_store", self.store).start()
+        mock.patch.object(telegram_bot, "is_admin", return_value=False).start()
+        self.delete = mock.patch.object(telegram_bot, "delete_message").start()
+        self.addCleanup(mock.patch.stopall)
+        self.user = telebot.types.User(1, False, "Ann")
+
+    def test_new_captcha_unverifies_a_verified_user(self):
+        telegram_bot.set_user_verified(-100, 1)
+        self.assertTrue(telegram_bot.get_user_state(-100, self.user)["is_verified"])
+        self.store.add(-100, 1, 7)
+        self.assertFalse(telegram_bot.get_user_state(-100, self.user)["is_verified"])
+        telegram_bot.user_cache.clear()
+        self.assertFalse(telegram_bot.get_user_state(-100, self.user)["is_verified"])
+
+    def test_messages_are_deleted_while_the_captcha_is_pending(self):
+        self.store.add(-100, 1, 7)
+        # Verified by a stale state, e.g. one loaded before the captcha was given.
+        telegram_bot.user_cache.set((-100, 1), {
+            "user_id": 1, "warnings": 0, "is_verified": 1, "muted": 0, "banned": 0,
+        })
+        message = make_message(-100, 1)
+        self.assertEqual(telegram_bot.message_filters.run(message), "unverified")
+        self.delete.assert_called_once_with(message)
+
+    def test_solving_verifies(self):
+        mock.patch.object(telegram_bot, "bot").start()
+        mock.patch.object(telegram_bot, "api_scheduler", ImmediateScheduler()).start()
+        self.store.add(-100, 1, 7)
+        self.assertTrue(telegram_bot.solve_captcha(-100, 1, 7).startswith("Correct!"))
+        self.assertNotIn((-100, 1), self.store)
+        self.assertIsNone(telegram_bot.message_filters.run(make_message(-100, 1)))
+        self.delete.assert_not_called()
+
+
+class StubBot:
+    """Collects the updates a WebhookServer hands to its workers."""
+
+    def __init__(self):
+        self.threaded = True
+        self.updates = []
+        self.lock = threading.Lock()
+
+    def process_new_updates(self, updates: list):
+        with self.lock:
+            self.updates.extend(updates)
+
+
+class WebhookServerTest(unittest.TestCase):
+    def setUp(self):
+        self.bot = StubBot()
+        self.server = telegram_bot.WebhookServer(
+            self.bot, "127.0.0.1", 0, "/telegram", secret_token="s3cret", workers=1
+        )
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.conn = http.client.HTTPConnection(*self.server.address, timeout=5)
+        self.addCleanup(self.conn.close)
+
+    def post(self, body: str, path: str = "/telegram", secret: str = "s3cret") -> int:
+        self.conn.request(
+            "POST", path, body.encode(), {"X-Telegram-Bot-Api-Secret-Token": secret}
+        )
+        response = self.conn.getresponse()
+        response.read()
+        return response.status
+
+    def test_accepts_updates(self):
+        self.assertEqual(self.post(json.dumps({"update_id": 7})), 200)
+        self.server.join()
+        self.assertEqual([update.update_id for update in self.bot.updates], [7])
+
+    def test_rejects_bodies_that_are_not_updates(self):
+        # Each answer comes back on the same keep-alive connection.
+        for body in ["[]", "{}", '"x"', "null", "not json"]:
+            with self.subTest(body=body):
+                self.assertEqual(self.post(body), 400)
+        self.assertEqual(self.post(json.dumps({"update_id": 8})), 200)
+        self.server.join()
+        self.assertEqual([update.update_id for update in self.bot.updates], [8])
+
+    def test_rejects_wrong_secret_and_path(self):
+        self.assertEqual(self.post("{}", secret="guess"), 403)
+        self.conn.close()
+        self.assertEqual(self.post("{}", path="/other"), 404)
+        self.assertEqual(self.bot.updates, [])
+
+
+class ImmediateScheduler:
+    """Stands in for telegram_bot.api_scheduler and sends each request on submit."""
+
+    def __init__(self):
+        self.priorities = []
+
+    def submit(self, priority: int, func, *args, limit_chat: int = None, action: str = "",
+               **kwargs) -> Future:
+        self.priorities.append(priority)
+        future = Future()
+        try:
+            future.set_result(func(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+class ApiSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = telegram_bot.ApiScheduler(workers=1)
+        self.addCleanup(self.scheduler.stop)
+
+    def test_sends_in_priority_order(self):
+        sent = []
+        # The dispatcher can't pick anything until all of them are queued.
+        with self.scheduler._cond:
+            for priority in [3, 0, 2, 1, 0]:
+                self.scheduler.submit(priority, sent.append, priority)
+        self.scheduler.join()
+        self.assertEqual(sent, [0, 0, 1, 2, 3])
+
+    def test_retries_after_429(self):
+        answers = [api_error(429, "Too Many Requests", retry_after=0), "ok"]
+
+        def request():
+            answer = answers.pop(0)
+            if isinstance(answer, Exception):
+                raise answer
+            return answer
+
+        self.assertEqual(self.scheduler.submit(0, request).result(timeout=5), "ok")
+        self.assertEqual(self.scheduler.stats()["retried"], 1)
+        self.assertEqual(self.scheduler.stats()["sent"], 1)
+
+    def test_gives_up_after_max_retries(self):
+        calls = []
+
+        def request():
+            calls.append(1)
+            raise api_error(429, "Too Many Requests", retry_after=0)
+
+        future = self.scheduler.submit(0, request)
+        with self.assertRaises(telebot.apihelper.ApiTelegramException):
+            future.result(timeout=5)
+        self.assertEqual(len(calls), telegram_bot.API_MAX_RETRIES + 1)
+
+    def test_other_errors_fail_at_once(self):
+        calls = []
+
+        def request():
+            calls.append(1)
+            raise api_error(400, "Bad Request: chat not found")
+
+        with self.assertRaises(telebot.apihelper.ApiTelegramException):
+            self.scheduler.submit(0, request).result(timeout=5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(self.scheduler.stats()["failed"], 1)
+
+
+class DeletionBatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.bot = mock.patch.object(telegram_bot, "bot").start()
+        mock.patch.object(telegram_bot, "api_scheduler", ImmediateScheduler()).start()
+        self.addCleanup(mock.patch.stopall)
+        self.batcher = telegram_bot.DeletionBatcher(window=60, max_size=3)
+
+    def test_sends_full_batches_at_once(self):
+        for message_id in [1, 2, 3, 4]:
+            self.batcher.add(-100, message_id)
+        self.bot.delete_messages.assert_called_once_with(-100, [1, 2, 3])
+        self.assertEqual(self.batcher.stats()["pending"], 1)
+
+    def test_flush_sends_single_messages_on_their_own(self):
+        self.batcher.add(-100, 1)
+        self.batcher.add(-200, 2)
+        self.batcher.add(-200, 3)
+        self.batcher.flush()
+        self.bot.delete_message.assert_called_once_with(-100, 1)
+        self.bot.delete_messages.assert_called_once_with(-200, [2, 3])
+        self.assertEqual(self.batcher.stats()["batches"], 2)
+
+    def test_sends_batches_after_the_window(self):
+        batcher = telegram_bot.DeletionBatcher(window=0.01, max_size=100)
+        batcher.add(-100, 1)
+        batcher.add(-100, 2)
+        self.assertTrue(wait_for(lambda: self.bot.delete_messages.called))
+        self.bot.delete_messages.assert_called_once_with(-100, [1, 2])
+
+    def test_falls_back_to_single_deletes_for_message_errors(self):
+        self.bot.delete_messages.side_effect = api_error(
+            400, "Bad Request: message to delete not found"
+        )
+        self.batcher.add(-100, 1)
+        self.batcher.add(-100, 2)
+        self.batcher.flush()
+        self.assertEqual(
+            self.bot.delete_message.call_args_list, [mock.call(-100, 1), mock.call(-100, 2)]
+        )
+        self.assertEqual(self.batcher.stats()["fallbacks"], 1)
+
+    def test_no_fallback_for_permission_errors(self):
+        for error in [
+            api_error(403, "Forbidden: bot was kicked from the supergroup chat"),
+            api_error(400, "Bad Request: not enough rights to delete a message"),
+        ]:
+            with self.subTest(error=error.description):
+                self.bot.delete_messages.side_effect = error
+                self.batcher.add(-100, 1)
+                self.batcher.add(-100, 2)
+                self.batcher.flush()
+        self.bot.delete_message.assert_not_called()
+        self.assertEqual(self.batcher.stats()["fallbacks"], 0)
+
+
+class StartMetricsTest(unittest.TestCase):
+    def test_busy_port_is_logged_not_raised(self):
+        busy = socket.socket()
+        self.addCleanup(busy.close)
+        busy.bind(("127.0.0.1", 0))
+        busy.listen()
+        with mock.patch.object(telegram_bot, "METRICS_HOST", "127.0.0.1"):
+            with self.assertLogs(telegram_bot.logger, "ERROR"):
+                server = telegram_bot.start_metrics(port=busy.getsockname()[1], log_interval=0)
+        self.assertIsNone(server)
+
+
+if __name__ == "__main__":
+    unittest.main()